@@ -3,11 +3,15 @@ import os
 import sys
 import time
 from argparse import ArgumentParser
-from multiprocessing import Process, Manager, cpu_count
-from pygit2 import Repository, GIT_SORT_REVERSE, GIT_SORT_TOPOLOGICAL
-from tqdm import tqdm
-
-
+from feature_io import TableWriter
+from columnar import INT, STR
+from functools import partial
+import instrument
+from commit_index import open_commit_index
+from diffstat import (LARGE_COMMIT_SCHEMA, add_guard_arguments, commit_diff, effective_guard, find_diffstats, guard_enabled,
+                      guard_from_args, init_worker_store)
+from message_labels import DEFAULT_LABELER, MessageLabeler, load_keywords
+from scheduler import run_stage
 
 # 全局后缀变量
 suffix_num = "1" 
@@ -15,8 +19,12 @@ suffix_repo = "z3"
 suffix_branch = "master"
 suffix_file = "z3_data"
 
-MANAGER = Manager()
-RES = MANAGER.dict()
+# 每行结果的列及其类型
+CHURN_SCHEMA = [
+    ("project", STR), ("parent_hashes", STR), ("commit_hash", STR), ("author_name", STR),
+    ("author_email", STR), ("author_date", STR), ("author_date_unix_timestamp", INT),
+    ("commit_message", STR), ("la", INT), ("ld", INT), ("nf", INT), ("classification", STR)
+]
 
 def load_commit_hashes_from_csv(csv_file_path):
     """
@@ -38,126 +46,99 @@ def format_author_date(author_time, author_offset):
     timezone_offset = f"{hours_offset:+03d}00"  # 格式化为 +0000 或 -0000 的格式
     return f"{formatted_time} {timezone_offset}"
 
+# 提交信息分类器，工作进程中可由 init_worker 换成自定义关键词
+LABELER = DEFAULT_LABELER
+
+# project 列的取值，工作进程中由 init_worker 设置
+PROJECT = suffix_repo
+
 def classify_commit_message(commit_message):
     """
-    根据commit_message中的关键词对提交进行分类。
+    根据commit_message中的关键词对提交进行分类（关键词见 message_labels.py）。
     """
-    message = commit_message.lower()
-    
-    if any(keyword in message for keyword in ["fix", "bug", "defect", "correct"]):
-        return "Corrective"
-    elif any(keyword in message for keyword in ["add", "feature", "improvement", "introduce"]):
-        return "Feature Addition"
-    elif any(keyword in message for keyword in ["improve", "enhance", "refactor", "optimize"]):
-        return "Perfective"
-    elif any(keyword in message for keyword in ["prevent", "avoid", "secure"]):
-        return "Preventative"
-    elif any(keyword in message for keyword in ["non functional", "documentation", "doc", "comment"]):
-        return "Non Functional"
-    else:
-        return "None"
-
-def parse_code_churns(pid, repo_path, branch, commit_hashes):
+    return LABELER.classify(commit_message)
+
+def init_worker(diffstat_path, index_path, keywords_path=None, project=suffix_repo, guard=None):
+    """
+    在工作进程启动时打开diff统计存储，并按需加载自定义关键词和大提交保护设置。
+    """
+    global LABELER, PROJECT
+    PROJECT = project
+    init_worker_store(diffstat_path, index_path, guard)
+    if keywords_path:
+        LABELER = MessageLabeler(load_keywords(keywords_path))
+
+def parse_code_churn(repo, commit):
     """
-    计算指定提交的代码变更，并存储在RES字典中。
+    计算单个提交的代码变更，由调度器在工作进程中调用。
     """
-    repo = Repository(repo_path)
-    head = repo.references.get(branch)
-    commits = list(repo.walk(head.target, GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE))
-
-    # 只处理 commit_hashes 中指定的提交
-    commits = [commit for commit in commits if str(commit.id) in commit_hashes]
-
-    code_churns = [[] for _ in range(len(commits))]
-    for i, commit in enumerate(tqdm(commits, position=pid)):
-        if commit.parents:
-            diff = repo.diff(commit.parents[0], commit)
-        else:
-            diff = repo.diff(None, commit)
-
-        patches = [p for p in diff]
-        stats = diff.stats
-
-        # 统计变更行数
-        cloc = stats.insertions  # 增加的代码行数
-        dloc = stats.deletions  # 删除的代码行数
-        files_churned = len(patches)  # 修改的文件数量
-
-        parent_hashes = ','.join([str(p.id) for p in commit.parents])  # 父提交哈希
-
-        # 提取提交者信息
-        author = commit.author
-        author_name = author.name
-        author_email = author.email
-        author_date = format_author_date(author.time, author.offset)  # 格式化 author_date
-        author_date_unix_timestamp = str(author.time)  # 提取Unix时间戳
-        commit_message = commit.message.strip()
-
-        # 基于commit_message进行分类
-        classification = classify_commit_message(commit_message)
-
-        # 存储扩展后的特pytorch
-        code_churns[i].append(f"{suffix_repo}")                           # project: 固定为 z3
-        code_churns[i].append(parent_hashes)                  # parent_hashes
-        code_churns[i].append(str(commit.id))                 # commit_hash
-        code_churns[i].append(author_name)                    # author_name
-        code_churns[i].append(author_email)                   # author_email
-        code_churns[i].append(author_date)                    # author_date
-        code_churns[i].append(author_date_unix_timestamp)     # author_date_unix_timestamp
-        code_churns[i].append(commit_message)                 # commit_message
-        code_churns[i].append(str(cloc))                      # la: 代码增加行数
-        code_churns[i].append(str(dloc))                      # ld: 代码删除行数
-        code_churns[i].append(str(files_churned))             # nf: 变更的文件数
-        code_churns[i].append(classification)                 # classification: 提交的分类
-
-    RES[pid] = code_churns
-
-def get_code_churns(repo_path, branch, commit_hashes):
+    # 相对第一个父提交（根提交与空树）修改的文件，优先从diff统计存储中读取
+    entries, large_commit = commit_diff(repo, commit)
+
+    # 统计变更行数
+    cloc = sum(e.additions for e in entries)  # 增加的代码行数
+    dloc = sum(e.deletions for e in entries)  # 删除的代码行数
+    files_churned = len(entries)  # 修改的文件数量
+
+    parent_hashes = ','.join([str(p.id) for p in commit.parents])  # 父提交哈希
+
+    # 提取提交者信息
+    author = commit.author
+    author_name = author.name
+    author_email = author.email
+    author_date = format_author_date(author.time, author.offset)  # 格式化 author_date
+    author_date_unix_timestamp = author.time  # 提取Unix时间戳
+    commit_message = commit.message.strip()
+
+    # 基于commit_message进行分类
+    classification = classify_commit_message(commit_message)
+
+    # 存储扩展后的特征
+    code_churn = []
+    code_churn.append(PROJECT)                            # project: 默认为 suffix_repo
+    code_churn.append(parent_hashes)                      # parent_hashes
+    code_churn.append(str(commit.id))                     # commit_hash
+    code_churn.append(author_name)                        # author_name
+    code_churn.append(author_email)                       # author_email
+    code_churn.append(author_date)                        # author_date
+    code_churn.append(author_date_unix_timestamp)         # author_date_unix_timestamp
+    code_churn.append(commit_message)                     # commit_message
+    code_churn.append(cloc)                               # la: 代码增加行数
+    code_churn.append(dloc)                               # ld: 代码删除行数
+    code_churn.append(files_churned)                      # nf: 变更的文件数
+    code_churn.append(classification)                     # classification: 提交的分类
+    if guard_enabled():
+        code_churn.append(large_commit)                   # large_commit: 大提交的处理方式（见 diffstat.py）
+    return code_churn
+
+def get_code_churns(repo_path, branch, commit_hashes, processes=None, chunk_size=8, diffstat_root=f"./{suffix_file}/diffstat", keywords=None,
+                    index_root=f"./{suffix_file}/commit_index", project=suffix_repo, guard=None, checkpoint_dir=None):
     """
     提取指定提交的代码变更信息。
+    diffstat_root 下存在当前tip的diff统计（diffstat.py）时直接读取，不再重新diff；
+    keywords 为分类关键词配置文件（见 message_labels.py），为 None 时使用默认关键词；
+    project 为 project 列的取值；guard 为大提交保护设置（见 diffstat.py），启用时输出 large_commit 列；
+    checkpoint_dir 为断点目录（见 scheduler.run_stage）。
     """
-    cpus =  cpu_count() 
-    print(f"Using {cpus} CPUs...")
-
-    # 将提交列表分为多份，以便并行处理
-    commit_list = list(commit_hashes)
-    quotes, remainder = divmod(len(commit_list), cpus)
-
-    processes = [
-        Process(target=parse_code_churns, args=(i, repo_path, branch, set(commit_list[i * quotes + min(i, remainder): (i + 1) * quotes + min(i + 1, remainder)])))
-        for i in range(cpus)
-    ]
-
-    for process in processes:
-        process.start()
-
-    start_time = time.time()
-    for process in processes:
-        process.join()
-    end_time = time.time()
-
-    print("Done")
-    print(f"Overall processing time: {end_time - start_time} seconds")
-
-    churns = []
-    for _, churn in RES.items():
-        churns.extend(churn)
-
-    churns = list(reversed(churns))
+    index = open_commit_index(repo_path, branch, index_root)
+    store_path = find_diffstats(diffstat_root, index)
+    guard = effective_guard(guard, store_path)
+    schema = CHURN_SCHEMA + LARGE_COMMIT_SCHEMA if guard.max_files else CHURN_SCHEMA
+    setup = partial(init_worker, store_path, index.path, keywords, project, guard)
+
+    # 按拓扑顺序把提交分成小块，由空闲进程按需领取
+    churns = run_stage(parse_code_churn, repo_path, index, index.select(commit_hashes), schema, processes, chunk_size, setup=setup,
+                       checkpoint_dir=checkpoint_dir)
     return churns
 
 def save_churns(churns, path=f"./{suffix_file}/code_churns{suffix_num}.csv"):
     """
-    将结果保存为CSV文件。
+    将结果保存为CSV文件，path 以 .parquet 结尾时保存为 Parquet 文件。
     """
-    with open(path, 'w') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow([
-            "project", "parent_hashes", "commit_hash", "author_name", "author_email",
-            "author_date", "author_date_unix_timestamp", "commit_message", "la", "ld", "nf", "classification"
-        ])
-
-        for row in churns:
+    with TableWriter(path, [name for name, _ in churns.schema]) as writer:
+
+        # 按拓扑逆序（最新的提交在前）逐行写出
+        for row in reversed(churns):
             if row:
                 writer.writerow(row)
 
@@ -166,8 +147,20 @@ if __name__ == "__main__":
     PARSER.add_argument("--repository", "-r", type=str, default=f"/home/WangZiyang/szz/{suffix_repo}", help="本地Git仓库的路径")
     PARSER.add_argument("--branch", "-b", type=str, default=f"refs/heads/{suffix_branch}", help="要分析的分支")
     PARSER.add_argument("--csv_file", "-c", type=str, default=f"./{suffix_file}/commit_id{suffix_num}.csv", help="包含提交哈希的CSV文件路径")
+    PARSER.add_argument("--processes", "-p", type=int, default=None, help="工作进程数，默认使用全部CPU")
+    PARSER.add_argument("--chunk-size", type=int, default=8, help="每次分发给工作进程的相邻提交数")
+    PARSER.add_argument("--output", "-o", type=str, default=f"./{suffix_file}/code_churns{suffix_num}.csv", help="输出文件，以 .parquet 结尾时保存为 Parquet")
+    PARSER.add_argument("--diffstat-root", type=str, default=f"./{suffix_file}/diffstat", help="diff统计存储目录（diffstat.py 生成）")
+    PARSER.add_argument("--keywords", "-k", type=str, default=None, help="分类关键词配置JSON文件（见 message_labels.py）")
+    PARSER.add_argument("--index-root", type=str, default=f"./{suffix_file}/commit_index", help="提交索引目录（commit_index.py）")
+    PARSER.add_argument("--project", type=str, default=suffix_repo, help="project 列的取值")
+    add_guard_arguments(PARSER)
+    PARSER.add_argument("--checkpoint", type=str, default=None, help="断点目录：保留已完成的提交块，中断后重新运行同一命令时只处理剩余的提交")
+    PARSER.add_argument("--trace", type=str, default=None, help="按提交记录耗时、diff时间、读取字节数和内存的目录（见 instrument.py）")
 
     ARGS = PARSER.parse_args()
+    if ARGS.trace:
+        instrument.enable(ARGS.trace, "001")
     REPOPATH = ARGS.repository
     BRANCH = ARGS.branch
     CSV_FILE_PATH = ARGS.csv_file
@@ -184,8 +177,10 @@ if __name__ == "__main__":
     commit_hashes = load_commit_hashes_from_csv(CSV_FILE_PATH)
 
     # 获取代码变更信息
-    churns = get_code_churns(REPOPATH, BRANCH, commit_hashes)
+    churns = get_code_churns(REPOPATH, BRANCH, commit_hashes, ARGS.processes, ARGS.chunk_size, ARGS.diffstat_root, ARGS.keywords,
+                             ARGS.index_root, ARGS.project, guard_from_args(ARGS), ARGS.checkpoint)
 
     # 保存变更数据
-    save_churns(churns)
+    save_churns(churns, ARGS.output)
+    churns.cleanup()
 
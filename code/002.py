@@ -1,14 +1,17 @@
-import csv
 import os
 import sys
-import time
 import pandas as pd
 
 from argparse import ArgumentParser
-from multiprocessing import Process, Manager, cpu_count
+from feature_io import TableWriter
+from functools import partial
+import instrument
 from numpy import log2
-from pygit2 import Repository, GIT_SORT_TOPOLOGICAL, GIT_SORT_REVERSE
-from tqdm import tqdm
+from columnar import FLOAT, STR
+from commit_index import open_commit_index
+from diffstat import (LARGE_COMMIT_SCHEMA, add_guard_arguments, commit_diff, effective_guard, find_diffstats, guard_enabled,
+                      guard_from_args, init_worker_store)
+from scheduler import run_stage
 
 # 全局后缀变量
 suffix_num = "1" 
@@ -16,9 +19,8 @@ suffix_repo = "z3"
 suffix_branch = "master"
 suffix_file = "z3_data" 
 
-# 初始化多进程管理器
-MANAGER = Manager()
-RES = MANAGER.dict()
+# 每行结果的列及其类型
+DIFFUSION_SCHEMA = [("commit_hash", STR), ("ns", FLOAT), ("nd", FLOAT), ("entropy", FLOAT), ("fileschanged", STR)]
 
 def count_diffing_subsystems(subsystems):
     """
@@ -40,127 +42,93 @@ def count_entropy(file_changes, total_change):
         for x in file_changes
     ])
 
-def parse_diffusion_features(pid, repo_path, branch, commit_hashes):
+def parse_diffusion_features(repo, commit):
     """
-    提取每个提交的扩散特征：ns、nd、entropy和fileschanged。
+    提取单个提交的扩散特征：ns、nd、entropy和fileschanged。
     """
-    repo = Repository(repo_path)
-    head = repo.references.get(branch)
-    commits = list(repo.walk(head.target, GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE))
+    # 相对第一个父提交（根提交与空树）修改的文件，优先从diff统计存储中读取
+    entries, large_commit = commit_diff(repo, commit)
+
+
+    # 初始化特征值
+    fileschanged = []  # 修改的文件路径
+    modules = set([])  # 修改的模块
+    subsystems_mapping = {}  # 存储子系统层次结构
+    entropy_change = 0  # 熵
+    file_changes = []  # 每个文件的修改行数
+    total_change = 0  # 总行数变化
+
+    for entry in entries:
+        if entry.binary:
+            continue  # 跳过二进制文件
+        total_change += (entry.additions + entry.deletions)
+        file_changes.append(entry.additions + entry.deletions)
+
+        # 获取被修改的文件路径
+        fpath = entry.path
+        fileschanged.append(fpath)
+
+        # 解析文件所属的子系统（路径的子目录）
+        subsystems = fpath.split('/')[:-1]
+        root = subsystems_mapping
+        for system in subsystems:
+            if system not in root:
+                root[system] = {}
+            root = root[system]
+        if subsystems:
+            modules.add(subsystems[0])  # 添加第一级目录作为模块
     
-    features = []
-    
-    for commit in tqdm(commits, position=pid):
-        if str(commit.id) not in commit_hashes:
-            continue  # 如果当前提交不在CSV中的commit_hash里，跳过
-
-        diff = repo.diff(commit.parents[0], commit) if commit.parents else repo.diff(None, commit)
-
-        patches = [p for p in diff]
-        
-        # 初始化特征值
-        fileschanged = []  # 修改的文件路径
-        modules = set([])  # 修改的模块
-        subsystems_mapping = {}  # 存储子系统层次结构
-        entropy_change = 0  # 熵
-        file_changes = []  # 每个文件的修改行数
-        total_change = 0  # 总行数变化
-
-        for patch in patches:
-            if patch.delta.is_binary:
-                continue  # 跳过二进制文件
-            _, addition, deletions = patch.line_stats
-            total_change += (addition + deletions)
-            file_changes.append(addition + deletions)
-
-            # 获取被修改的文件路径
-            fpath = patch.delta.new_file.path
-            fileschanged.append(fpath)
-
-            # 解析文件所属的子系统（路径的子目录）
-            subsystems = fpath.split('/')[:-1]
-            root = subsystems_mapping
-            for system in subsystems:
-                if system not in root:
-                    root[system] = {}
-                root = root[system]
-            if subsystems:
-                modules.add(subsystems[0])  # 添加第一级目录作为模块
-        
-        # 计算变更的子系统数量 ns
-        modified_systems = count_diffing_subsystems(subsystems_mapping)
-
-        # 计算变更的模块数量 nd
-        modified_modules = len(modules)
-
-        # 计算熵
-        entropy_change = count_entropy(file_changes, total_change)
-
-        # 添加到特征列表中
-        features.append([
-            str(commit.id),              # commit id
-            str(float(modified_systems)), # ns：变更子系统数量
-            str(float(modified_modules)), # nd：变更模块数量
-            str(float(entropy_change)),   # 熵
-            ','.join(fileschanged)        # fileschanged：修改的文件路径
-        ])
-
-    RES[pid] = features
-
-def get_diffusion_features(repo_path, branch, csv_file=f'./{suffix_file}/commit_id{suffix_num}.csv'):
+    # 计算变更的子系统数量 ns
+    modified_systems = count_diffing_subsystems(subsystems_mapping)
+
+    # 计算变更的模块数量 nd
+    modified_modules = len(modules)
+
+    # 计算熵
+    entropy_change = count_entropy(file_changes, total_change)
+
+    features = [
+        str(commit.id),              # commit id
+        float(modified_systems),      # ns：变更子系统数量
+        float(modified_modules),      # nd：变更模块数量
+        float(entropy_change),        # 熵
+        ','.join(fileschanged)        # fileschanged：修改的文件路径
+    ]
+    if guard_enabled():
+        features.append(large_commit)  # large_commit: 大提交的处理方式（见 diffstat.py）
+    return features
+
+def get_diffusion_features(repo_path, branch, csv_file=f'./{suffix_file}/commit_id{suffix_num}.csv', processes=None, chunk_size=8,
+                           diffstat_root=f"./{suffix_file}/diffstat", index_root=f"./{suffix_file}/commit_index", guard=None,
+                           checkpoint_dir=None):
     """
     从 CSV 文件获取 commit_hash，并提取扩散特征。
+    diffstat_root 下存在当前tip的diff统计（diffstat.py）时直接读取，不再重新diff；
+    guard 为大提交保护设置（见 diffstat.py），大提交的 entropy 由估计的行数计算，启用时输出 large_commit 列；
+    checkpoint_dir 为断点目录（见 scheduler.run_stage）。
     """
-    repo = Repository(repo_path)
+    index = open_commit_index(repo_path, branch, index_root)
 
     # 读取CSV文件，并提取commit_hash列
     df = pd.read_csv(csv_file)
     commit_hashes = set(df['commit_hash'].tolist())  # 从csv中提取commit_hash
 
-    # 获取提交并并行处理
-    cpus = cpu_count()
-    print(f"Using {cpus} CPUs...")
-    
-    processes = []
-    quote, remainder = divmod(len(commit_hashes), cpus)
-    
-    # 多进程处理提交
-    for i in range(cpus):
-        start = i * quote + min(i, remainder)
-        end = (i + 1) * quote + min(i + 1, remainder)
-        commit_batch = list(commit_hashes)[start:end]
-        
-        process = Process(
-            target=parse_diffusion_features,
-            args=(i, repo_path, branch, commit_batch)
-        )
-        processes.append(process)
-        process.start()
-
-    start_time = time.time()
-
-    for process in processes:
-        process.join()
-
-    end_time = time.time()
-    print(f"Overall processing time: {end_time - start_time}")
-
-    # 汇总各进程的结果
-    features = []
-    for _, feat in RES.items():
-        features.extend(feat)
+    store_path = find_diffstats(diffstat_root, index)
+    guard = effective_guard(guard, store_path)
+    schema = DIFFUSION_SCHEMA + LARGE_COMMIT_SCHEMA if guard.max_files else DIFFUSION_SCHEMA
+
+    # 按拓扑顺序把提交分成小块，由空闲进程按需领取
+    setup = partial(init_worker_store, store_path, index.path, guard)
+    features = run_stage(parse_diffusion_features, repo_path, index, index.select(commit_hashes), schema, processes, chunk_size, setup=setup,
+                         checkpoint_dir=checkpoint_dir)
 
     return features
 
 def save_diffusion_features(diffusion_features, path=f"./{suffix_file}/diffusion_features{suffix_num}.csv"):
     """
-    将扩散特征保存到CSV文件。
+    将扩散特征保存到CSV文件，path 以 .parquet 结尾时保存为 Parquet 文件。
     """
-    with open(path, 'w') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow([
-            "commit_hash", "ns", "nd", "entropy", "fileschanged"
-        ])
+    with TableWriter(path, [name for name, _ in diffusion_features.schema]) as writer:
         for row in diffusion_features:
             writer.writerow(row)
 
@@ -190,8 +158,55 @@ if __name__ == "__main__":
         default=f"./{suffix_file}/commit_id{suffix_num}.csv",
         help="Path to the CSV file containing commit_hash column."
     )
+    PARSER.add_argument(
+        "--processes",
+        "-p",
+        type=int,
+        default=None,
+        help="Number of worker processes, defaults to all CPUs."
+    )
+    PARSER.add_argument(
+        "--chunk-size",
+        type=int,
+        default=8,
+        help="Number of adjacent commits handed to a worker at a time."
+    )
+    PARSER.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        default=f"./{suffix_file}/diffusion_features{suffix_num}.csv",
+        help="The path where the output is written (.parquet for a typed Parquet file)."
+    )
+    PARSER.add_argument(
+        "--diffstat-root",
+        type=str,
+        default=f"./{suffix_file}/diffstat",
+        help="Directory of the per-commit diff stats written by diffstat.py."
+    )
+    PARSER.add_argument(
+        "--index-root",
+        type=str,
+        default=f"./{suffix_file}/commit_index",
+        help="Directory where commit indexes are stored."
+    )
+    PARSER.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Directory for per-commit timing and memory records, see instrument.py."
+    )
+    add_guard_arguments(PARSER)
+    PARSER.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+        help="Directory that keeps finished chunks, so that rerunning the same command after a crash only processes the rest."
+    )
 
     ARGS = PARSER.parse_args()
+    if ARGS.trace:
+        instrument.enable(ARGS.trace, "002")
     REPOPATH = ARGS.repository
     BRANCH = ARGS.branch
     CSV_FILE = ARGS.csv_file  # 获取CSV文件路径
@@ -200,6 +215,8 @@ if __name__ == "__main__":
         print("The repository path does not exist!")
         sys.exit(1)
 
-    DIFFUSION_FEATURES = get_diffusion_features(REPOPATH, BRANCH, CSV_FILE)
-    save_diffusion_features(DIFFUSION_FEATURES)
+    DIFFUSION_FEATURES = get_diffusion_features(REPOPATH, BRANCH, CSV_FILE, ARGS.processes, ARGS.chunk_size, ARGS.diffstat_root, ARGS.index_root,
+                                                 guard_from_args(ARGS), ARGS.checkpoint)
+    save_diffusion_features(DIFFUSION_FEATURES, ARGS.output)
+    DIFFUSION_FEATURES.cleanup()
 
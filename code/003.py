@@ -1,14 +1,19 @@
-import csv
 import json
 import sys
 import time
 import pygit2
 import pandas as pd
 from argparse import ArgumentParser
-from datetime import datetime
-from numpy import floor
-from pygit2 import Repository, GIT_SORT_TOPOLOGICAL, GIT_SORT_REVERSE
+from feature_io import TableWriter
+from pygit2 import Oid, Repository
 from tqdm import tqdm
+import instrument
+from commit_index import open_commit_index, report_misses
+import experience
+from diffstat import diff_stats
+from tree_files import DEFAULT_PATTERNS, tree_files
+from graph_store import (GraphStore, is_fast_forward, is_store_path, read_graph_checkpoint, read_graph_tip, walk_commits,
+                         write_graph_checkpoint)
 
 # 全局后缀变量
 suffix_num = "1" 
@@ -28,122 +33,187 @@ def set_to_list(obj):
         return str(obj)
     raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
 
-def get_files_in_tree(tree, repo):
-    files = set()
-    for entry in tree:
-        if entry.type == "blob":
-            blob = repo[entry.id]
-            if not blob.is_binary:
-                if entry.name.endswith("java"):
-                    files.add((str(entry.id), entry.name))
-        elif entry.type == "tree":
-            sub_tree = repo[entry.id]
-            sub_files = get_files_in_tree(repo[sub_tree], repo)
-            files.update(sub_files)
-    return files
-
 def get_diffing_files(commit, parent, repo):
-    diff = repo.diff(parent, commit)
-    patches = [p for p in diff]
+    stats = diff_stats(repo, commit, parent)
     files = set()
-    for patch in patches:
-        if patch.delta.is_binary:
+    for path, oid, status, binary in zip(stats['path'], stats['new_oid'], stats['status'], stats['binary']):
+        if binary:
             continue
-        nfile = patch.delta.new_file
-        files.add((str(nfile.id), nfile.path, patch.delta.status))
+        files.add((str(Oid(raw=oid)), path, status))
     return files
 
-def save_experience_features_graph(repo_path, branch, graph_path):
+def load_experience_state(graph_path):
+    """
+    读取增量更新所需的作者状态：二进制存储只读取每个作者的最后一次提交。
+    """
+    if is_store_path(graph_path):
+        store = GraphStore(graph_path)
+        all_authors = store.read_experience_tail()
+        store.close()
+        return all_authors
+    return load_experience_features_graph(graph_path)
+
+def committer_name(commit):
+    return commit.committer.name if commit.committer is not None else "Unknown"
+
+def move_experience_seed(repo, graph_path, all_authors, tip, head_commit, seed_patterns, tree_cache):
+    """
+    把增量更新前的图的初始提交从 tip 移到新的分支tip（见 experience.move_seed），
+    二进制存储先读入两个提交者的完整记录。
+    """
+    old_committer = committer_name(repo.get(tip))
+    new_committer = committer_name(head_commit)
+    if is_store_path(graph_path):
+        store = GraphStore(graph_path)
+        for author in {old_committer, new_committer}:
+            data = store.read_experience_author(author)
+            if data is not None:
+                all_authors[author] = data
+        store.close()
+    files = tree_files(repo, head_commit.tree, seed_patterns, tree_cache)
+    experience.move_seed(all_authors, tip, old_committer, str(head_commit.id), new_committer, head_commit.commit_time, len(files))
+
+def save_experience_features_graph(repo_path, branch, graph_path, checkpoint_every=0, seed_patterns=DEFAULT_PATTERNS,
+                                   tree_cache=f"./{suffix_file}/tree_files"):
+    """
+    checkpoint_every 不为 0 且图为二进制存储时，每处理这么多提交把当前状态写入存储并记录断点，
+    中断后重新运行时从断点继续。
+    完整建图时以分支tip中匹配 seed_patterns 的文件作为初始提交的文件集合（见 tree_files.py），
+    tree_cache 为与 004.py 共用的文件列表缓存目录，为 None 时不缓存。
+    增量更新时初始提交随 tip 移动，结果与在新 tip 上完整建图相同；无法移动时完整重建。
+    """
     repo = Repository(repo_path)
     head = repo.references.get(branch)
-    commits = list(repo.walk(head.target, GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE))
-    current_commit = repo.head.target
+    checkpoint = read_graph_checkpoint("experience", graph_path, str(head.target))
+    tip = read_graph_tip("experience", graph_path, seed_patterns)
+    incremental = tip is not None and is_fast_forward(repo, tip, head.target)
+    checkpoint_every = checkpoint_every if is_store_path(graph_path) else 0
+    start = 1
 
     start_time = time.time()
-    current_commit = repo.get(str(current_commit))
-    files = get_files_in_tree(current_commit.tree, repo)
+    if checkpoint is None and incremental:
+        all_authors = load_experience_state(graph_path)
+        if tip != str(head.target):
+            try:
+                move_experience_seed(repo, graph_path, all_authors, tip, repo.get(head.target), seed_patterns, tree_cache)
+            except ValueError as error:
+                print(f"Rebuilding graph: {error}")
+                incremental = False
 
-    all_authors = {}
-    if current_commit.committer is not None:
-        author = current_commit.committer.name
+    if checkpoint is not None:
+        # 上次构建在断点处中断：状态已在存储中，跳过已处理的提交
+        print(f"Resuming graph at commit {checkpoint['done']}")
+        base = checkpoint["base"]
+        all_authors = load_experience_state(graph_path)
+        commits = walk_commits(repo, head.target, base)
+        start = checkpoint["done"]
+    elif incremental:
+        # 只处理上次构建的tip之后的新提交，初始提交已移到新的tip
+        print(f"Updating graph from {tip} to {head.target}")
+        base = tip
+        commits = walk_commits(repo, head.target, base)
     else:
-        author = "Unknown"
-    all_authors[author] = {}
-    all_authors[author]['lastcommit'] = str(current_commit.id)
-    all_authors[author][str(current_commit.id)] = {}
-    all_authors[author][str(current_commit.id)]['prevcommit'] = ""
-    all_authors[author][str(current_commit.id)]["exp"] = 1
-    all_authors[author][str(current_commit.id)]["rexp"] = [[len(files), 1]]
-    all_authors[author][str(current_commit.id)]["sexp"] = {}
-
-    for i, commit in enumerate(tqdm(commits[1:])):
-        files = get_diffing_files(commit, commits[i], repo)
-        if commit.committer is not None:
-            author = commit.committer.name
-        else:
-            author = "Unknown"
-        commit_id_str = str(commit.id)
+        base = None
+        commits = walk_commits(repo, head.target)
+        current_commit = repo.get(head.target)
+        files = tree_files(repo, current_commit.tree, seed_patterns, tree_cache)
 
-        if author not in all_authors:
-            all_authors[author] = {}
-            all_authors[author]['lastcommit'] = commit_id_str
-            all_authors[author][commit_id_str] = {}
-            all_authors[author][commit_id_str]['prevcommit'] = ""
-            all_authors[author][commit_id_str]["exp"] = 1
-            all_authors[author][commit_id_str]["rexp"] = [[len(files), 1.0]]
-            all_authors[author][commit_id_str]["sexp"] = {}
-        else:
-            last_commit = str(all_authors[author]["lastcommit"])
-            all_authors[author]["lastcommit"] = commit_id_str
-            all_authors[author][commit_id_str] = {}
-            all_authors[author][commit_id_str]['prevcommit'] = last_commit
-            all_authors[author][commit_id_str]['exp'] = 1 + all_authors[author][last_commit]['exp']
+        all_authors = {}
+        author = committer_name(current_commit)
+        all_authors[author] = experience.new_author()
+        experience.add_commit(all_authors[author], str(current_commit.id), current_commit.commit_time, len(files))
 
-            date_current = datetime.fromtimestamp(commit.commit_time)
-            date_last = datetime.fromtimestamp(repo.get(last_commit).commit_time)
-            diffing_years = abs(floor(float((date_current - date_last).days) / 365))
+    # 存储中已经有本次构建的一部分时，之后只追加新增的内容
+    append = checkpoint is not None or incremental
+    for i, commit in enumerate(tqdm(commits[start:], initial=start - 1, total=len(commits) - 1), start):
+        instrument.begin_commit(str(commit.id), i)
+        files = get_diffing_files(commit, commits[i - 1], repo)
+        author = committer_name(commit)
+        if author not in all_authors:
+            all_authors[author] = experience.new_author()
+        experience.add_commit(all_authors[author], str(commit.id), commit.commit_time, len(files),
+                              experience.commit_subsystems(name for _, name, _ in files))
+        instrument.end_commit()
 
-            overall = all_authors[author][last_commit]['rexp']
-            all_authors[author][commit_id_str]['rexp'] = [[len(files), 1.0]] + [[e[0], e[1] + diffing_years] for e in overall]
+        if checkpoint_every and i % checkpoint_every == 0 and i + 1 < len(commits):
+            all_authors = write_graph_checkpoint("experience", graph_path, all_authors, append,
+                                                 {"target": str(head.target), "base": base, "done": i + 1})
+            append = True
 
-    with open(graph_path, 'w') as output:
-        json.dump(all_authors, output, default=set_to_list)
+    if is_store_path(graph_path):
+        store = GraphStore(graph_path)
+        if append:
+            store.append_experience(all_authors)
+        else:
+            store.write_experience(all_authors)
+        store.set_meta("experience_tip", str(head.target))
+        store.set_meta("experience_seed_files", list(seed_patterns))
+        store.set_meta("experience_checkpoint", None)
+        store.close()
+    else:
+        with open(graph_path, 'w') as output:
+            json.dump(experience.graph_to_json(all_authors, str(head.target), list(seed_patterns)), output, default=set_to_list)
 
     end_time = time.time()
     print("Done")
     print(f"Overall processing time {end_time - start_time}")
 
 
-def get_experience_features_for_commit_hashes(graph, repo_path, commit_hashes):
-    repo = Repository(repo_path)
-    features = []
-
-    for commit_hash in commit_hashes:
+def lookup_experiences(graph, keys):
+    """
+    批量查询 [(author, commit_id), ...] 的 (exp, rexp, sexp)，不存在的为 None。
+    """
+    if isinstance(graph, GraphStore):
+        return graph.lookup_experiences(keys)
+    results = []
+    for author, commit_id in keys:
         try:
-            commit = repo.get(commit_hash)
-            if commit.committer is not None:
-                author = commit.committer.name
-            else:
-                author = "Unknown"
-            commit_id_str = str(commit.id)
-
-            exp = graph[author][commit_id_str]['exp']
-            rexp = graph[author][commit_id_str]['rexp']
-            rrexp = sum([float(float(e[0]) / (float(e[1]) + 1)) for e in rexp])
-
-            commit_feat = [commit_id_str, str(float(exp)), str(float(rrexp)), str(float(0))]
-            features.append(commit_feat)
+            results.append(experience.lookup(graph[author], commit_id))
         except KeyError:
-            print(f"Commit {commit_hash} not found in the graph.")
-    
+            results.append(None)
+    return results
+
+
+def get_experience_features_for_commit_hashes(graph, repo_path, branch, commit_hashes, index_root=f"./{suffix_file}/commit_index"):
+    """
+    提交者由提交索引一次批量查出，不读取提交对象；exp/rexp/sexp 再从图中批量查询。
+    不在分支上或不在图中的提交被跳过，最后各汇总输出一次。
+    """
+    index = open_commit_index(repo_path, branch, index_root)
+    positions = index.positions(commit_hashes)
+    authors = index.committers(positions)
+
+    keys = []
+    not_in_index = []
+    for commit_hash, pos, author in zip(commit_hashes, positions, authors):
+        if pos < 0:
+            not_in_index.append(commit_hash)
+        else:
+            keys.append((author, index.hex(pos)))
+
+    features = []
+    not_in_graph = []
+    for (author, commit_id), result in zip(keys, lookup_experiences(graph, keys)):
+        if result is None:
+            not_in_graph.append(commit_id)
+            continue
+        exp, rrexp, sexp = result
+        features.append([commit_id, str(float(exp)), str(float(rrexp)), str(float(sexp))])
+
+    report_misses(not_in_index, f"not found on {branch}")
+    report_misses(not_in_graph, "not found in the graph (rebuild it with -sg)")
     return features
 
 
-def load_experience_features_graph(path=f"./{suffix_file}/author_graph.json"):
+def load_experience_features_graph(path=f"./{suffix_file}/author_graph.db"):
+    if is_store_path(path):
+        # 二进制存储按需查询，不整体加载
+        return GraphStore(path)
+
     file_graph = {}
     with open(path, 'r') as inp:
         file_graph = json.load(inp, parse_float=lambda x: float(x))
-    return file_graph
+    return experience.graph_from_json(file_graph)
 
 def get_commit_hashes(csv_path):
     df = pd.read_csv(csv_path)
@@ -152,9 +222,7 @@ def get_commit_hashes(csv_path):
 
 
 def save_experience_features(history_features, path):
-    with open(path, 'w') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(["commit_hash", "exp", "rexp", "sexp"])
+    with TableWriter(path, ["commit_hash", "exp", "rexp", "sexp"]) as writer:
         for row in history_features:
             if row:
                 writer.writerow([row[0], row[1], row[2], row[3]])
@@ -186,8 +254,8 @@ if __name__ == "__main__":
         "--graph-path",
         "-gp",
         type=str,
-        default=f"./{suffix_file}/author_graph.json",
-        help="The path to where the graph is stored."
+        default=f"./{suffix_file}/author_graph.db",
+        help="The path to where the graph is stored (.db/.sqlite for the binary store, otherwise JSON)."
     )
     PARSER.add_argument(
         "--output",
@@ -203,8 +271,40 @@ if __name__ == "__main__":
         default=f"./{suffix_file}/commit_id{suffix_num}.csv",
         help="Path to the commit_id.csv file."
     )
+    PARSER.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=10000,
+        help="When saving a binary graph store, persist the graph every this many commits so that an interrupted build resumes there (0 disables)."
+    )
+    PARSER.add_argument(
+        "--seed-files",
+        nargs='+',
+        default=DEFAULT_PATTERNS,
+        help="Extensions or glob patterns of the files that seed a new graph (matched against tree entries only)."
+    )
+    PARSER.add_argument(
+        "--tree-cache",
+        type=str,
+        default=f"./{suffix_file}/tree_files",
+        help="Directory caching the seed file lists, shared with 004.py."
+    )
+    PARSER.add_argument(
+        "--index-root",
+        type=str,
+        default=f"./{suffix_file}/commit_index",
+        help="Directory of the commit index (commit_index.py), used to look up the committers."
+    )
+    PARSER.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Directory for per-commit timing and memory records, see instrument.py."
+    )
 
     ARGS = PARSER.parse_args()
+    if ARGS.trace:
+        instrument.enable(ARGS.trace, "003")
     REPO_PATH = ARGS.repository
     BRANCH = ARGS.branch
     SAVE_GRAPH = ARGS.save_graph
@@ -213,10 +313,10 @@ if __name__ == "__main__":
     COMMIT_ID_CSV_PATH = ARGS.commit_id_csv
 
     if SAVE_GRAPH:
-        save_experience_features_graph(REPO_PATH, BRANCH, GRAPH_PATH)
+        save_experience_features_graph(REPO_PATH, BRANCH, GRAPH_PATH, ARGS.checkpoint_every, ARGS.seed_files, ARGS.tree_cache)
     
     GRAPH = load_experience_features_graph(GRAPH_PATH)
     COMMIT_HASHES = get_commit_hashes(COMMIT_ID_CSV_PATH)
-    EXPERIENCE_FEATURES = get_experience_features_for_commit_hashes(GRAPH, REPO_PATH, COMMIT_HASHES)
+    EXPERIENCE_FEATURES = get_experience_features_for_commit_hashes(GRAPH, REPO_PATH, BRANCH, COMMIT_HASHES, ARGS.index_root)
     save_experience_features(EXPERIENCE_FEATURES, OUTPUT)
 
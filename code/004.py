@@ -1,9 +1,18 @@
-import csv
 import json
+import sys
 import time
 from argparse import ArgumentParser
-from pygit2 import Repository, GIT_SORT_TOPOLOGICAL, GIT_SORT_REVERSE
+from feature_io import TableWriter
+from pygit2 import Oid, Repository
+from commit_index import open_commit_index, report_misses
+from diffstat import diff_stats, open_diffstats
 from tqdm import tqdm
+import instrument
+import history
+from tree_files import DEFAULT_PATTERNS, tree_files
+from graph_store import (GraphStore, is_fast_forward, is_store_path, read_graph_checkpoint, read_graph_tip, walk_commits,
+                         write_graph_checkpoint)
+import numpy as np
 import pandas as pd
 
 
@@ -22,168 +31,259 @@ def set_to_list(obj):
     raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
 
 
-def get_files_in_tree(tree, repo):
+def get_diffing_files(commit, parent, repo, diffstats=None):
     """
-    Extract the hex of all files and their name.
+    Get the files that diffed between two commits. When parent is the first
+    parent of commit and the diff-stat store has the commit, the stored
+    entries are used instead of diffing again.
     """
+    if diffstats is not None and commit.parent_ids and commit.parent_ids[0] == parent.id:
+        pos = diffstats.position(str(commit.id))
+        if 0 <= pos < len(diffstats):
+            return set((Oid(raw=e.new_oid), e.path, e.status) for e in diffstats.entries(pos) if not e.binary)
+
+    stats = diff_stats(repo, commit, parent)
     files = set()
-    for entry in tree:
-        if entry.type == "tree":
-            sub_files = [(f[0], "{}/{}".format(entry.name, f[1]))
-                         for f in get_files_in_tree(repo[entry.id], repo)]
-            files.update(sub_files)
-        else:
-            blob = repo[entry.id]
-            if blob.type == "blob":  # Check if it's a blob (file)
-                if entry.name.endswith(".java"):  # Adjust file extension if needed
-                    files.add((blob.id, entry.name))
+
+    for path, oid, status, binary in zip(stats['path'], stats['new_oid'], stats['status'], stats['binary']):
+        if binary:
+            continue
+        files.add((Oid(raw=oid), path, status))
+
     return files
 
 
-def get_diffing_files(commit, parent, repo):
+def load_history_state(graph_path):
     """
-    Get the files that diffed between two commits.
+    Load the state needed to continue a graph. For the binary store only the
+    latest revision of every file is read.
     """
-    diff = repo.diff(parent, commit)
-    patches = [p for p in diff]
-    files = set()
+    if is_store_path(graph_path):
+        store = GraphStore(graph_path)
+        graph = store.read_history_tail()
+        store.close()
+        return graph
+    return load_history_features_graph(graph_path)
 
-    for patch in patches:
-        if patch.delta.is_binary:
-            continue
-        nfile = patch.delta.new_file
-        files.add((nfile.id, nfile.path, patch.delta.status))
 
-    return files
+def move_history_seed(repo, graph_path, graph, index, tip, head_commit, seed_patterns, tree_cache):
+    """
+    Move the seed of a graph built at tip to the new branch tip, see
+    history.move_seed. For the binary store all revisions of the files seeded
+    at either tip are loaded first.
+    """
+    old_seed = [name for _, name in tree_files(repo, repo.get(tip).tree, seed_patterns, tree_cache)]
+    new_seed = [name for _, name in tree_files(repo, head_commit.tree, seed_patterns, tree_cache)]
+    if is_store_path(graph_path):
+        store = GraphStore(graph_path)
+        store.read_history_files(graph, set(old_seed) | set(new_seed))
+        store.close()
+    history.move_seed(graph, index, tip, old_seed, str(head_commit.id), new_seed)
 
 
-def save_history_features_graph(repo_path, branch, graph_path):
+def save_history_features_graph(repo_path, branch, graph_path, diffstat_root=f"./{suffix_file}/diffstat", index_root=f"./{suffix_file}/commit_index",
+                                checkpoint_every=0, seed_patterns=DEFAULT_PATTERNS, tree_cache=f"./{suffix_file}/tree_files"):
     """
     Track the number of developers that have worked in a repository and save the
-    results in a graph which could be used for later use.
+    results in a graph which could be used for later use. If the saved graph was
+    built at an ancestor of the current branch tip only the new commits are
+    processed, otherwise the graph is rebuilt from scratch.
+    With a binary store and checkpoint_every set, the graph is persisted every
+    checkpoint_every commits and an interrupted build resumes from there.
+    A new graph is seeded with the files of the branch tip matching
+    seed_patterns (see tree_files.py); the list is cached in tree_cache and
+    shared with 003.py. On an incremental update the seed moves to the new
+    tip, so the graph matches a full build there; if it cannot be moved the
+    graph is rebuilt.
     """
     repo = Repository(repo_path)
     head = repo.references.get(branch)
-
-    commits = list(repo.walk(head.target, GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE))
-    current_commit = repo.head.target
-
-    all_files = {}
-    current_commit = repo.get(str(current_commit))
-    files = get_files_in_tree(current_commit.tree, repo)
-
-    for (_, name) in tqdm(files):
-        all_files[name] = {}
-        all_files[name]['lastcommit'] = str(current_commit.id)
-        all_files[name][str(current_commit.id)] = {}
-        all_files[name][str(current_commit.id)]['prevcommit'] = ""
-        all_files[name][str(current_commit.id)]['authors'] = [current_commit.committer.name]
-
-    for i, commit in enumerate(tqdm(commits[1:])):
-        files = get_diffing_files(commit, commits[i], repo)
+    index = open_commit_index(repo_path, branch, index_root)
+    diffstats = open_diffstats(diffstat_root, index)
+    checkpoint = read_graph_checkpoint("history", graph_path, str(head.target))
+    tip = read_graph_tip("history", graph_path, seed_patterns)
+    incremental = tip is not None and is_fast_forward(repo, tip, head.target)
+    checkpoint_every = checkpoint_every if is_store_path(graph_path) else 0
+    start = 1
+
+    if checkpoint is None and incremental:
+        graph = load_history_state(graph_path)
+        if tip != str(head.target):
+            try:
+                move_history_seed(repo, graph_path, graph, index, tip, repo.get(head.target), seed_patterns, tree_cache)
+            except ValueError as error:
+                print(f"Rebuilding graph: {error}")
+                incremental = False
+
+    if checkpoint is not None:
+        # The last build stopped at a checkpoint, its state is already stored
+        print(f"Resuming graph at commit {checkpoint['done']}")
+        base = checkpoint["base"]
+        graph = load_history_state(graph_path)
+        all_files = graph['files']
+        commits = walk_commits(repo, head.target, base)
+        start = checkpoint["done"]
+    elif incremental:
+        print(f"Updating graph from {tip} to {head.target}")
+        base = tip
+        all_files = graph['files']
+        commits = walk_commits(repo, head.target, base)
+    else:
+        base = None
+        commits = walk_commits(repo, head.target)
+        graph = history.new_history_graph()
+        all_files = graph['files']
+        current_commit = repo.get(head.target)
+        files = tree_files(repo, current_commit.tree, seed_patterns, tree_cache)
+
+        commit_id = sys.intern(str(current_commit.id))
+        authorset_id = history.add_author_to_set(graph, 0, history.intern_author(graph, current_commit.committer.name))
+        for (_, name) in tqdm(files):
+            all_files[name] = {}
+            all_files[name]['lastcommit'] = commit_id
+            all_files[name][commit_id] = ["", authorset_id]
+
+    # Once part of this build is stored only the new parts are appended
+    append = checkpoint is not None or incremental
+    for i, commit in enumerate(tqdm(commits[start:], initial=start - 1, total=len(commits) - 1), start):
+        instrument.begin_commit(str(commit.id), i)
+        files = get_diffing_files(commit, commits[i - 1], repo, diffstats)
+        commit_id = sys.intern(str(commit.id))
+        author_id = history.intern_author(graph, commit.committer.name)
         for (_, name, _) in files:
             if name not in all_files:
                 all_files[name] = {}
 
-            last_commit = ""
-            if 'lastcommit' not in all_files[name]:
-                all_files[name]['lastcommit'] = str(commit.id)
-            else:
-                last_commit = all_files[name]['lastcommit']
-
-            all_files[name][str(commit.id)] = {}
-            all_files[name][str(commit.id)]['prevcommit'] = last_commit
+            last_commit = all_files[name].get('lastcommit', "")
+            authorset_id = all_files[name][last_commit][1] if last_commit else 0
 
-            authors = set([commit.committer.name])
-            
+            all_files[name][commit_id] = [last_commit, history.add_author_to_set(graph, authorset_id, author_id)]
+            all_files[name]['lastcommit'] = commit_id
+        instrument.end_commit()
 
-            if last_commit:
-            # 检查 'authors' 键是否存在
-                if 'authors' in all_files[name][last_commit]:
-                    authors.update(all_files[name][last_commit]['authors'])
-                else:
-                    all_files[name][last_commit]['authors'] = set()
-                    authors.update(all_files[name][last_commit]['authors'])
-            all_files[name][str(commit.id)]['authors'] = authors
+        if checkpoint_every and i % checkpoint_every == 0 and i + 1 < len(commits):
+            graph = write_graph_checkpoint("history", graph_path, graph, append,
+                                           {"target": str(head.target), "base": base, "done": i + 1})
+            all_files = graph['files']
+            append = True
 
-            all_files[name]['lastcommit'] = str(commit.id)
-
-    with open(graph_path, 'w') as output:
-        json.dump(all_files, output, default=set_to_list)
+    if is_store_path(graph_path):
+        store = GraphStore(graph_path)
+        if append:
+            store.append_history(graph)
+        else:
+            store.write_history(graph)
+        store.set_meta("history_tip", str(head.target))
+        store.set_meta("history_seed_files", list(seed_patterns))
+        store.set_meta("history_checkpoint", None)
+        store.close()
+    else:
+        with open(graph_path, 'w') as output:
+            json.dump(history.to_json(graph, str(head.target), list(seed_patterns)), output, default=set_to_list)
 
 
 def load_history_features_graph(path):
     """
-    Load the history features from a JSON file.
+    Load the history features from a JSON file. The binary store is opened
+    instead and queried lazily.
     """
+    if is_store_path(path):
+        return GraphStore(path)
+
     file_graph = {}
     with open(path, 'r') as inp:
         file_graph = json.load(inp)
-    return file_graph
+    return history.from_json(file_graph)
+
+
+def lookup_revision(graph, name, commit_hash):
+    if isinstance(graph, GraphStore):
+        return graph.lookup_revision(name, commit_hash)
+    return history.lookup(graph, name, commit_hash)
 
 
-def get_history_features_for_commits(graph, repo_path, branch, commit_hashes):
+def changed_paths(index, pos, diffstats, repo):
+    """
+    Paths of the non-binary files a commit changed relative to its first
+    parent, read from the diff-stat store. Without a store the commit is
+    diffed, which is the only case that reads the object database.
+    """
+    if diffstats is not None:
+        return diffstats.changed_paths(pos)
+    commit = repo[index.hex(pos)]
+    return [name for (_, name, _) in get_diffing_files(commit, commit.parents[0], repo)]
+
+
+def get_history_features_for_commits(graph, repo_path, branch, commit_hashes, diffstat_root=f"./{suffix_file}/diffstat",
+                                     index_root=f"./{suffix_file}/commit_index"):
     """
     Function that extracts the history features for specified commit hashes.
     They are the total number of authors, the total age, and the total
     number of unique changes.
+    Commit times and parents come from the commit index and the changed files
+    from the diff-stat store, so no commit object is loaded. Commits that are
+    not on the branch are skipped and reported once at the end.
     """
-    repo = Repository(repo_path)
-    head = repo.references.get(branch)
-
-    commits = list(repo.walk(head.target, GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE))
-    commit_map = {str(commit.id): commit for commit in commits}
-
+    index = open_commit_index(repo_path, branch, index_root)
+    positions = index.positions(commit_hashes)
+    diffstats = open_diffstats(diffstat_root, index)
+    repo = None
+    if diffstats is None:
+        print(f"No diff stats for {index.tip} in {diffstat_root}, diffing every commit (run diffstat.py first to avoid this)")
+        repo = Repository(repo_path)
+    commit_time = np.asarray(index.commit_time)
+    parent_offsets = np.asarray(index.parent_offsets)
     features = []
+    not_in_index = []
+    unknown_prev = 0
 
-    for commit_hash in tqdm(commit_hashes):
-        if commit_hash not in commit_map:
-            print(f"Commit {commit_hash} not found in the repository.")
+    for commit_hash, pos in zip(tqdm(commit_hashes), positions):
+        if pos < 0:
+            not_in_index.append(commit_hash)
             continue
 
-        commit = commit_map[commit_hash]
-        parent = commit.parents[0] if commit.parents else None
-
-        if not parent:
+        if parent_offsets[pos] == parent_offsets[pos + 1]:
             # If no parent, it's the initial commit
             features.append([commit_hash, 1.0, 0.0, 0.0])
             continue
 
-        files = get_diffing_files(commit, parent, repo)
-
-        total_number_of_authors = set()
-        total_age = []
-        total_unique_changes = set()
+        total_number_of_authors = 0
+        prev_commits = []
 
-        for (_, name, _) in files:
-            if name not in graph or commit_hash not in graph[name]:
+        for name in changed_paths(index, pos, diffstats, repo):
+            revision = lookup_revision(graph, name, commit_hash)
+            if revision is None:
                 continue
 
-            sub_graph = graph[name][commit_hash]
-            total_number_of_authors.update(sub_graph['authors'])
-
-            prev_commit = sub_graph['prevcommit']
+            prev_commit, authors = revision
+            total_number_of_authors |= authors
             if prev_commit:
-                total_unique_changes.add(prev_commit)
-
-                prev_commit_obj = repo.get(prev_commit)
-                total_age.append(commit.commit_time - prev_commit_obj.commit_time)
-
-        total_age = float(sum(total_age)) / len(total_age) if total_age else 0
-
-        commit_feat = [commit_hash, float(len(total_number_of_authors)), float(total_age), float(len(total_unique_changes))]
+                prev_commits.append(prev_commit)
+
+        # The age of every touched file is the time since its previous change
+        total_age = 0
+        if prev_commits:
+            prev_positions = index.positions(prev_commits)
+            found = prev_positions >= 0
+            unknown_prev += int(np.count_nonzero(~found))
+            ages = commit_time[pos] - commit_time[prev_positions[found]]
+            total_age = float(ages.sum()) / len(ages) if len(ages) else 0
+
+        commit_feat = [commit_hash, float(history.count_authors(total_number_of_authors)), float(total_age), float(len(set(prev_commits)))]
         features.append(commit_feat)
 
+    report_misses(not_in_index, f"not found on {branch}")
+    if unknown_prev:
+        print(f"{unknown_prev} previous revisions are not on {branch} and were left out of age (rebuild the graph with -sg)")
     return features
 
 
 def save_history_features(history_features, path):
     """
-    Function to save the history features as a CSV file.
+    Function to save the history features as a CSV file, or as a Parquet
+    file when path ends with .parquet.
     """
-    with open(path, 'w') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(["commit_hash", "ndev", "age", "nuc"])
+    with TableWriter(path, ["commit_hash", "ndev", "age", "nuc"]) as writer:
         for row in history_features:
             if row:
                 writer.writerow([row[0], row[1], row[2], row[3]])
@@ -216,8 +316,8 @@ if __name__ == "__main__":
         "--graph-path",
         "-gp",
         type=str,
-        default=f"./{suffix_file}/file_graph.json",
-        help="The path to where the graph is stored."
+        default=f"./{suffix_file}/file_graph.db",
+        help="The path to where the graph is stored (.db/.sqlite for the binary store, otherwise JSON)."
     )
     PARSER.add_argument(
         "--output",
@@ -233,8 +333,46 @@ if __name__ == "__main__":
         default=f"./{suffix_file}/commit_id{suffix_num}.csv",
         help="Path to the commit_id.csv file."
     )
+    PARSER.add_argument(
+        "--diffstat-root",
+        type=str,
+        default=f"./{suffix_file}/diffstat",
+        help="Directory of the per-commit diff stats written by diffstat.py."
+    )
+    PARSER.add_argument(
+        "--index-root",
+        type=str,
+        default=f"./{suffix_file}/commit_index",
+        help="Directory where commit indexes are stored."
+    )
+    PARSER.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=10000,
+        help="When saving a binary graph store, persist the graph every this many commits so that an interrupted build resumes there (0 disables)."
+    )
+    PARSER.add_argument(
+        "--seed-files",
+        nargs='+',
+        default=DEFAULT_PATTERNS,
+        help="Extensions or glob patterns of the files that seed a new graph (matched against tree entries only)."
+    )
+    PARSER.add_argument(
+        "--tree-cache",
+        type=str,
+        default=f"./{suffix_file}/tree_files",
+        help="Directory caching the seed file lists, shared with 003.py."
+    )
+    PARSER.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Directory for per-commit timing and memory records, see instrument.py."
+    )
 
     ARGS = PARSER.parse_args()
+    if ARGS.trace:
+        instrument.enable(ARGS.trace, "004")
     REPO_PATH = ARGS.repository
     BRANCH = ARGS.branch
     SAVE_GRAPH = ARGS.save_graph
@@ -243,7 +381,8 @@ if __name__ == "__main__":
     OUTPUT = ARGS.output
 
     if SAVE_GRAPH:
-        save_history_features_graph(REPO_PATH, BRANCH, GRAPH_PATH)
+        save_history_features_graph(REPO_PATH, BRANCH, GRAPH_PATH, ARGS.diffstat_root, ARGS.index_root, ARGS.checkpoint_every,
+                                    ARGS.seed_files, ARGS.tree_cache)
 
     # Load commit hashes from CSV file
     commit_data = pd.read_csv(COMMIT_FILE)
@@ -253,7 +392,7 @@ if __name__ == "__main__":
     GRAPH = load_history_features_graph(GRAPH_PATH)
 
     # Extract features for the specified commit hashes
-    HISTORY_FEATURES = get_history_features_for_commits(GRAPH, REPO_PATH, BRANCH, commit_hashes)
+    HISTORY_FEATURES = get_history_features_for_commits(GRAPH, REPO_PATH, BRANCH, commit_hashes, ARGS.diffstat_root, ARGS.index_root)
 
     # Save the history features to a CSV file
     save_history_features(HISTORY_FEATURES, OUTPUT)
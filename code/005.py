@@ -1,8 +1,11 @@
 import csv
-import re
+import os
+import sys
 from argparse import ArgumentParser
-from tqdm import tqdm
-from pygit2 import Repository, GIT_SORT_TOPOLOGICAL, GIT_SORT_REVERSE
+from feature_io import TableWriter, iter_rows
+from pygit2 import Repository
+from commit_index import open_commit_index, report_misses
+from message_labels import DEFAULT_LABELER, MessageLabeler, load_keywords
 
 # 全局后缀变量
 suffix_num = "1" 
@@ -10,9 +13,6 @@ suffix_repo = "z3"
 suffix_branch = "master"
 suffix_file = "z3_data"
 
-# Patterns to search for in commit messages to identify "fix" commits
-PATTERNS = [r"bug", r"fix", r"defect", r"patch"]
-
 def load_commit_hashes_from_csv(csv_file_path):
     """
     从CSV文件中加载commit_hash列。
@@ -26,44 +26,75 @@ def load_commit_hashes_from_csv(csv_file_path):
 
 def is_fix(message):
     """
-    Check if a message contains any of the fix patterns.
+    Check if a message contains any of the fix patterns
+    (see DEFAULT_KEYWORDS["fix"] in message_labels.py).
     """
-    for pattern in PATTERNS:
-        if re.search(pattern, message, re.IGNORECASE):  # 忽略大小写
-            return True
-    return False
+    return DEFAULT_LABELER.is_fix(message)
 
-def get_purpose_features(repo_path, branch, commit_hashes):
+def load_messages_from_csv(csv_file_path, commit_hashes):
     """
-    Extract the purpose features for each commit, but only process commits
-    that are listed in commit_hashes.
+    从包含 commit_message 列的CSV或Parquet文件（例如 001.py 输出的 code_churns）中读取提交信息，
+    只读取 commit_hash 和 commit_message 两列。
+    """
+    hashes = []
+    messages = []
+    for commit_hash, message in iter_rows(csv_file_path, ["commit_hash", "commit_message"]):
+        if commit_hash in commit_hashes:
+            hashes.append(commit_hash)
+            messages.append(message)
+    return hashes, messages
+
+def load_messages_from_repo(repo_path, branch, commit_hashes, index_root=f"./{suffix_file}/commit_index"):
+    """
+    通过提交索引直接定位 commit_hashes 中的提交，按拓扑顺序读取提交信息；
+    不在分支上的提交汇总输出一行。
     """
     repo = Repository(repo_path)
-    head = repo.references.get(branch)
-
-    # 获取所有提交
-    commits = list(repo.walk(head.target, GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE))
-
-    features = []
-    for _, commit in enumerate(tqdm(commits)):
-        # 只处理在 commit_hashes 中指定的提交
-        if str(commit.id) in commit_hashes:  # 修改为 commit.id
-            message = commit.message
-
-            # 检查提交信息中是否有修复相关的关键词
-            fix = 1.0 if is_fix(message) else 0.0
-
-            feat = [str(commit.id), str(fix)]
-            features.append(feat)
-    return features
+    index = open_commit_index(repo_path, branch, index_root)
+    positions = index.select(commit_hashes)
+    hashes = index.hexes(positions)
+    messages = [repo[commit_hash].message for commit_hash in hashes]
+    found = set(hashes)
+    report_misses(sorted(h for h in commit_hashes if h not in found), f"not found on {branch}")
+    return hashes, messages
+
+def get_purpose_features(repo_path, branch, commit_hashes, messages_csv=None, labeler=DEFAULT_LABELER,
+                         index_root=f"./{suffix_file}/commit_index"):
+    """
+    Extract the purpose features for each commit, but only process commits
+    that are listed in commit_hashes. When messages_csv already holds the
+    commit messages the repository is only opened for the commits missing from it.
+    The output is in topological order either way.
+    """
+    if messages_csv and os.path.exists(messages_csv):
+        hashes, messages = load_messages_from_csv(messages_csv, commit_hashes)
+        found = set(hashes)
+        missing = [commit_hash for commit_hash in commit_hashes if commit_hash not in found]
+        if missing:
+            report_misses(missing, f"not found in {messages_csv}, reading them from the repository")
+            missing_hashes, missing_messages = load_messages_from_repo(repo_path, branch, missing, index_root)
+            hashes += missing_hashes
+            messages += missing_messages
+
+        # 补读的提交追加在末尾，按拓扑位置重新排序；不在分支上的提交排在最后
+        index = open_commit_index(repo_path, branch, index_root)
+        positions = index.positions(hashes)
+        positions[positions < 0] = len(index)
+        order = sorted(range(len(hashes)), key=positions.__getitem__)
+        hashes = [hashes[i] for i in order]
+        messages = [messages[i] for i in order]
+    else:
+        hashes, messages = load_messages_from_repo(repo_path, branch, commit_hashes, index_root)
+
+    # 所有提交信息一次性批量匹配
+    _, fixes = labeler.label_messages(messages)
+    return [[commit_hash, str(fix)] for commit_hash, fix in zip(hashes, fixes)]
 
 def save_features(purpose_features, path=f"./{suffix_file}/fix_features{suffix_num}.csv"):
     """
-    Save the purpose features to a csv file.
+    Save the purpose features to a csv file (a Parquet file when path ends with .parquet).
     """
-    with open(path, 'w') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(["commit_hash", "fix"])
+    with TableWriter(path, ["commit_hash", "fix"]) as writer:
         for row in purpose_features:
             if row:
                 writer.writerow([row[0], row[1]])
@@ -90,6 +121,27 @@ if __name__ == "__main__":
         type=str,
         default=f"./{suffix_file}/commit_id{suffix_num}.csv",
         help="Path to CSV file containing commit hashes.")
+    PARSER.add_argument(
+        "--messages-csv", "-m",
+        type=str,
+        default=f"./{suffix_file}/code_churns{suffix_num}.csv",
+        help="CSV file with commit_hash and commit_message columns (e.g. the output of 001.py). "
+             "When it exists the repository is only read for commits missing from it.")
+    PARSER.add_argument(
+        "--output", "-o",
+        type=str,
+        default=f"./{suffix_file}/fix_features{suffix_num}.csv",
+        help="The path where the output is written (.parquet for a typed Parquet file).")
+    PARSER.add_argument(
+        "--keywords", "-k",
+        type=str,
+        default=None,
+        help="Keyword configuration JSON, see message_labels.py.")
+    PARSER.add_argument(
+        "--index-root",
+        type=str,
+        default=f"./{suffix_file}/commit_index",
+        help="Directory where commit indexes are stored.")
 
     ARGS = PARSER.parse_args()
     REPOPATH = ARGS.repository
@@ -104,8 +156,9 @@ if __name__ == "__main__":
     commit_hashes = load_commit_hashes_from_csv(CSV_FILE_PATH)
 
     # 获取提交的特征信息
-    FEATURES = get_purpose_features(REPOPATH, BRANCH, commit_hashes)
+    FEATURES = get_purpose_features(REPOPATH, BRANCH, commit_hashes, ARGS.messages_csv, MessageLabeler(load_keywords(ARGS.keywords)),
+                                    ARGS.index_root)
 
     # 保存特征信息
-    save_features(FEATURES)
+    save_features(FEATURES, ARGS.output)
 
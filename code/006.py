@@ -1,12 +1,19 @@
 import csv
 import os
 import sys
-import time
 
 from argparse import ArgumentParser
-from multiprocessing import Process, Manager, cpu_count
-from pygit2 import Repository, GIT_SORT_REVERSE, GIT_SORT_TOPOLOGICAL
-from tqdm import tqdm
+from feature_io import TableWriter
+from functools import partial
+import instrument
+from columnar import INT, STR
+from commit_index import open_commit_index
+import diffstat
+from diffstat import (LARGE_COMMIT_SCHEMA, LARGE_NONE, add_guard_arguments, commit_diff, effective_guard, find_diffstats, guard_from_args,
+                      guarded_sum, init_worker_store)
+from loc_cache import LocCache, count_lines
+from pygit2 import Oid
+from scheduler import register_chunk_hook, run_stage
 
 # 全局后缀变量
 suffix_num = "1" 
@@ -14,9 +21,22 @@ suffix_repo = "z3"
 suffix_branch = "master"
 suffix_file = "z3_data"
 
-# Global variables
-MANAGER = Manager()
-RES = MANAGER.dict()
+# 每行结果的列及其类型
+LT_SCHEMA = [("commit_hash", STR), ("lt", INT)]
+
+# 工作进程内的行数缓存，由 init_worker 打开
+LOC_CACHE = None
+
+def init_worker(loc_cache, diffstat_path, index_path, guard=None):
+    """
+    在工作进程启动时打开diff统计存储和共享的行数缓存，
+    行数缓存每处理完一块提交写回一次；guard 为大提交保护设置。
+    """
+    global LOC_CACHE
+    init_worker_store(diffstat_path, index_path, guard)
+    if loc_cache:
+        LOC_CACHE = LocCache(loc_cache)
+        register_chunk_hook(LOC_CACHE.flush)
 
 def load_commit_hashes_from_csv(csv_file_path):
     """
@@ -29,106 +49,96 @@ def load_commit_hashes_from_csv(csv_file_path):
             commit_hashes.add(row['commit_hash'])  # 假设列名为'commit_hash'
     return commit_hashes
 
-def parse_code_churns(pid, repo_path, branch, commit_hashes):
+def parse_code_churn(repo, commit):
     """
-    Function that is intended to be runned by a process. It extracts the code churns
-    for a set of commits and stores them in the RES dict.
+    Function that is intended to be called by the scheduler in a worker process.
+    It extracts the lt feature of a single commit.
     """
-    repo = Repository(repo_path)
-    head = repo.references.get(branch)
-    commits = list(repo.walk(head.target, GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE))
-
-    # 只处理在 commit_hashes 中指定的提交
-    commits = [commit for commit in commits if str(commit.id) in commit_hashes]
-
-    code_churns = [[] for _ in range(len(commits))]
-    for i, commit in enumerate(tqdm(commits, position=pid)):
-        if commit.parents:
-            diff = repo.diff(commit.parents[0], commit)
-        else:
-            diff = repo.diff(None, commit)
-
-        patches = [p for p in diff]
-
-        # 计算 line_of_code_old，即修改前版本的代码总行数
+    guard = diffstat.GUARD
+    if not commit.parents:
+        # 根提交没有修改前的版本
+        return [str(commit.id), 0] + ([LARGE_NONE] if guard.max_files else [])
+
+    # 相对第一个父提交修改的文件，优先从diff统计存储中读取
+    entries, large_commit = commit_diff(repo, commit)
+    entries = [entry for entry in entries if not entry.binary]  # 跳过二进制文件
+
+    # 计算 line_of_code_old，即修改前版本的代码总行数
+    if guard.max_files and len(entries) > guard.max_files:
+        # 只读取一部分修改前的文件，按比例估计总行数
+        line_of_code_old, flag = guarded_sum(len(entries), guard, lambda i: get_file_lines_of_code(repo, entries[i].old_oid))
+        large_commit = max(large_commit, flag)
+    else:
         line_of_code_old = 0
-        for patch in patches:
-            if patch.delta.is_binary:  # 跳过二进制文件
-                continue
-            old_file = patch.delta.old_file  # 获取旧文件
-            line_of_code_old += get_file_lines_of_code(repo, commit.parents[0].tree, old_file)  # 修改前版本的行数
+        for entry in entries:
+            line_of_code_old += get_file_lines_of_code(repo, entry.old_oid)  # 修改前版本的行数
 
-        # 存储提交ID及lt特征
-        code_churns[i].append(str(commit.id))  # commit_hash
-        code_churns[i].append(str(line_of_code_old))  # lt: 修改前的代码总行数
+    # 存储提交ID及lt特征
+    return [str(commit.id), line_of_code_old] + ([large_commit] if guard.max_files else [])
 
-    RES[pid] = code_churns
-
-def get_file_lines_of_code(repo, tree, dfile):
+def get_file_lines_of_code(repo, old_oid):
     """
     计算给定文件的代码行数。
+    diff 中已经带有修改前的blob oid（20字节），不需要再从父提交的树中按路径查找；
+    新增文件的 oid 为全零，行数为 0。
     """
-    tloc = 0
+    if old_oid == b'\0' * 20:
+        return 0
+    if LOC_CACHE is not None:
+        return LOC_CACHE.lines(repo, old_oid)
     try:
-        blob = repo[tree[dfile.path].id]
-        tloc = len(str(blob.data).split('\\n'))
+        return count_lines(repo[Oid(raw=old_oid)])
     except Exception:
-        return tloc
-    return tloc
+        return 0
 
-def get_code_churns(repo_path, branch, commit_hashes):
+def get_code_churns(repo_path, branch, commit_hashes, processes=None, chunk_size=8, loc_cache=f"./{suffix_file}/loc_cache.db",
+                    diffstat_root=f"./{suffix_file}/diffstat", index_root=f"./{suffix_file}/commit_index", guard=None, checkpoint_dir=None):
     """
     提取指定提交的代码变更信息。
+    loc_cache 为按blob oid保存行数的缓存文件，为 None 时不使用缓存；
+    diffstat_root 下存在当前tip的diff统计（diffstat.py）时直接读取，不再重新diff；
+    guard 为大提交保护设置（见 diffstat.py），启用时输出 large_commit 列；
+    checkpoint_dir 为断点目录（见 scheduler.run_stage）。
     """
-    cpus = cpu_count()
-    print(f"Using {cpus} CPUs...")
-
-    # 将提交列表分为多份，以便并行处理
-    commit_list = list(commit_hashes)
-    quotes, remainder = divmod(len(commit_list), cpus)
-
-    processes = [
-        Process(target=parse_code_churns, args=(i, repo_path, branch, set(commit_list[i * quotes + min(i, remainder): (i + 1) * quotes + min(i + 1, remainder)])))
-        for i in range(cpus)
-    ]
-
-    for process in processes:
-        process.start()
-
-    start_time = time.time()
-    for process in processes:
-        process.join()
-    end_time = time.time()
-
-    print("Done")
-    print(f"Overall processing time: {end_time - start_time} seconds")
-
-    churns = []
-    for _, churn in RES.items():
-        churns.extend(churn)
-
-    churns = list(reversed(churns))
+    index = open_commit_index(repo_path, branch, index_root)
+    store_path = find_diffstats(diffstat_root, index)
+    guard = effective_guard(guard, store_path)
+    schema = LT_SCHEMA + LARGE_COMMIT_SCHEMA if guard.max_files else LT_SCHEMA
+
+    # 按拓扑顺序把提交分成小块，由空闲进程按需领取
+    churns = run_stage(parse_code_churn, repo_path, index, index.select(commit_hashes), schema, processes, chunk_size,
+                       setup=partial(init_worker, loc_cache, store_path, index.path, guard), checkpoint_dir=checkpoint_dir)
     return churns
 
 def save_churns(churns, path=f"./{suffix_file}/lt{suffix_num}.csv"):
     """
-    保存lt特征到CSV文件。
+    保存lt特征到CSV文件，path 以 .parquet 结尾时保存为 Parquet 文件。
     """
-    with open(path, 'w') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(["commit_hash", "lt"])  # 输出提交哈希和lt特征
+    with TableWriter(path, [name for name, _ in churns.schema]) as writer:  # 输出提交哈希和lt特征（以及 large_commit）
 
-        for row in churns:
+        # 按拓扑逆序（最新的提交在前）逐行写出
+        for row in reversed(churns):
             if row:
-                writer.writerow([row[0], row[1]])  # 仅输出提交哈希和lt特征
+                writer.writerow(row)
 
 if __name__ == "__main__":
     PARSER = ArgumentParser(description="从指定仓库和CSV文件中的提交中提取代码变更。")
     PARSER.add_argument("--repository", "-r", type=str, default=f"/home/WangZiyang/szz/{suffix_repo}", help="Path to local git repository.")
     PARSER.add_argument("--branch", "-b", type=str, default=f"refs/heads/{suffix_branch}", help="Which branch to use.")
     PARSER.add_argument("--csv_file", "-c", type=str, default=f"./{suffix_file}/commit_id{suffix_num}.csv", help="包含提交哈希的CSV文件路径")
+    PARSER.add_argument("--processes", "-p", type=int, default=None, help="Number of worker processes, defaults to all CPUs.")
+    PARSER.add_argument("--chunk-size", type=int, default=8, help="Number of adjacent commits handed to a worker at a time.")
+    PARSER.add_argument("--loc-cache", type=str, default=f"./{suffix_file}/loc_cache.db", help="按blob oid缓存文件行数的sqlite文件，传空字符串则不使用缓存。")
+    PARSER.add_argument("--output", "-o", type=str, default=f"./{suffix_file}/lt{suffix_num}.csv", help="The path where the output is written (.parquet for a typed Parquet file).")
+    PARSER.add_argument("--diffstat-root", type=str, default=f"./{suffix_file}/diffstat", help="diff统计存储目录（diffstat.py 生成）")
+    PARSER.add_argument("--index-root", type=str, default=f"./{suffix_file}/commit_index", help="Directory where commit indexes are stored.")
+    PARSER.add_argument("--trace", type=str, default=None, help="按提交记录耗时、diff时间、读取字节数和内存的目录（见 instrument.py）")
+    add_guard_arguments(PARSER)
+    PARSER.add_argument("--checkpoint", type=str, default=None, help="断点目录：保留已完成的提交块，中断后重新运行同一命令时只处理剩余的提交")
 
     ARGS = PARSER.parse_args()
+    if ARGS.trace:
+        instrument.enable(ARGS.trace, "006")
     REPOPATH = ARGS.repository
     BRANCH = ARGS.branch
     CSV_FILE_PATH = ARGS.csv_file
@@ -145,8 +155,10 @@ if __name__ == "__main__":
     commit_hashes = load_commit_hashes_from_csv(CSV_FILE_PATH)
 
     # 获取代码变更信息
-    churns = get_code_churns(REPOPATH, BRANCH, commit_hashes)
+    churns = get_code_churns(REPOPATH, BRANCH, commit_hashes, ARGS.processes, ARGS.chunk_size, ARGS.loc_cache, ARGS.diffstat_root, ARGS.index_root,
+                             guard_from_args(ARGS), ARGS.checkpoint)
 
     # 保存变更数据
-    save_churns(churns)
+    save_churns(churns, ARGS.output)
+    churns.cleanup()
 
@@ -4,9 +4,7 @@ import sys
 import time
 
 from argparse import ArgumentParser
-from multiprocessing import Process, Manager, cpu_count
-from pygit2 import Repository, GIT_SORT_REVERSE, GIT_SORT_TOPOLOGICAL
-from tqdm import tqdm
+from commit_index import open_commit_index
 
 # 全局后缀变量
 suffix_num = "1" 
@@ -14,66 +12,20 @@ suffix_repo = "z3"
 suffix_branch = "master"
 suffix_file = "z3_data"
 
-MANAGER = Manager()
-RES = MANAGER.dict()
-
-# Global variables
-MANAGER = Manager()
-RES = MANAGER.dict()
-
-def extract_commit_hashes(pid, repo_path, branch, batch_start, batch_end):
+def get_all_commit_hashes(repo_path, branch, index_root=f"./{suffix_file}/commit_index"):
     """
-    Function that extracts commit hashes for a set of commits
-    and stores them in the RES dict.
+    General function for extracting commit hashes. The hashes are read
+    directly from the memory-mapped commit index, so no worker processes
+    or result passing between processes are needed.
     """
-    repo = Repository(repo_path)
-    head = repo.references.get(branch)
-    commits = list(repo.walk(head.target, GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE))
-
-    commits = commits[batch_start:batch_end]
-
-    commit_hashes = [str(commit.id) for commit in commits]
-    RES[pid] = commit_hashes
-
-def get_all_commit_hashes(repo_path, branch):
-    """
-    General function for extracting commit hashes. It uses multiprocessing
-    to speed up the process.
-    """
-    repo = Repository(repo_path)
-    head = repo.references.get(branch)
-    commits = list(repo.walk(head.target, GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE))
-
-    # Check how many processes that could be spawned
-    cpus = cpu_count()
-    print(f"Using {cpus} CPUs...")
-
-    # Equally split the commit set into equally sized parts.
-    quote, remainder = divmod(len(commits), cpus)
-
-    processes = [
-        Process(
-            target=extract_commit_hashes,
-            args=(i, repo_path, branch, i * quote + min(i, remainder),
-                  (i + 1) * quote + min(i + 1, remainder))) for i in range(cpus)
-    ]
-
-    for process in processes:
-        process.start()
-
     start_time = time.time()
-    for process in processes:
-        process.join()
+    index = open_commit_index(repo_path, branch, index_root)
+    all_commit_hashes = index.hexes()
     end_time = time.time()
 
     print("Done")
     print(f"Overall processing time {end_time - start_time} seconds.")
 
-    # Assemble the results
-    all_commit_hashes = []
-    for _, commit_hashes in RES.items():
-        all_commit_hashes.extend(commit_hashes)
-
     return all_commit_hashes
 
 def save_commit_hashes(commit_hashes, path=f"./{suffix_file}/all_id.csv"):
@@ -102,6 +54,17 @@ if __name__ == "__main__":
         type=str,
         default=f"refs/heads/{suffix_branch}",
         help="Which branch to use.")
+    PARSER.add_argument(
+        "--index-root",
+        type=str,
+        default=f"./{suffix_file}/commit_index",
+        help="Directory where commit indexes are stored.")
+    PARSER.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        default=f"./{suffix_file}/all_id.csv",
+        help="The path where the output is written.")
 
     ARGS = PARSER.parse_args()
     REPOPATH = ARGS.repository
@@ -112,9 +75,9 @@ if __name__ == "__main__":
         sys.exit(1)
 
     # 获取所有 commit_hash
-    all_commit_hashes = get_all_commit_hashes(REPOPATH, BRANCH)
+    all_commit_hashes = get_all_commit_hashes(REPOPATH, BRANCH, ARGS.index_root)
 
     # 保存所有 commit_hash 到 CSV
-    save_commit_hashes(all_commit_hashes)
+    save_commit_hashes(all_commit_hashes, ARGS.output)
 
     print(f"All commit hashes saved to all_id.csv.")
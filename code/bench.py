@@ -0,0 +1,381 @@
+import csv
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+import pygit2
+from pygit2 import GIT_FILEMODE_BLOB, GIT_FILEMODE_TREE, Signature
+from run_all import REPO_DEFAULTS, plan_repo
+
+# 结果文件格式版本（2: 合成仓库中加入合并提交，与版本1的结果不可直接比较）
+BENCH_VERSION = 2
+
+# 合成仓库的默认规模
+DEFAULT_CONFIG = {
+    "commits": 2000,
+    "files": 500,
+    "authors": 20,
+    "depth": 3,
+    "lines": 40,            # 新文件的平均行数
+    "files_per_commit": 3,  # 普通提交平均修改的文件数
+    "huge_every": 500,      # 每隔多少个提交出现一次大提交（例如 vendor 目录导入），0 表示没有
+    "huge_files": 2000,     # 大提交新增的文件数
+    "merge_every": 100,     # 每隔多少个提交把一个分支以 --no-ff 方式合并回主线，0 表示线性历史
+    "branch_commits": 3,    # 每个被合并的分支上的提交数
+    "bug_ratio": 0.1,       # 作为 szz 数据对中引入bug的提交的比例
+    "seed": 1,
+}
+
+WORDS = ["int", "return", "if", "else", "for", "while", "value", "index", "result", "buffer", "node", "state",
+         "count", "size", "ptr", "expr", "solver", "term", "check", "push", "pop", "assert", "model", "fix"]
+
+# --check 中比较增量更新与完整建图时的初始文件（合成仓库中的 .c/.py 文件），使初始提交移动时有文件受影响
+CHECK_SEED_FILES = ["*.c", "*.py"]
+
+MESSAGES = ["fix crash in {w}", "add {w} support", "refactor {w}", "improve {w} performance", "update docs for {w}",
+            "avoid overflow in {w}", "merge {w} changes", "bug in {w}", "optimize {w}", "clean up {w}"]
+
+class SyntheticRepo:
+    """
+    用 pygit2 直接写对象生成一个可复现的合成仓库（同一配置与 seed 生成相同的提交）。
+    树以嵌套字典保存，只重新写入有修改的目录。
+    """
+
+    def __init__(self, path, config):
+        self.config = config
+        self.rng = random.Random(config["seed"])
+        self.repo = pygit2.init_repository(path, bare=True)
+        self.root = {}
+        self.tree_cache = {}
+        self.paths = []
+        self.created = 0  # 删除文件后 len(self.paths) 会变小，文件名用单调递增的编号避免重名
+        self.blob_bytes = 0
+
+    def text(self, lines):
+        rng = self.rng
+        return "".join(" ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 8))) + "\n" for _ in range(lines)).encode()
+
+    def new_path(self, prefix=None):
+        depth = self.rng.randint(1, self.config["depth"])
+        dirs = [f"d{self.rng.randint(0, 7)}" for _ in range(depth)]
+        if prefix:
+            dirs = [prefix] + dirs
+        self.created += 1
+        return "/".join(dirs + [f"f{self.created}.{self.rng.choice(['c', 'h', 'py', 'txt'])}"])
+
+    def set_file(self, path, data):
+        node = self.root
+        parts = path.split("/")
+        for i, part in enumerate(parts[:-1]):
+            self.tree_cache.pop("/".join(parts[:i]), None)
+            node = node.setdefault(part, {})
+        self.tree_cache.pop("/".join(parts[:-1]), None)
+        node[parts[-1]] = self.repo.create_blob(data)
+        self.blob_bytes += len(data)
+
+    def remove_file(self, path):
+        node = self.root
+        parts = path.split("/")
+        for i, part in enumerate(parts[:-1]):
+            self.tree_cache.pop("/".join(parts[:i]), None)
+            node = node[part]
+        self.tree_cache.pop("/".join(parts[:-1]), None)
+        del node[parts[-1]]
+
+    def write_tree(self, node, prefix=""):
+        if prefix in self.tree_cache:
+            return self.tree_cache[prefix]
+        builder = self.repo.TreeBuilder()
+        for name, value in node.items():
+            if isinstance(value, dict):
+                if value:
+                    builder.insert(name, self.write_tree(value, f"{prefix}/{name}" if prefix else name), GIT_FILEMODE_TREE)
+            else:
+                builder.insert(name, value, GIT_FILEMODE_BLOB)
+        oid = builder.write()
+        self.tree_cache[prefix] = oid
+        return oid
+
+    def commit(self, parents, when):
+        config = self.config
+        author_id = int(self.rng.paretovariate(1.2)) % config["authors"]
+        author = Signature(f"author{author_id}", f"author{author_id}@example.com", when, 0)
+        message = self.rng.choice(MESSAGES).format(w=self.rng.choice(WORDS))
+        return self.repo.create_commit(None, author, author, message, self.write_tree(self.root), parents)
+
+    def generate(self):
+        """
+        生成 config["commits"] 个提交的历史，返回按时间顺序排列的提交 oid 列表。
+        merge_every 不为 0 时，每个周期的最后 branch_commits 个提交在分支上，随后的合并提交
+        以主线为第一个父提交、树与分支相同，所以遍历顺序中合并提交的前一个提交不是它的第一个父提交。
+        """
+        config = self.config
+        rng = self.rng
+        when = 1600000000
+        commits = []
+
+        for _ in range(max(1, config["files"] // 4)):
+            self.paths.append(self.new_path())
+            self.set_file(self.paths[-1], self.text(config["lines"]))
+        commits.append(self.commit([], when))
+        mainline = commits[-1]
+        merge_every = config["merge_every"]
+
+        for i in range(1, config["commits"]):
+            when += rng.randint(60, 36000)
+            if merge_every and i % merge_every == 0 and commits[-1] != mainline:
+                mainline = self.commit([mainline, commits[-1]], when)
+                commits.append(mainline)
+                continue
+            if config["huge_every"] and i % config["huge_every"] == 0:
+                # 大提交：一次导入很多新文件
+                vendor = f"vendor{i}"
+                for _ in range(config["huge_files"]):
+                    self.paths.append(self.new_path(vendor))
+                    self.set_file(self.paths[-1], self.text(rng.randint(1, config["lines"] * 2)))
+            else:
+                for _ in range(max(1, int(rng.expovariate(1 / config["files_per_commit"])))):
+                    roll = rng.random()
+                    if len(self.paths) < config["files"] and roll < 0.2:
+                        self.paths.append(self.new_path())
+                        self.set_file(self.paths[-1], self.text(rng.randint(1, config["lines"] * 2)))
+                    elif roll < 0.23 and len(self.paths) > 1:
+                        self.remove_file(self.paths.pop(rng.randrange(len(self.paths))))
+                    else:
+                        self.set_file(rng.choice(self.paths), self.text(rng.randint(1, config["lines"] * 2)))
+            commits.append(self.commit([commits[-1]], when))
+            if not merge_every or i % merge_every < merge_every - config["branch_commits"]:
+                mainline = commits[-1]
+
+        self.repo.references.create("refs/heads/master", commits[-1], force=True)
+        return commits
+
+    def pairs(self, commits):
+        """
+        随机选出引入bug的提交，每个配一个之后的修复提交，格式同 szz 的 fix_and_introducers_pairs.json。
+        """
+        count = int(len(commits) * self.config["bug_ratio"])
+        pairs = []
+        for pos in sorted(self.rng.sample(range(len(commits) - 1), min(count, len(commits) - 1))):
+            pairs.append([str(commits[self.rng.randint(pos + 1, len(commits) - 1)]), str(commits[pos])])
+        return pairs
+
+def count_rows(path):
+    with open(path, 'r') as inp:
+        return max(0, sum(1 for _ in inp) - 1)
+
+def run_stage_process(job, log_path):
+    """
+    运行一个步骤并等待结束，返回 (秒数, 峰值RSS MB, 返回码)。
+    峰值RSS取自 wait4，为该步骤进程及其已结束的子进程（调度器的工作进程）中最大的一个。
+    """
+    with open(log_path, 'w') as log:
+        start_time = time.perf_counter()
+        process = subprocess.Popen(job.command(), stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return seconds, usage.ru_maxrss / 1024, process.returncode
+
+def run_benchmark(config, workdir, processes=1, engine="stages", labels=(1, 0), trace=None, check=False):
+    """
+    生成合成仓库并依次运行流水线的每一步，返回结果字典。
+    trace 不为 None 时各阶段把按提交的记录写入该目录（见 instrument.py）。
+    check 为 True 且 engine 为 stages 时，之后用 check_engines 比较 extract_all.py 与流水线的输出，
+    用 check_incremental 比较 003/004 增量更新与完整建图的输出（不计时）。
+    """
+    repo_path = os.path.join(workdir, "repo.git")
+    data_dir = os.path.join(workdir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+
+    start_time = time.perf_counter()
+    synthetic = SyntheticRepo(repo_path, config)
+    commits = synthetic.generate()
+    with open(os.path.join(data_dir, "fix_and_introducers_pairs.json"), 'w') as output:
+        json.dump(synthetic.pairs(commits), output)
+    generate_seconds = time.perf_counter() - start_time
+
+    repo = dict(REPO_DEFAULTS)
+    repo.update({"name": "bench", "path": repo_path, "branch": "refs/heads/master", "data_dir": data_dir,
+                 "pairs": os.path.join(data_dir, "fix_and_introducers_pairs.json"), "engine": engine, "labels": list(labels),
+                 "trace": os.path.abspath(trace) if trace else False})
+
+    stages = []
+    for job in plan_repo(repo):
+        job.workers = processes
+        seconds, rss, returncode = run_stage_process(job, os.path.join(data_dir, f"{job.name}.log"))
+        stage = {"name": job.name, "seconds": round(seconds, 4), "peak_rss_mb": round(rss, 1), "returncode": returncode}
+        # 按标签运行的步骤以对应 commit_id 文件的行数为提交数，其余步骤处理全部提交
+        ids = [job.args[i + 1] for i, arg in enumerate(job.args) if arg == "-c"]
+        ids += [os.path.join(data_dir, f"commit_id{job.args[i + 1]}.csv") for i, arg in enumerate(job.args) if arg == "--label"]
+        stage["commits"] = count_rows(ids[0]) if ids and os.path.exists(ids[0]) else len(commits)
+        stage["commits_per_second"] = round(stage["commits"] / seconds, 2) if seconds else None
+        stages.append(stage)
+        print(f"{job.name:<14} {seconds:9.3f}s {stage['commits_per_second'] or 0:10.1f} commits/s {rss:8.1f} MB")
+        if returncode != 0:
+            print(f"{job.name} failed, see {os.path.join(data_dir, job.name + '.log')}")
+            break
+
+    ok = all(stage["returncode"] == 0 for stage in stages)
+    mismatches = None
+    if check and engine == "stages" and ok:
+        mismatches = check_engines(repo, data_dir, processes)
+        mismatches.update(check_incremental(repo, data_dir, commits))
+
+    total = sum(stage["seconds"] for stage in stages)
+    return {
+        "version": BENCH_VERSION,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "pygit2": pygit2.__version__,
+                 "libgit2": pygit2.LIBGIT2_VERSION, "cpus": os.cpu_count()},
+        "config": config,
+        "processes": processes,
+        "engine": engine,
+        "repo": {"commits": len(commits), "files": len(synthetic.paths), "blob_bytes": synthetic.blob_bytes,
+                 "generate_seconds": round(generate_seconds, 4)},
+        "stages": stages,
+        "total": {"seconds": round(total, 4), "commits_per_second": round(len(commits) / total, 2) if total else None,
+                  "peak_rss_mb": max((stage["peak_rss_mb"] for stage in stages), default=0),
+                  "ok": ok and (mismatches is None or not any(count != 0 for count in mismatches.values()))},
+        "check": mismatches,
+    }
+
+def read_features(path):
+    with open(path, 'r', newline='') as inp:
+        return {row["commit_hash"]: row for row in csv.DictReader(inp)}
+
+def same_value(a, b):
+    try:
+        return math.isclose(float(a), float(b), rel_tol=1e-9, abs_tol=1e-9)
+    except ValueError:
+        return a == b
+
+def check_engines(repo, data_dir, processes=1):
+    """
+    在同一仓库上再运行 extract_all.py，与流水线 merge.py 的输出逐行逐列比较。
+    返回 {标签: 不一致的单元格数}，某一方缺少的行也计入。
+    """
+    mismatches = {}
+    for job in plan_repo(dict(repo, engine="extract_all")):
+        if not job.name.startswith("extract_all"):
+            continue
+        label = job.name[len("extract_all"):]
+        expected = job.args[job.args.index("-o") + 1]
+        output = os.path.join(data_dir, f"check_extract_all{label}.csv")
+        job.args[job.args.index("-o") + 1] = output
+        job.workers = processes
+        _, _, returncode = run_stage_process(job, os.path.join(data_dir, f"check_{job.name}.log"))
+        if returncode != 0:
+            print(f"{job.name} failed, see {os.path.join(data_dir, 'check_' + job.name + '.log')}")
+            mismatches[label] = None
+            continue
+        mismatches[label] = count_mismatches(expected, output, f"extract_all{label} vs merge{label}")
+    return mismatches
+
+def count_mismatches(expected_path, actual_path, name):
+    """
+    逐行逐列比较两个特征文件，返回不一致的单元格数，某一方缺少的行也计入。
+    """
+    expected, actual = read_features(expected_path), read_features(actual_path)
+    count = len(set(expected) ^ set(actual))
+    for commit_hash in set(expected) & set(actual):
+        for column, value in expected[commit_hash].items():
+            if not same_value(value, actual[commit_hash].get(column, "")):
+                count += 1
+                if count <= 5:
+                    print(f"{name} {commit_hash} {column}: {value} != {actual[commit_hash].get(column)}")
+    print(f"{name}: {len(expected)} rows, {count} mismatches")
+    return count
+
+def check_incremental(repo, data_dir, commits):
+    """
+    在分支 refs/heads/bench-check 指向 2/3 处的提交时用 003.py/004.py 建图，分支前进到最后一个提交后增量更新，
+    与在最后一个提交上完整建图的输出比较；JSON 与二进制存储各一次。
+    返回 {"003_db": 不一致的单元格数, ...}，运行失败时为 None。
+    """
+    ref = "refs/heads/bench-check"
+    git_repo = pygit2.Repository(repo["path"])
+    check_dir = os.path.join(data_dir, "check_incremental")
+    os.makedirs(check_dir, exist_ok=True)
+    label = repo["labels"][0]
+    mismatches = {}
+    for job in plan_repo(dict(repo, branch=ref)):
+        if job.name not in (f"003_{label}", f"004_{label}"):
+            continue
+        job.args += ["--seed-files"] + CHECK_SEED_FILES
+        stage = job.name.split("_")[0]
+        for ext in ["db", "json"]:
+            name = f"{stage}_{ext}"
+            runs = [("base", commits[len(commits) * 2 // 3], "incremental"), ("incremental", commits[-1], "incremental"),
+                    ("full", commits[-1], "full")]
+            returncode = 0
+            for run, target, graph in runs:
+                git_repo.references.create(ref, target, force=True)
+                job.args[job.args.index("-gp") + 1] = os.path.join(check_dir, f"{stage}_{graph}.{ext}")
+                job.args[job.args.index("-o") + 1] = os.path.join(check_dir, f"{name}_{run}.csv")
+                _, _, returncode = run_stage_process(job, os.path.join(check_dir, f"{name}_{run}.log"))
+                if returncode != 0:
+                    print(f"{job.name} failed, see {os.path.join(check_dir, name + '_' + run + '.log')}")
+                    break
+            mismatches[name] = None if returncode != 0 else count_mismatches(
+                os.path.join(check_dir, f"{name}_full.csv"), os.path.join(check_dir, f"{name}_incremental.csv"),
+                f"{stage} incremental vs full ({ext})")
+    git_repo.references.delete(ref)
+    return mismatches
+
+def compare_results(base, results):
+    """
+    按步骤比较两次结果的耗时和峰值内存，ratio < 1 表示变快。
+    """
+    base_stages = {stage["name"]: stage for stage in base["stages"]}
+    print(f"{'stage':<14} {'base s':>9} {'new s':>9} {'ratio':>7} {'base MB':>9} {'new MB':>9}")
+    for stage in results["stages"] + [dict(results["total"], name="total")]:
+        old = base["total"] if stage["name"] == "total" else base_stages.get(stage["name"])
+        if old is None:
+            continue
+        ratio = stage["seconds"] / old["seconds"] if old["seconds"] else float("nan")
+        print(f"{stage['name']:<14} {old['seconds']:9.3f} {stage['seconds']:9.3f} {ratio:7.2f} {old['peak_rss_mb']:9.1f} {stage['peak_rss_mb']:9.1f}")
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="生成可复现的合成仓库，依次计时流水线的每一步，结果写入JSON以便跨版本比较。")
+    for key, value in DEFAULT_CONFIG.items():
+        PARSER.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value, help=f"合成仓库参数，默认 {value}")
+    PARSER.add_argument("--processes", "-p", type=int, default=1, help="并行步骤的工作进程数")
+    PARSER.add_argument("--engine", choices=["stages", "extract_all"], default="stages", help="运行 001-006+merge 还是 extract_all.py")
+    PARSER.add_argument("--labels", type=int, nargs='+', default=[1, 0], help="要运行的标签")
+    PARSER.add_argument("--output", "-o", type=str, default="bench_results.json", help="结果JSON文件")
+    PARSER.add_argument("--compare", "-c", type=str, default=None, help="与之前的结果JSON比较")
+    PARSER.add_argument("--trace", type=str, default=None, help="各阶段按提交的记录目录，之后可用 python code/instrument.py 目录 汇总")
+    PARSER.add_argument("--check", action="store_true", help="engine 为 stages 时再运行 extract_all.py 并与 merge.py 的输出比较，并比较 003/004 增量更新与完整建图的输出，不一致时返回非0")
+    PARSER.add_argument("--workdir", type=str, default=None, help="合成仓库和中间文件的目录，默认使用临时目录并在结束后删除")
+
+    ARGS = PARSER.parse_args()
+    CONFIG = {key: getattr(ARGS, key) for key in DEFAULT_CONFIG}
+
+    WORKDIR = ARGS.workdir or tempfile.mkdtemp(prefix="bench_")
+    if ARGS.workdir and os.path.exists(os.path.join(WORKDIR, "repo.git")):
+        print(f"{WORKDIR} already contains a benchmark repository!")
+        sys.exit(1)
+    try:
+        RESULTS = run_benchmark(CONFIG, WORKDIR, ARGS.processes, ARGS.engine, ARGS.labels, ARGS.trace, ARGS.check)
+    finally:
+        if not ARGS.workdir:
+            shutil.rmtree(WORKDIR)
+
+    with open(ARGS.output, 'w') as output:
+        json.dump(RESULTS, output, indent=2)
+    print(f"{RESULTS['repo']['commits']} commits in {RESULTS['total']['seconds']} seconds "
+          f"({RESULTS['total']['commits_per_second']} commits/s), results written to {ARGS.output}")
+
+    if ARGS.compare:
+        with open(ARGS.compare, 'r') as inp:
+            compare_results(json.load(inp), RESULTS)
+    sys.exit(0 if RESULTS["total"]["ok"] else 1)
@@ -0,0 +1,124 @@
+import json
+import os
+import sys
+import time
+
+from argparse import ArgumentParser
+import numpy as np
+from commit_index import hashes_to_oids, open_commit_index
+from feature_io import TableWriter
+
+# 全局后缀变量
+suffix_num = "1"
+suffix_repo = "z3"
+suffix_branch = "master"
+suffix_file = "z3_data"
+
+def load_pairs(json_path):
+    """
+    读取szz输出的 [修复提交, 引入提交] 列表，转换为 (n, 2) 的 S20 oid 数组，
+    去掉重复的数据对（保留首次出现的顺序）。返回 (pairs, 重复数量)。
+    """
+    with open(json_path, 'r') as inp:
+        data = json.load(inp)
+    flat = hashes_to_oids(hash for pair in data for hash in pair[:2])
+    del data
+
+    pairs = flat.reshape(-1, 2)
+    if len(pairs) == 0:
+        return pairs, 0
+    # 每个数据对看作一个40字节的值去重
+    keys = np.ascontiguousarray(pairs).view('V40').reshape(-1)
+    _, first = np.unique(keys, return_index=True)
+    first.sort()
+    return pairs[first], len(pairs) - len(first)
+
+def oid_hex(oid):
+    """
+    S20 数组的元素会去掉末尾的零字节，转换为十六进制前先补齐20字节。
+    """
+    return oid.ljust(20, b"\0").hex()
+
+def sorted_oids(oids):
+    """
+    排序去重后的 S20 数组，空值（无法解析的哈希）被丢弃，用于 contains 的二分查找。
+    """
+    oids = np.unique(np.asarray(oids, dtype='S20'))
+    return oids[oids != b""]
+
+def contains(sorted_set, oids):
+    """
+    oids 中每个 oid 是否在 sorted_set 中，返回布尔数组。
+    """
+    oids = np.asarray(oids, dtype='S20')
+    if len(sorted_set) == 0 or len(oids) == 0:
+        return np.zeros(len(oids), dtype=bool)
+    idx = np.searchsorted(sorted_set, oids)
+    idx[idx >= len(sorted_set)] = 0
+    return sorted_set[idx] == oids
+
+def label_index(index, buggy):
+    """
+    一次遍历提交索引，返回每个拓扑位置的 is_buggy_commit（int8，1 为引入bug的提交）。
+    buggy 为 sorted_oids 返回的数组。
+    """
+    oids = np.asarray(index.oids).view('S20').reshape(-1)
+    return contains(buggy, oids).astype(np.int8)
+
+def save_labels(index, labels, output_path, value=None):
+    """
+    按拓扑顺序写出 commit_hash,is_buggy_commit；value 不为 None 时只写出 commit_hash 列中标签等于 value 的提交。
+    """
+    columns = ["commit_hash"] if value is not None else ["commit_hash", "is_buggy_commit"]
+    with TableWriter(output_path, columns, lineterminator='\n') as writer:
+        for pos in range(len(index)):
+            if value is None:
+                writer.writerow([index.hex(pos), int(labels[pos])])
+            elif labels[pos] == value:
+                writer.writerow([index.hex(pos)])
+    return writer.count
+
+def get_bug_labels(repo_path, branch, json_path, index_root=f"./{suffix_file}/commit_index"):
+    """
+    读取szz结果并对分支上的所有提交打标签，返回 (index, labels, pairs, 重复数量)。
+    """
+    start_time = time.time()
+    index = open_commit_index(repo_path, branch, index_root)
+    pairs, duplicate_count = load_pairs(json_path)
+    labels = label_index(index, sorted_oids(pairs[:, 1]))
+    end_time = time.time()
+    print(f"{int(labels.sum())} of {len(index)} commits labelled buggy in {end_time - start_time} seconds")
+    return index, labels, pairs, duplicate_count
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="由szz的数据对一次性计算分支上所有提交的 is_buggy_commit 标签。")
+    PARSER.add_argument("--repository", "-r", type=str, default=f"/home/WangZiyang/szz/{suffix_repo}", help="Path to local git repository.")
+    PARSER.add_argument("--branch", "-b", type=str, default=f"refs/heads/{suffix_branch}", help="Which branch to use.")
+    PARSER.add_argument("--pairs", "-p", type=str, default=f"./{suffix_file}/fix_and_introducers_pairs.json", help="szz输出的数据对JSON文件")
+    PARSER.add_argument("--output", "-o", type=str, default=f"./{suffix_file}/bug_labels{suffix_num}.csv", help="输出 commit_hash,is_buggy_commit")
+    PARSER.add_argument("--buggy-output", type=str, default=None, help="另外写出标签为1的 commit_hash 列表")
+    PARSER.add_argument("--clean-output", type=str, default=None, help="另外写出标签为0的 commit_hash 列表（同 commit_id0.csv）")
+    PARSER.add_argument("--pairs-output", type=str, default=None, help="另外写出去重后的数据对（同 choose_id1.py 的 不同数据对.csv）")
+    PARSER.add_argument("--index-root", type=str, default=f"./{suffix_file}/commit_index", help="提交索引目录（commit_index.py）")
+
+    ARGS = PARSER.parse_args()
+
+    if not os.path.exists(ARGS.repository):
+        print("The repository path does not exist!")
+        sys.exit(1)
+    if not os.path.exists(ARGS.pairs):
+        print(f"{ARGS.pairs} 不存在!")
+        sys.exit(1)
+
+    INDEX, LABELS, PAIRS, DUPLICATE_COUNT = get_bug_labels(ARGS.repository, ARGS.branch, ARGS.pairs, ARGS.index_root)
+    print(f"Number of duplicate data pairs removed: {DUPLICATE_COUNT}")
+    if ARGS.pairs_output:
+        with TableWriter(ARGS.pairs_output, ['commit_hash_1', 'commit_hash_2'], lineterminator='\n') as writer:
+            for fix, bug in PAIRS:
+                writer.writerow([oid_hex(fix), oid_hex(bug)])
+    save_labels(INDEX, LABELS, ARGS.output)
+    if ARGS.buggy_output:
+        save_labels(INDEX, LABELS, ARGS.buggy_output, 1)
+    if ARGS.clean_output:
+        save_labels(INDEX, LABELS, ARGS.clean_output, 0)
+    print(f"Labels saved to {ARGS.output}")
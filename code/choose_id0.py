@@ -1,20 +1,46 @@
-import pandas as pd
+import os
+import sys
+
+from argparse import ArgumentParser
+from bug_labels import contains, sorted_oids
+from commit_index import hashes_to_oids
+from feature_io import TableWriter, iter_rows
 
 suffix_num = "1" 
 suffix_repo = "z3" 
 suffix_branch = "master"
 suffix_file = "z3_data"
 
-# 读取 all_id.csv 和 commit_id1.csv
-all_id_df = pd.read_csv(f'./{suffix_file}/all_id.csv')
-commit_id1_df = pd.read_csv(f'./{suffix_file}/commit_id1.csv')
+def write_missing(hashes, buggy, writer):
+    found = contains(buggy, hashes_to_oids(hashes))
+    for commit_hash, is_buggy in zip(hashes, found):
+        if not is_buggy:
+            writer.writerow([commit_hash])
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="从szz结果json文件中找到不是commit_bug的hash值")
+    PARSER.add_argument("--all-ids", "-a", type=str, default=f'./{suffix_file}/all_id.csv', help="all_id.py 输出的所有 commit_hash")
+    PARSER.add_argument("--buggy-ids", "-i", type=str, default=f'./{suffix_file}/commit_id1.csv', help="choose_id1.py 输出的 commit_hash")
+    PARSER.add_argument("--output", "-o", type=str, default=f'./{suffix_file}/commit_id0.csv', help="输出的 commit_hash 列表")
+    PARSER.add_argument("--chunk-rows", type=int, default=100000, help="每次处理的 all_id 行数")
+
+    ARGS = PARSER.parse_args()
+
+    for path in [ARGS.all_ids, ARGS.buggy_ids]:
+        if not os.path.exists(path):
+            print(f"{path} 不存在!")
+            sys.exit(1)
 
-# 查找 all_id.csv 中不在 commit_id1.csv 中的 commit_hash
-# 使用 set 来比较两个文件中的 commit_hash 列
-commit_id1_hashes = set(commit_id1_df['commit_hash'])
-missing_commit_hashes = all_id_df[~all_id_df['commit_hash'].isin(commit_id1_hashes)]
+    # commit_id1.csv 中的 commit_hash 转换为排序的20字节oid数组，按块二分查找 all_id.csv 中的 commit_hash
+    buggy = sorted_oids(hashes_to_oids(row[0] for row in iter_rows(ARGS.buggy_ids, ['commit_hash'])))
 
-# 将结果保存到 commit_id0.csv 中
-missing_commit_hashes.to_csv(f'./{suffix_file}/commit_id0.csv', index=False)
+    with TableWriter(ARGS.output, ['commit_hash'], lineterminator='\n') as writer:
+        chunk = []
+        for row in iter_rows(ARGS.all_ids, ['commit_hash']):
+            chunk.append(row[0])
+            if len(chunk) >= ARGS.chunk_rows:
+                write_missing(chunk, buggy, writer)
+                chunk = []
+        write_missing(chunk, buggy, writer)
 
-print(f"Missing commit_hashes saved to commit_id0.csv")
+    print(f"Missing commit_hashes saved to commit_id0.csv")
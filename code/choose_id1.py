@@ -1,41 +1,39 @@
-import json
-import pandas as pd
+import os
+import sys
+
+from argparse import ArgumentParser
+from bug_labels import load_pairs, oid_hex
+from feature_io import TableWriter
 
 suffix_num = "1" 
 suffix_repo = "z3" 
 suffix_branch = "master"
 suffix_file = "z3_data"
 
-# 假设 json 文件的路径
-json_file = f'./{suffix_file}/fix_and_introducers_pairs.json'
-
-# 读取 json 文件
-with open(json_file, 'r') as file:
-    data = json.load(file)
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="从szz结果json文件中找到是commit_bug的hash值")
+    PARSER.add_argument("--pairs", "-p", type=str, default=f'./{suffix_file}/fix_and_introducers_pairs.json', help="szz输出的数据对JSON文件")
+    PARSER.add_argument("--output", "-o", type=str, default=f'./{suffix_file}/commit_id1.csv', help="输出的 commit_hash 列表")
+    PARSER.add_argument("--pairs-output", type=str, default='不同数据对.csv', help="去重后的数据对")
 
-# 查找并删除重复项
-unique_data = []
-seen = set()
-duplicate_count = 0
+    ARGS = PARSER.parse_args()
 
-# 假设 json 数据是一个列表，其中每个项也是一个列表
-for item in data:
-    data_pair = tuple(item)  # 将每个列表转换为元组
-    if data_pair not in seen:
-        unique_data.append(item)
-        seen.add(data_pair)
-    else:
-        duplicate_count += 1
+    if not os.path.exists(ARGS.pairs):
+        print(f"{ARGS.pairs} 不存在!")
+        sys.exit(1)
 
-# 保存唯一的数据对到 CSV 文件 '不同数据对.csv' 中
-df_unique = pd.DataFrame(unique_data, columns=['commit_hash_1', 'commit_hash_2'])
-df_unique.to_csv('不同数据对.csv', index=False)
+    # 数据对以20字节的二进制oid保存并去重，只在写出时转换为十六进制
+    pairs, duplicate_count = load_pairs(ARGS.pairs)
 
-# 提取每个数据对的第二个数据，保存到 'commit_id1.csv' 的 commit_hash 列中
-commit_df = df_unique[['commit_hash_2']].copy()
-commit_df.columns = ['commit_hash']  # 重命名列
-commit_df.to_csv(f'./{suffix_file}/commit_id1.csv', index=False)
+    # 保存唯一的数据对到 CSV 文件 '不同数据对.csv' 中
+    with TableWriter(ARGS.pairs_output, ['commit_hash_1', 'commit_hash_2'], lineterminator='\n') as writer:
+        for fix, bug in pairs:
+            writer.writerow([oid_hex(fix), oid_hex(bug)])
 
-# 输出重复的数量
-print(f"Number of duplicate data pairs removed: {duplicate_count}")
+    # 提取每个数据对的第二个数据，保存到 'commit_id1.csv' 的 commit_hash 列中
+    with TableWriter(ARGS.output, ['commit_hash'], lineterminator='\n') as writer:
+        for bug in pairs[:, 1]:
+            writer.writerow([oid_hex(bug)])
 
+    # 输出重复的数量
+    print(f"Number of duplicate data pairs removed: {duplicate_count}")
@@ -0,0 +1,210 @@
+import heapq
+import json
+import os
+import shutil
+import uuid
+
+from array import array
+import numpy as np
+
+# 列类型：整数、浮点数以 numpy 数组保存，字符串做字典编码，OID 为20字节的原始对象id
+INT = "int"
+FLOAT = "float"
+STR = "str"
+OID = "oid"
+
+class ColumnWriter:
+    """
+    在工作进程中按行累积一块结果，写完后追加到本进程的分片文件（ShardWriter）。
+    schema 为 [(列名, 类型), ...]。
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.columns = []
+        self.dictionaries = []
+        for _, kind in schema:
+            if kind == INT:
+                self.columns.append(array('q'))
+            elif kind == FLOAT:
+                self.columns.append(array('d'))
+            elif kind == OID:
+                self.columns.append(bytearray())
+            else:
+                self.columns.append(array('i'))
+            self.dictionaries.append({} if kind == STR else None)
+        self.count = 0
+
+    def append(self, row):
+        for value, (_, kind), column, dictionary in zip(row, self.schema, self.columns, self.dictionaries):
+            if kind == STR:
+                column.append(dictionary.setdefault(value, len(dictionary)))
+            elif kind == OID:
+                column.extend(value)
+            else:
+                column.append(value)
+        self.count += 1
+
+    def write_block(self, output):
+        """
+        把这一块结果追加到已打开的二进制文件：每列一个 .npy 帧，字符串列后面另有字典帧（JSON编码）。
+        """
+        for (name, kind), column, dictionary in zip(self.schema, self.columns, self.dictionaries):
+            dtype = {INT: np.int64, FLOAT: np.float64, STR: np.int32, OID: np.uint8}[kind]
+            values = np.frombuffer(column, dtype=dtype) if len(column) else np.zeros(0, dtype=dtype)
+            np.save(output, values.reshape(-1, 20) if kind == OID else values)
+            if kind == STR:
+                np.save(output, np.frombuffer(json.dumps(list(dictionary)).encode(), dtype=np.uint8))
+
+class ColumnChunk:
+    """
+    从分片文件中读出的一块结果（只有一块的大小，随用随读）。
+    """
+
+    def __init__(self, schema, inp):
+        self.schema = schema
+        self.columns = []
+        self.dictionaries = []
+        for name, kind in schema:
+            self.columns.append(np.load(inp))
+            self.dictionaries.append(json.loads(np.load(inp).tobytes()) if kind == STR else None)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def row(self, i):
+        values = []
+        for (_, kind), column, dictionary in zip(self.schema, self.columns, self.dictionaries):
+            if kind == OID:
+                values.append(column[i].tobytes())
+                continue
+            value = column[i].item()
+            values.append(dictionary[value] if dictionary is not None else value)
+        return values
+
+    def column(self, name):
+        i = [n for n, _ in self.schema].index(name)
+        if self.dictionaries[i] is None:
+            return self.columns[i]
+        return [self.dictionaries[i][code] for code in self.columns[i]]
+
+# 分片索引文件中每块一条定长记录：块编号、块在数据文件中的偏移、行数
+SHARD_INDEX_DTYPE = np.dtype([('chunk', '<i8'), ('offset', '<i8'), ('rows', '<i8')])
+
+class ShardWriter:
+    """
+    一个工作进程的结果分片：shard_<id>.data 依次追加各块的列式数据，
+    shard_<id>.idx 在数据写完后追加该块的索引记录。
+    工作进程按递增顺序领取块，所以每个分片内的块按拓扑顺序排列；
+    进程在写入中途退出时，没有索引记录的数据会被忽略。
+    """
+
+    def __init__(self, spill_dir):
+        name = f"shard_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+        self.data = open(os.path.join(spill_dir, f"{name}.data"), 'ab')
+        self.index = open(os.path.join(spill_dir, f"{name}.idx"), 'ab')
+
+    def append(self, chunk_id, writer):
+        offset = self.data.tell()
+        writer.write_block(self.data)
+        self.data.flush()
+        self.index.write(np.array([(chunk_id, offset, writer.count)], dtype=SHARD_INDEX_DTYPE).tobytes())
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+def shard_names(spill_dir):
+    """
+    溢出目录中所有分片的名字（不含扩展名）。
+    """
+    return sorted(name[:-len(".idx")] for name in os.listdir(spill_dir) if name.startswith("shard_") and name.endswith(".idx"))
+
+def read_shard_index(path):
+    """
+    以只读 mmap 方式打开分片索引，忽略末尾不完整的记录。
+    """
+    count = os.path.getsize(path) // SHARD_INDEX_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=SHARD_INDEX_DTYPE)
+    return np.memmap(path, dtype=SHARD_INDEX_DTYPE, mode='r', shape=(count,))
+
+def done_chunks(spill_dir):
+    """
+    溢出目录中已经完整写出的块编号集合（用于断点续跑）。
+    """
+    done = set()
+    for name in shard_names(spill_dir):
+        done.update(read_shard_index(os.path.join(spill_dir, f"{name}.idx"))['chunk'].tolist())
+    return done
+
+class ColumnarResult:
+    """
+    各工作进程分片中的结果，迭代时按块编号对所有分片做k路归并，
+    得到确定的拓扑顺序（或用 reversed 得到逆序）。
+    父进程同时只读取每个分片的一块，内存占用与仓库大小无关。
+    """
+
+    def __init__(self, schema, spill_dir):
+        self.schema = schema
+        self.spill_dir = spill_dir
+        self.shards = []
+        for name in shard_names(spill_dir):
+            self.shards.append((read_shard_index(os.path.join(spill_dir, f"{name}.idx")), os.path.join(spill_dir, f"{name}.data")))
+
+    def __len__(self):
+        return sum(int(index['rows'].sum()) for index, _ in self.shards)
+
+    def blocks(self, reverse=False):
+        """
+        按块编号归并所有分片，依次返回每块的 ColumnChunk。
+        """
+        def entries(shard, index):
+            positions = range(len(index) - 1, -1, -1) if reverse else range(len(index))
+            for i in positions:
+                yield int(index[i]['chunk']), shard, int(index[i]['offset'])
+
+        files = [open(data_path, 'rb') for _, data_path in self.shards]
+        try:
+            last = None
+            for chunk_id, shard, offset in heapq.merge(*(entries(shard, index) for shard, (index, _) in enumerate(self.shards)),
+                                                       reverse=reverse):
+                if chunk_id == last:
+                    continue
+                last = chunk_id
+                files[shard].seek(offset)
+                yield ColumnChunk(self.schema, files[shard])
+        finally:
+            for inp in files:
+                inp.close()
+
+    def __iter__(self):
+        for chunk in self.blocks():
+            for i in range(len(chunk)):
+                yield chunk.row(i)
+
+    def __reversed__(self):
+        for chunk in self.blocks(reverse=True):
+            for i in reversed(range(len(chunk))):
+                yield chunk.row(i)
+
+    def column(self, name):
+        """
+        返回某一列在所有块中的值（整列读入内存），数值列拼接为一个 numpy 数组，OID 列为 (n, 20) 的数组。
+        """
+        parts = [chunk.column(name) for chunk in self.blocks()]
+        kind = dict(self.schema)[name]
+        if kind == STR:
+            return [value for part in parts for value in part]
+        if kind == OID:
+            return np.concatenate(parts) if parts else np.zeros((0, 20), dtype=np.uint8)
+        return np.concatenate(parts) if parts else np.zeros(0)
+
+    def cleanup(self):
+        """
+        删除溢出目录。
+        """
+        self.shards = []
+        if self.spill_dir and os.path.exists(self.spill_dir):
+            shutil.rmtree(self.spill_dir)
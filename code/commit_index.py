@@ -0,0 +1,207 @@
+import json
+import os
+import shutil
+import sys
+import time
+
+from argparse import ArgumentParser
+import numpy as np
+from pygit2 import Repository, GIT_SORT_TOPOLOGICAL, GIT_SORT_REVERSE
+from tqdm import tqdm
+
+# 全局后缀变量
+suffix_num = "1"
+suffix_repo = "z3"
+suffix_branch = "master"
+suffix_file = "z3_data"
+
+# 索引格式版本，格式变化时递增，旧索引会被重建（2: 增加 committer_id）
+INDEX_VERSION = 2
+
+def hashes_to_oids(commit_hashes):
+    """
+    将40位十六进制的commit_hash转换为20字节的二进制oid数组（dtype S20）。
+    无法解析的哈希被转换为空值，查找时视为不存在。
+    """
+    oids = []
+    for commit_hash in commit_hashes:
+        try:
+            oids.append(bytes.fromhex(commit_hash))
+        except (TypeError, ValueError):
+            oids.append(b"")
+    return np.array(oids, dtype='S20')
+
+class CommitIndex:
+    """
+    按拓扑顺序（GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE）存储的提交索引，
+    所有数组均以只读 mmap 方式打开，可被多个进程共享。
+
+    oids          (N, 20) uint8  每个提交的二进制oid
+    order         (N,)    int64  按oid排序后的位置，用于二分查找
+    parent_offsets (N+1,) int64  parents 数组中每个提交的起止位置
+    parents       (M,)    int64  父提交的拓扑位置
+    author_time   (N,)    int64
+    commit_time   (N,)    int64
+    author_id     (N,)    int32  authors.json 中的作者下标
+    committer_id  (N,)    int32  authors.json 中的提交者下标（没有提交者时为 "Unknown"）
+
+    authors.json 是作者和提交者共用的名字表。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r') as inp:
+            self.meta = json.load(inp)
+        with open(os.path.join(path, "authors.json"), 'r') as inp:
+            self.authors = json.load(inp)
+        for name in ["oids", "order", "parent_offsets", "parents", "author_time", "commit_time", "author_id", "committer_id"]:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r'))
+        self._sorted_oids = None
+
+    def __len__(self):
+        return len(self.oids)
+
+    @property
+    def tip(self):
+        return self.meta['tip']
+
+    def hex(self, pos):
+        return self.oids[pos].tobytes().hex()
+
+    def hexes(self, positions=None):
+        if positions is None:
+            positions = range(len(self))
+        return [self.hex(pos) for pos in positions]
+
+    def parent_positions(self, pos):
+        return self.parents[self.parent_offsets[pos]:self.parent_offsets[pos + 1]]
+
+    def positions(self, commit_hashes):
+        """
+        批量查找commit_hash对应的拓扑位置，不存在的返回 -1。
+        """
+        if self._sorted_oids is None:
+            self._sorted_oids = np.asarray(self.oids).view('S20').reshape(-1)[self.order]
+        wanted = hashes_to_oids(commit_hashes)
+        if len(self) == 0 or len(wanted) == 0:
+            return np.full(len(wanted), -1, dtype=np.int64)
+        idx = np.searchsorted(self._sorted_oids, wanted)
+        idx[idx >= len(self)] = 0
+        found = self._sorted_oids[idx] == wanted
+        return np.where(found, np.asarray(self.order)[idx], -1)
+
+    def committers(self, positions):
+        """
+        批量返回拓扑位置对应的提交者名字，位置为 -1 时返回 None。
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        ids = np.full(len(positions), -1, dtype=np.int64)
+        found = positions >= 0
+        ids[found] = np.asarray(self.committer_id)[positions[found]]
+        return [self.authors[i] if i >= 0 else None for i in ids]
+
+    def select(self, commit_hashes):
+        """
+        返回commit_hashes中存在于索引内的提交位置，按拓扑顺序排列。
+        """
+        positions = self.positions(list(commit_hashes))
+        return np.unique(positions[positions >= 0])
+
+def report_misses(misses, reason, limit=5):
+    """
+    对一类缺失的提交只输出一行汇总（附前几个哈希）。
+    """
+    if misses:
+        examples = ", ".join(str(commit_hash) for commit_hash in misses[:limit])
+        more = f" and {len(misses) - limit} more" if len(misses) > limit else ""
+        print(f"{len(misses)} commits {reason}: {examples}{more}")
+
+def build_commit_index(repo_path, branch, index_root):
+    """
+    遍历一次分支历史，生成以分支tip命名的提交索引目录。
+    """
+    repo = Repository(repo_path)
+    head = repo.references.get(branch)
+    tip = str(head.target)
+    path = os.path.join(index_root, tip)
+
+    oids = []
+    parent_ids = []
+    author_time = []
+    commit_time = []
+    author_id = []
+    committer_id = []
+    authors = {}
+
+    start_time = time.time()
+    for commit in tqdm(repo.walk(head.target, GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE)):
+        oids.append(commit.id.raw)
+        parent_ids.append([p.raw for p in commit.parent_ids])
+        author_time.append(commit.author.time)
+        commit_time.append(commit.commit_time)
+        author_id.append(authors.setdefault(commit.author.name, len(authors)))
+        committer = commit.committer.name if commit.committer is not None else "Unknown"
+        committer_id.append(authors.setdefault(committer, len(authors)))
+
+    position = {oid: i for i, oid in enumerate(oids)}
+    parent_offsets = np.zeros(len(oids) + 1, dtype=np.int64)
+    parent_offsets[1:] = np.cumsum([len(p) for p in parent_ids])
+    parents = np.array([position[p] for ps in parent_ids for p in ps], dtype=np.int64)
+
+    oid_array = np.frombuffer(b"".join(oids), dtype=np.uint8).reshape(-1, 20)
+    order = np.argsort(oid_array.view('S20').reshape(-1), kind='stable').astype(np.int64)
+
+    # 先写入临时目录再原子替换，避免其他进程读到不完整的索引
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, "oids.npy"), oid_array)
+    np.save(os.path.join(tmp_path, "order.npy"), order)
+    np.save(os.path.join(tmp_path, "parent_offsets.npy"), parent_offsets)
+    np.save(os.path.join(tmp_path, "parents.npy"), parents)
+    np.save(os.path.join(tmp_path, "author_time.npy"), np.array(author_time, dtype=np.int64))
+    np.save(os.path.join(tmp_path, "commit_time.npy"), np.array(commit_time, dtype=np.int64))
+    np.save(os.path.join(tmp_path, "author_id.npy"), np.array(author_id, dtype=np.int32))
+    np.save(os.path.join(tmp_path, "committer_id.npy"), np.array(committer_id, dtype=np.int32))
+    with open(os.path.join(tmp_path, "authors.json"), 'w') as output:
+        json.dump(list(authors), output)
+    with open(os.path.join(tmp_path, "meta.json"), 'w') as output:
+        json.dump({"version": INDEX_VERSION, "branch": branch, "tip": tip, "count": len(oids)}, output)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+    end_time = time.time()
+    print(f"Commit index with {len(oids)} commits written to {path} in {end_time - start_time} seconds")
+    return CommitIndex(path)
+
+def open_commit_index(repo_path, branch, index_root=f"./{suffix_file}/commit_index"):
+    """
+    打开分支当前tip对应的提交索引，不存在或版本过旧时重新生成。
+    """
+    repo = Repository(repo_path)
+    head = repo.references.get(branch)
+    path = os.path.join(index_root, str(head.target))
+
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as inp:
+            if json.load(inp).get("version") == INDEX_VERSION:
+                return CommitIndex(path)
+
+    return build_commit_index(repo_path, branch, index_root)
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="Build the on-disk commit index for a branch.")
+    PARSER.add_argument("--repository", "-r", type=str, default=f"/home/WangZiyang/szz/{suffix_repo}", help="Path to local git repository.")
+    PARSER.add_argument("--branch", "-b", type=str, default=f"refs/heads/{suffix_branch}", help="Which branch to use.")
+    PARSER.add_argument("--index-root", "-i", type=str, default=f"./{suffix_file}/commit_index", help="Directory where commit indexes are stored.")
+
+    ARGS = PARSER.parse_args()
+
+    if not os.path.exists(ARGS.repository):
+        print("The repository path does not exist!")
+        sys.exit(1)
+
+    INDEX = open_commit_index(ARGS.repository, ARGS.branch, ARGS.index_root)
+    print(f"{len(INDEX)} commits, tip {INDEX.tip}")
@@ -0,0 +1,442 @@
+import json
+import os
+import shutil
+import sys
+import time
+
+from argparse import ArgumentParser
+from array import array
+from collections import namedtuple
+from functools import partial
+import numpy as np
+import instrument
+from pygit2 import GIT_DIFF_FIND_RENAMES
+from columnar import INT, OID, STR
+from commit_index import CommitIndex, open_commit_index
+from scheduler import run_stage
+
+# 全局后缀变量
+suffix_num = "1"
+suffix_repo = "z3"
+suffix_branch = "master"
+suffix_file = "z3_data"
+
+# 存储格式版本，格式或内容的计算方式变化时递增，旧的存储会被重建（3: 大提交的估计只用文本文件的平均值）
+DIFFSTAT_VERSION = 3
+
+# 每个提交相对于第一个父提交修改的一个文件
+DiffEntry = namedtuple('DiffEntry', ['path', 'old_path', 'old_oid', 'new_oid', 'status', 'additions', 'deletions', 'binary'])
+
+# 工作进程返回的每行结果（一个文件一行）
+DIFFSTAT_SCHEMA = [
+    ("commit_hash", STR), ("path", STR), ("old_path", STR), ("old_oid", OID), ("new_oid", OID),
+    ("status", INT), ("additions", INT), ("deletions", INT), ("binary", INT), ("large_commit", INT)
+]
+
+# 工作进程内打开的存储，由 init_worker_store 设置
+_STORE = None
+
+# 重命名检测最多比较的候选文件数，0 表示不做重命名检测（与原先的 repo.diff 一致）
+RENAME_LIMIT = 0
+
+# 大提交的处理结果，输出到各阶段的 large_commit 列
+LARGE_NONE = 0         # 正常计算
+LARGE_APPROXIMATE = 1  # 只对 sample_files 个文件计算行数，其余按平均值估计
+LARGE_SKIPPED = 2      # 只保留文件列表，不计算行数（la/ld/lt 为 0）
+LARGE_TIMEOUT = 3      # 超过 time_budget 秒后停止，剩余文件按已计算文件的平均值估计
+
+# 启用大提交保护时各阶段输出的附加列
+LARGE_COMMIT_SCHEMA = [("large_commit", INT)]
+
+# 大提交保护：修改文件数（diff 的 delta 数）超过 max_files 的提交按 mode 处理，max_files 为 0 时不启用。
+# mode 为 approximate、skip 或 timeout（在 time_budget 秒内尽量精确计算）
+LargeCommitGuard = namedtuple('LargeCommitGuard', ['max_files', 'mode', 'sample_files', 'time_budget'])
+NO_GUARD = LargeCommitGuard(0, "approximate", 200, 30.0)
+GUARD = NO_GUARD
+
+def diff_stats(repo, commit, parent=None, rename_limit=None, guard=None):
+    """
+    只统计行数的diff：context_lines=0，逐个文件读取 line_stats 后立即丢弃patch，
+    不保留 patches 列表，也不访问 hunk 和行对象。
+    parent 为 None 时与空树比较（根提交）。rename_limit 为 0 时不做重命名检测，
+    否则最多在 rename_limit 个候选文件之间检测重命名；为 None 时使用 RENAME_LIMIT。
+    guard 为 LargeCommitGuard，为 None 时使用 GUARD；delta 数超过 guard.max_files 时
+    不生成全部patch（也不做重命名检测），见 large_commit_stats。
+    返回按列的普通数组：
+    path, old_path, old_oid, new_oid 为列表（oid 为20字节），
+    status, additions, deletions, binary 为 array，large_commit 为 LARGE_* 之一。
+    """
+    guard = GUARD if guard is None else guard
+    stats = {
+        'path': [], 'old_path': [], 'old_oid': [], 'new_oid': [],
+        'status': array('b'), 'additions': array('i'), 'deletions': array('i'), 'binary': array('b'),
+        'large_commit': LARGE_NONE,
+    }
+    with instrument.timed("diff_seconds"):
+        if parent is not None:
+            diff = repo.diff(parent, commit, context_lines=0, interhunk_lines=0)
+        else:
+            diff = commit.tree.diff_to_tree(context_lines=0, interhunk_lines=0, swap=True)
+
+        # 只生成了delta（文件列表），还没有读取blob内容
+        if guard.max_files and len(diff) > guard.max_files:
+            large_commit_stats(diff, stats, guard)
+            instrument.add("files", len(stats['path']))
+            return stats
+
+        rename_limit = RENAME_LIMIT if rename_limit is None else rename_limit
+        if rename_limit:
+            diff.find_similar(GIT_DIFF_FIND_RENAMES, rename_limit=rename_limit)
+
+        for patch in diff:
+            delta = patch.delta
+            _, additions, deletions = patch.line_stats
+            stats['path'].append(delta.new_file.path)
+            stats['old_path'].append(delta.old_file.path)
+            stats['old_oid'].append(delta.old_file.id.raw)
+            stats['new_oid'].append(delta.new_file.id.raw)
+            stats['status'].append(delta.status)
+            stats['additions'].append(additions)
+            stats['deletions'].append(deletions)
+            stats['binary'].append(delta.is_binary)
+    instrument.add("files", len(stats['path']))
+    return stats
+
+def sample_positions(count, sample_files):
+    """
+    从 count 个文件中均匀选出最多 sample_files 个的下标，结果可复现。
+    """
+    if count <= sample_files:
+        return list(range(count))
+    return sorted(set(i * count // sample_files for i in range(sample_files)))
+
+def guarded_compute(count, guard, compute):
+    """
+    大提交中按 guard.mode 选出要精确计算的文件，依次调用 compute(i)。
+    skip 不计算任何文件；approximate 只计算 sample_positions 选出的文件；
+    timeout 按顺序计算，超过 guard.time_budget 秒后停止。
+    返回 (已计算的下标列表, LARGE_* 标记)，全部文件都计算了时标记为 LARGE_NONE。
+    guarded_sum 和 large_commit_stats 共用这个循环，两种估计使用相同的文件。
+    """
+    if guard.mode == "skip":
+        return [], LARGE_SKIPPED
+    if guard.mode == "timeout":
+        positions = range(count)
+        deadline = time.perf_counter() + guard.time_budget
+    else:
+        positions = sample_positions(count, guard.sample_files)
+        deadline = None
+
+    computed = []
+    for i in positions:
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+        compute(i)
+        computed.append(i)
+    if len(computed) == count:
+        return computed, LARGE_NONE
+    return computed, LARGE_TIMEOUT if deadline is not None else LARGE_APPROXIMATE
+
+def guarded_sum(count, guard, value):
+    """
+    大提交中按 guard.mode 只对一部分文件调用 value(i)，按比例估计 count 个文件的总和。
+    返回 (总和, LARGE_* 标记)，全部文件都计算了时标记为 LARGE_NONE。
+    """
+    values = []
+    computed, flag = guarded_compute(count, guard, lambda i: values.append(value(i)))
+    total = sum(values)
+    if flag == LARGE_NONE:
+        return total, flag
+    return (round(total * count / len(computed)) if computed else 0), flag
+
+def large_commit_stats(diff, stats, guard):
+    """
+    大提交：文件列表直接取自delta；行数按 guard.mode 只计算一部分文件，
+    其余文件的增删行数取已计算的文本文件的平均值，结果写入 stats。
+    是否二进制只有生成patch后才知道（读取 delta.is_binary 会让 pygit2 读取blob并生成patch），
+    未计算的文件记为非二进制。
+    """
+    count = len(diff)
+    for delta in diff.deltas:
+        stats['path'].append(delta.new_file.path)
+        stats['old_path'].append(delta.old_file.path)
+        stats['old_oid'].append(delta.old_file.id.raw)
+        stats['new_oid'].append(delta.new_file.id.raw)
+        stats['status'].append(delta.status)
+    stats['additions'] = array('i', [0] * count)
+    stats['deletions'] = array('i', [0] * count)
+    stats['binary'] = array('b', [0] * count)
+
+    def compute(i):
+        patch = diff[i]
+        _, stats['additions'][i], stats['deletions'][i] = patch.line_stats
+        stats['binary'][i] = patch.delta.is_binary
+
+    computed, stats['large_commit'] = guarded_compute(count, guard, compute)
+    text = [i for i in computed if not stats['binary'][i]]
+    if stats['large_commit'] == LARGE_NONE or not text:
+        return
+    done = set(computed)
+    additions = round(sum(stats['additions'][i] for i in text) / len(text))
+    deletions = round(sum(stats['deletions'][i] for i in text) / len(text))
+    for i in range(count):
+        if i not in done:
+            stats['additions'][i] = additions
+            stats['deletions'][i] = deletions
+
+def stats_entries(stats):
+    """
+    把 diff_stats 的按列结果转换为 DiffEntry 列表。
+    """
+    return [DiffEntry(*values[:7], bool(values[7])) for values in zip(
+        stats['path'], stats['old_path'], stats['old_oid'], stats['new_oid'],
+        stats['status'], stats['additions'], stats['deletions'], stats['binary'])]
+
+def compute_entries(repo, commit, rename_limit=None):
+    """
+    直接调用libgit2计算提交相对于第一个父提交修改的文件列表。
+    """
+    return stats_entries(diff_stats(repo, commit, commit.parents[0] if commit.parents else None, rename_limit))
+
+def parse_diffstat(repo, commit):
+    """
+    由调度器在工作进程中调用，返回一个提交的多行结果。
+    """
+    commit_hash = str(commit.id)
+    stats = diff_stats(repo, commit, commit.parents[0] if commit.parents else None)
+    return [[commit_hash] + list(values) + [stats['large_commit']] for values in zip(
+        stats['path'], stats['old_path'], stats['old_oid'], stats['new_oid'],
+        stats['status'], stats['additions'], stats['deletions'], stats['binary'])]
+
+def set_rename_limit(rename_limit, guard=None):
+    """
+    设置工作进程中的 RENAME_LIMIT（以及大提交保护 GUARD），作为调度器的 setup 使用。
+    """
+    global RENAME_LIMIT
+    RENAME_LIMIT = rename_limit
+    if guard is not None:
+        set_guard(guard)
+
+def set_guard(guard):
+    global GUARD
+    GUARD = guard if guard is not None else NO_GUARD
+
+def guard_enabled():
+    return GUARD.max_files > 0
+
+def add_guard_arguments(parser):
+    """
+    各阶段共用的大提交保护参数。
+    """
+    parser.add_argument("--max-files", type=int, default=0, help="修改文件数超过该值的提交视为大提交，0 表示不启用")
+    parser.add_argument("--large-mode", choices=["approximate", "skip", "timeout"], default="approximate",
+                        help="大提交的处理方式：按抽样估计行数、不计算行数，或在 --time-budget 秒内尽量计算")
+    parser.add_argument("--sample-files", type=int, default=200, help="approximate 时计算行数的文件数")
+    parser.add_argument("--time-budget", type=float, default=30.0, help="timeout 时每个大提交计算行数的秒数")
+
+def guard_from_args(args):
+    return LargeCommitGuard(args.max_files, args.large_mode, args.sample_files, args.time_budget)
+
+class DiffStatStore:
+    """
+    以只读 mmap 方式打开的diff统计存储，提交位置与同一tip的提交索引一致。
+
+    offsets    (N+1,)   int64  每个提交的文件行范围
+    path       (M,)     int32  paths.json 中的下标
+    old_path   (M,)     int32
+    old_oid    (M, 20)  uint8
+    new_oid    (M, 20)  uint8
+    status     (M,)     uint8  pygit2 的 GIT_DELTA_* 值
+    additions  (M,)     int32
+    deletions  (M,)     int32
+    binary     (M,)     bool
+    large_commit (N,)   uint8  每个提交的 LARGE_* 标记
+    """
+
+    def __init__(self, path, index=None):
+        self.path = path
+        self.index = index
+        with open(os.path.join(path, "meta.json"), 'r') as inp:
+            self.meta = json.load(inp)
+        with open(os.path.join(path, "paths.json"), 'r') as inp:
+            self.paths = json.load(inp)
+        for name in ["offsets", "path", "old_path", "old_oid", "new_oid", "status", "additions", "deletions", "binary", "large_commit"]:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def tip(self):
+        return self.meta['tip']
+
+    def entries(self, pos):
+        """
+        返回拓扑位置 pos 处的提交修改的文件列表。
+        """
+        start, end = int(self.offsets[pos]), int(self.offsets[pos + 1])
+        instrument.add("files", end - start)
+        return [DiffEntry(self.paths[self.path[i]], self.paths[self.old_path[i]], self.old_oid[i].tobytes(),
+                          self.new_oid[i].tobytes(), int(self.status[i]), int(self.additions[i]),
+                          int(self.deletions[i]), bool(self.binary[i]))
+                for i in range(start, end)]
+
+    def changed_paths(self, pos):
+        """
+        返回拓扑位置 pos 处的提交修改的非二进制文件路径，只读取 path 和 binary 两列。
+        """
+        start, end = int(self.offsets[pos]), int(self.offsets[pos + 1])
+        instrument.add("files", end - start)
+        keep = ~np.asarray(self.binary[start:end])
+        return [self.paths[i] for i in np.asarray(self.path[start:end])[keep]]
+
+    def position(self, commit_hash):
+        if self.index is None:
+            return -1
+        return int(self.index.positions([commit_hash])[0])
+
+def store_path(store_root, tip):
+    return os.path.join(store_root, tip)
+
+def build_diffstats(repo_path, index, store_root=f"./{suffix_file}/diffstat", processes=None, chunk_size=8, rename_limit=0, guard=None,
+                    checkpoint_dir=None):
+    """
+    对索引中的每个提交计算一次diff统计，写入以索引tip命名的目录。
+    rename_limit 与 guard（大提交保护）见 diff_stats，会记录在 meta.json 中；checkpoint_dir 为断点目录（见 scheduler.run_stage）。
+    """
+    guard = guard or NO_GUARD
+    path = store_path(store_root, index.tip)
+    start_time = time.time()
+
+    result = run_stage(parse_diffstat, repo_path, index, range(len(index)), DIFFSTAT_SCHEMA, processes, chunk_size,
+                       setup=partial(set_rename_limit, rename_limit, guard), multi_row=True, checkpoint_dir=checkpoint_dir)
+
+    # 逐块读取结果，提交位置和路径编码按块计算，数值列直接写入 .npy，不把整列读入内存
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    rows = len(result)
+    columns = {}
+    for name, dtype, shape in [("path", np.int32, (rows,)), ("old_path", np.int32, (rows,)), ("old_oid", np.uint8, (rows, 20)),
+                               ("new_oid", np.uint8, (rows, 20)), ("status", np.uint8, (rows,)), ("additions", np.int32, (rows,)),
+                               ("deletions", np.int32, (rows,)), ("binary", bool, (rows,))]:
+        columns[name] = np.lib.format.open_memmap(os.path.join(tmp_path, f"{name}.npy"), mode='w+', dtype=dtype, shape=shape)
+    counts = np.zeros(len(index), dtype=np.int64)
+    large_commit = np.zeros(len(index), dtype=np.uint8)
+    # 新旧路径共用一个字典
+    paths = {}
+    start = 0
+    for chunk in result.blocks():
+        end = start + len(chunk)
+        positions = index.positions(chunk.column("commit_hash"))
+        np.add.at(counts, positions, 1)
+        np.maximum.at(large_commit, positions, chunk.column("large_commit").astype(np.uint8))
+        for name in ("path", "old_path"):
+            columns[name][start:end] = [paths.setdefault(p, len(paths)) for p in chunk.column(name)]
+        for name in ("old_oid", "new_oid", "status", "additions", "deletions", "binary"):
+            columns[name][start:end] = chunk.column(name)
+        start = end
+    for column in columns.values():
+        column.flush()
+    del columns
+    offsets = np.zeros(len(index) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+    np.save(os.path.join(tmp_path, "large_commit.npy"), large_commit)
+    with open(os.path.join(tmp_path, "paths.json"), 'w') as output:
+        json.dump(list(paths), output)
+    with open(os.path.join(tmp_path, "meta.json"), 'w') as output:
+        json.dump({"version": DIFFSTAT_VERSION, "tip": index.tip, "count": len(index), "files": int(offsets[-1]), "rename_limit": rename_limit,
+                   "guard": guard._asdict(), "large_commits": int(np.count_nonzero(large_commit))}, output)
+    result.cleanup()
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+    end_time = time.time()
+    print(f"Diff stats for {len(index)} commits ({int(offsets[-1])} files) written to {path} in {end_time - start_time} seconds")
+    return DiffStatStore(path, index)
+
+def find_diffstats(store_root, index):
+    """
+    返回与提交索引同一tip的diff统计存储路径，不存在或版本过旧时返回 None。
+    """
+    if not store_root:
+        return None
+    path = store_path(store_root, index.tip)
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as inp:
+        if json.load(inp).get("version") != DIFFSTAT_VERSION:
+            return None
+    return path
+
+def open_diffstats(store_root, index):
+    path = find_diffstats(store_root, index)
+    return DiffStatStore(path, index) if path else None
+
+def init_worker_store(path, index_path, guard=None):
+    """
+    在工作进程启动时打开diff统计存储，path 为 None 时不使用存储；guard 为大提交保护设置。
+    """
+    global _STORE
+    _STORE = DiffStatStore(path, CommitIndex(index_path)) if path else None
+    set_guard(guard)
+
+def commit_diff(repo, commit, store=None):
+    """
+    返回 (提交相对于第一个父提交修改的文件列表, LARGE_* 标记)：优先从存储读取，
+    存储中没有该提交时再调用libgit2计算（使用工作进程中的 GUARD）。
+    """
+    store = store if store is not None else _STORE
+    if store is not None:
+        pos = store.position(str(commit.id))
+        if 0 <= pos < len(store):
+            return store.entries(pos), int(store.large_commit[pos])
+    stats = diff_stats(repo, commit, commit.parents[0] if commit.parents else None)
+    return stats_entries(stats), stats['large_commit']
+
+def effective_guard(guard, store_path):
+    """
+    阶段实际使用的大提交保护：优先使用阶段自己的 guard，否则沿用 store_path 处存储构建时的设置
+    （存储中的行数已经是估计值），都没有时为 NO_GUARD。启用时各阶段输出 large_commit 列。
+    """
+    if guard is not None and guard.max_files:
+        return guard
+    if store_path:
+        with open(os.path.join(store_path, "meta.json"), 'r') as inp:
+            stored = json.load(inp).get("guard")
+        if stored and stored.get("max_files"):
+            return LargeCommitGuard(**stored)
+    return NO_GUARD
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="对分支上的每个提交计算一次diff统计，供各特征阶段复用。")
+    PARSER.add_argument("--repository", "-r", type=str, default=f"/home/WangZiyang/szz/{suffix_repo}", help="Path to local git repository.")
+    PARSER.add_argument("--branch", "-b", type=str, default=f"refs/heads/{suffix_branch}", help="Which branch to use.")
+    PARSER.add_argument("--store-root", "-s", type=str, default=f"./{suffix_file}/diffstat", help="Directory where diff stats are stored.")
+    PARSER.add_argument("--processes", "-p", type=int, default=None, help="Number of worker processes, defaults to all CPUs.")
+    PARSER.add_argument("--chunk-size", type=int, default=8, help="Number of adjacent commits handed to a worker at a time.")
+    PARSER.add_argument("--rename-limit", type=int, default=0, help="重命名检测最多比较的候选文件数，0 表示不检测。")
+    PARSER.add_argument("--force", "-f", action="store_true", help="即使已存在也重新计算。")
+    add_guard_arguments(PARSER)
+    PARSER.add_argument("--checkpoint", type=str, default=None, help="断点目录：保留已完成的提交块，中断后重新运行同一命令时只处理剩余的提交")
+    PARSER.add_argument("--index-root", type=str, default=f"./{suffix_file}/commit_index", help="Directory where commit indexes are stored.")
+    PARSER.add_argument("--trace", type=str, default=None, help="Directory for per-commit timing and memory records, see instrument.py.")
+
+    ARGS = PARSER.parse_args()
+    if ARGS.trace:
+        instrument.enable(ARGS.trace, "diffstat")
+
+    if not os.path.exists(ARGS.repository):
+        print("The repository path does not exist!")
+        sys.exit(1)
+
+    INDEX = open_commit_index(ARGS.repository, ARGS.branch, ARGS.index_root)
+    if find_diffstats(ARGS.store_root, INDEX) and not ARGS.force:
+        print(f"Diff stats for {INDEX.tip} already exist")
+    else:
+        build_diffstats(ARGS.repository, INDEX, ARGS.store_root, ARGS.processes, ARGS.chunk_size, ARGS.rename_limit, guard_from_args(ARGS),
+                        ARGS.checkpoint)
@@ -0,0 +1,217 @@
+from array import array
+from datetime import datetime
+from numpy import floor
+
+# 作者经验图的格式版本：2 起记录 sexp，旧版本的图在 -sg 时重新构建
+EXPERIENCE_VERSION = 2
+
+def diffing_years(commit_time, last_time):
+    """
+    两次提交之间相差的整年数，与 003.py 原先的计算方式一致。
+    """
+    date_current = datetime.fromtimestamp(commit_time)
+    date_last = datetime.fromtimestamp(last_time)
+    return int(abs(floor(float((date_current - date_last).days) / 365)))
+
+def new_author():
+    """
+    单个作者的经验记录：按提交顺序保存的紧凑数组，以及增量计算 rexp 所需的状态。
+
+    commits  作者的提交（十六进制哈希）
+    times    每次提交的 commit_time
+    files    每次提交修改的文件数
+    rexp     每次提交时的 rexp 值
+    sexp     每次提交时的 sexp 值
+    years    到目前为止累计的年份差 S
+    buckets  [[S_k, 文件数之和], ...]，S_k 相同的历史提交合并为一个桶
+    subsystems  {子系统: 作者修改过该子系统的提交数}，用于增量计算 sexp
+    offset   未加载到内存中的更早提交数（增量更新时只加载最后一次提交）
+    stored   数组中前 stored 个提交已经持久化
+    """
+    return {
+        'commits': [],
+        'times': array('q'),
+        'files': array('q'),
+        'rexp': array('d'),
+        'sexp': array('d'),
+        'years': 0,
+        'buckets': [],
+        'subsystems': {},
+        'offset': 0,
+        'stored': 0,
+    }
+
+def commit_subsystems(paths):
+    """
+    提交修改的子系统：文件路径的第一级目录，与 002.py 中 nd 的模块定义相同，根目录下的文件不属于任何子系统。
+    """
+    return set(path.split('/', 1)[0] for path in paths if '/' in path)
+
+def add_files(author, nfiles):
+    """
+    把一次提交的文件数加入当前累计年份差 author['years'] 对应的桶，返回本次提交的 rexp。
+    """
+    years = author['years']
+    buckets = author['buckets']
+    if buckets and buckets[-1][0] == years:
+        buckets[-1][1] += nfiles
+    else:
+        buckets.append([years, nfiles])
+
+    rexp = 0.0
+    for bucket_years, files in reversed(buckets):
+        rexp += float(files) / (years - bucket_years + 2)
+    return rexp
+
+def add_commit(author, commit_id, commit_time, nfiles, subsystems=()):
+    """
+    记录作者的一次新提交，返回 (exp, rexp, sexp)。
+
+    原实现对每个提交复制作者的全部历史 [[files, years], ...]，并把每一项的
+    years 加上本次的年份差。这里等价地只维护累计年份差 S：第 k 次提交在当前
+    的 years 为 1 + S - S_k，因此 rexp = sum(files_k / (S - S_k + 2))。
+    S 只在两次提交相隔一年以上时增加，S_k 相同的提交合并在同一个桶里，
+    每次提交只需追加一个元素并遍历少量的桶。
+    sexp 为作者在本次修改的各子系统（commit_subsystems）中的提交数之和，与 exp 一样包括本次提交；
+    每个子系统只更新一个计数。
+    """
+    if author['commits']:
+        author['years'] += diffing_years(commit_time, author['times'][-1])
+
+    rexp = add_files(author, nfiles)
+
+    counts = author['subsystems']
+    sexp = 0
+    for subsystem in subsystems:
+        counts[subsystem] = counts.get(subsystem, 0) + 1
+        sexp += counts[subsystem]
+
+    author['commits'].append(commit_id)
+    author['times'].append(commit_time)
+    author['files'].append(nfiles)
+    author['rexp'].append(rexp)
+    author['sexp'].append(sexp)
+    return author['offset'] + len(author['commits']), rexp, float(sexp)
+
+def replace_commits(author, commits, times, files, sexp):
+    """
+    用完整的提交序列替换作者记录，并从头重算 years、桶和每次提交的 rexp（sexp 与子系统计数不变）。
+    """
+    author['commits'] = list(commits)
+    author['times'] = array('q', times)
+    author['files'] = array('q', files)
+    author['sexp'] = array('d', sexp)
+    author['rexp'] = array('d')
+    author['years'] = 0
+    author['buckets'] = []
+    author['offset'] = 0
+    author['stored'] = 0
+    author.pop('positions', None)
+    for i, nfiles in enumerate(author['files']):
+        if i:
+            author['years'] += diffing_years(author['times'][i], author['times'][i - 1])
+        author['rexp'].append(add_files(author, nfiles))
+
+def move_seed(all_authors, old_tip, old_committer, new_tip, new_committer, commit_time, nfiles):
+    """
+    完整建图时 tip 的提交者先记一次修改了初始文件的提交（见 003.py），它影响该作者之后所有提交的 exp/rexp。
+    增量更新到新的 tip 时把这条初始记录从 old_tip 移到 new_tip，结果与在新 tip 上完整建图相同；
+    只有这两个提交者的记录需要重算，调用前它们必须已完整加载（offset 为 0）。
+    图不是以 old_tip 为初始提交时抛出 ValueError。
+    """
+    old = all_authors.get(old_committer)
+    if old is None or old['offset'] or not old['commits'] or old['commits'][0] != old_tip:
+        raise ValueError(f"the author graph is not seeded at {old_tip}")
+    replace_commits(old, old['commits'][1:], old['times'][1:], old['files'][1:], old['sexp'][1:])
+
+    if new_committer not in all_authors:
+        all_authors[new_committer] = new_author()
+    new = all_authors[new_committer]
+    if new['offset']:
+        raise ValueError(f"the commits of {new_committer} are not fully loaded")
+    replace_commits(new, [new_tip] + new['commits'], [commit_time] + list(new['times']), [nfiles] + list(new['files']),
+                    [0.0] + list(new['sexp']))
+
+def to_json(author):
+    return {
+        'commits': author['commits'],
+        'times': author['times'].tolist(),
+        'files': author['files'].tolist(),
+        'rexp': author['rexp'].tolist(),
+        'sexp': author['sexp'].tolist(),
+        'years': author['years'],
+        'buckets': author['buckets'],
+        'subsystems': author['subsystems'],
+    }
+
+def convert_old_author(data):
+    """
+    把旧版 003.py 保存的单个作者记录 {"lastcommit": ..., <提交>: {"prevcommit", "exp", "rexp", "sexp"}}
+    转换为紧凑数组。最后一次提交的 rexp 列表 [[files, years], ...]（最新的在前）包含作者所有提交的
+    文件数和年份差，据此重算每次提交的 rexp 和桶状态；提交id沿 prevcommit 链得到。
+    旧格式没有提交时间（times 记为 0）和 sexp（记为 0），也没有记录tip，转换后的图在 -sg 时会完整重建。
+    """
+    entries = data[data['lastcommit']]['rexp']
+    commits = []
+    commit_id = data['lastcommit']
+    # 链的长度以 rexp 列表为准：分支tip作为初始提交出现两次时，它的第一条记录已被覆盖
+    for _ in entries:
+        commits.append(commit_id)
+        commit_id = data[commit_id]['prevcommit'] if commit_id in data else ""
+    commits.reverse()
+
+    # 第 k 次提交的项为 [files_k, 1 + S - S_k]，取第一次提交的 S 为 0
+    author = new_author()
+    first_years = int(entries[-1][1])
+    for commit_id, (nfiles, years) in zip(commits, reversed(entries)):
+        nfiles = int(nfiles)
+        author['years'] = first_years - int(years)
+        rexp = add_files(author, nfiles)
+        author['commits'].append(commit_id)
+        author['times'].append(0)
+        author['files'].append(nfiles)
+        author['rexp'].append(rexp)
+        author['sexp'].append(0.0)
+    return author
+
+def from_json(data):
+    if 'commits' not in data:
+        if 'lastcommit' not in data:
+            raise ValueError("unknown author graph layout, rebuild the graph with -sg")
+        return convert_old_author(data)
+    author = new_author()
+    author['commits'] = data['commits']
+    author['times'] = array('q', data['times'])
+    author['files'] = array('q', data['files'])
+    author['rexp'] = array('d', data['rexp'])
+    # 没有 sexp 的旧图按 0 读取（重新用 -sg 建图后才有 sexp）
+    author['sexp'] = array('d', data.get('sexp', [0.0] * len(data['commits'])))
+    author['years'] = data['years']
+    author['buckets'] = data['buckets']
+    author['subsystems'] = data.get('subsystems', {})
+    return author
+
+def lookup(author, commit_id):
+    """
+    返回作者在 commit_id 时的 (exp, rexp, sexp)，不存在时抛出 KeyError。
+    同一提交出现多次时以最后一次为准。
+    """
+    if 'positions' not in author:
+        author['positions'] = {c: i for i, c in enumerate(author['commits'])}
+    i = author['positions'][commit_id]
+    return author['offset'] + i + 1, author['rexp'][i], author['sexp'][i]
+
+def graph_to_json(all_authors, tip=None, seed_files=None):
+    """
+    整个作者经验图的 JSON 形式，tip 为构建图时的分支tip，seed_files 为初始文件的模式（见 tree_files.py）。
+    """
+    return {'tip': tip, 'version': EXPERIENCE_VERSION, 'seed_files': seed_files,
+            'authors': {author: to_json(data) for author, data in all_authors.items()}}
+
+def graph_from_json(data):
+    """
+    从 JSON 读取整个作者经验图，兼容没有记录tip的格式和旧版 003.py 按提交保存的格式（见 convert_old_author）。
+    """
+    if isinstance(data.get('tip'), (str, type(None))) and isinstance(data.get('authors'), dict) and 'commits' not in data['authors']:
+        data = data['authors']
+    return {author: from_json(value) for author, value in data.items()}
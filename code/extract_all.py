@@ -0,0 +1,346 @@
+import csv
+import os
+import sys
+import time
+
+from argparse import ArgumentParser
+from feature_io import NA_VALUES, TableWriter
+import numpy as np
+from numpy import log2
+from pygit2 import Oid, Repository
+from commit_index import open_commit_index, report_misses
+from diffstat import LARGE_NONE, NO_GUARD, add_guard_arguments, diff_stats, guard_from_args, guarded_sum
+from message_labels import DEFAULT_LABELER, MessageLabeler, load_keywords
+from loc_cache import LocCache, count_lines
+import experience
+import history
+from tree_files import DEFAULT_PATTERNS, tree_files
+from tqdm import tqdm
+import instrument
+
+# 全局后缀变量
+suffix_num = "1"
+suffix_repo = "z3"
+suffix_branch = "master"
+suffix_file = "z3_data"
+
+# 与 merge.py 相同的列顺序
+columns_order = [
+    'project', 'parent_hashes', 'commit_hash', 'author_name', 'author_email',
+    'author_date', 'author_date_unix_timestamp', 'commit_message', 'la', 'ld',
+    'fileschanged', 'nf', 'ns', 'nd', 'entropy', 'ndev', 'lt', 'nuc', 'age',
+    'exp', 'rexp', 'sexp', 'classification', 'fix', 'is_buggy_commit'
+]
+
+
+def load_commit_hashes_from_csv(csv_file_path):
+    """
+    从CSV文件中加载commit_hash列。
+    """
+    commit_hashes = set()  # 使用set避免重复
+    with open(csv_file_path, 'r') as file:
+        reader = csv.DictReader(file)
+        for row in reader:
+            commit_hashes.add(row['commit_hash'])
+    return commit_hashes
+
+def format_author_date(author_time, author_offset):
+    """
+    格式化author_date为类似 'Tue Sep 2 20:13:38 2008 +0000' 的格式。
+    """
+    formatted_time = time.strftime("%a %b %d %H:%M:%S %Y", time.gmtime(author_time))
+    hours_offset = author_offset // 60
+    timezone_offset = f"{hours_offset:+03d}00"
+    return f"{formatted_time} {timezone_offset}"
+
+def count_diffing_subsystems(subsystems):
+    """
+    计算提交中变更的子系统数量。
+    """
+    number = 0
+    for system in subsystems.values():
+        number += count_diffing_subsystems(system)
+    return number + len(subsystems.keys())
+
+def count_entropy(file_changes, total_change):
+    """
+    计算文件修改的熵。
+    """
+    if total_change == 0:
+        return 0
+    return sum([
+        -1 * (float(x) / total_change) * (log2(float(x) / total_change) if x > 0 else 0)
+        for x in file_changes
+    ])
+
+def get_file_lines_of_code(repo, old_oid, loc_cache=None):
+    """
+    计算给定文件修改前的代码行数（同 006.py），old_oid 为20字节的blob id。
+    """
+    if old_oid == b'\0' * 20:
+        return 0
+    if loc_cache is not None:
+        return loc_cache.lines(repo, old_oid)
+    try:
+        return count_lines(repo[Oid(raw=old_oid)])
+    except Exception:
+        return 0
+
+def get_committer_name(commit):
+    if commit.committer is not None:
+        return commit.committer.name
+    return "Unknown"
+
+def seed_graphs(repo, tip, seed_patterns=DEFAULT_PATTERNS, tree_cache=None):
+    """
+    与 003/004 完全建图时一样，以分支tip中匹配 seed_patterns 的文件作为初始状态：
+    tip 的提交者先记一次修改了这些文件的提交，每个文件的上一次修改为 tip。
+    返回 (作者经验状态, 文件历史图)。
+    """
+    files = tree_files(repo, tip.tree, seed_patterns, tree_cache)
+    tip_id = str(tip.id)
+    author = get_committer_name(tip)
+    authors = {author: experience.new_author()}
+    experience.add_commit(authors[author], tip_id, tip.commit_time, len(files))
+
+    graph = history.new_history_graph()
+    authorset_id = history.add_author_to_set(graph, 0, history.intern_author(graph, author))
+    for _, name in files:
+        graph['files'][name] = {'lastcommit': tip_id, tip_id: ["", authorset_id]}
+    return authors, graph
+
+def update_graphs(authors, graph, commit, stats):
+    """
+    把一个提交加入作者经验状态和文件历史图（与 003/004 建图的循环相同），
+    stats 为该提交与遍历顺序中前一个提交的 diff_stats。
+    """
+    files = set((oid, path, status) for path, oid, status, binary in
+                zip(stats['path'], stats['new_oid'], stats['status'], stats['binary']) if not binary)
+    commit_id = sys.intern(str(commit.id))
+    author = get_committer_name(commit)
+
+    if author not in authors:
+        authors[author] = experience.new_author()
+    experience.add_commit(authors[author], commit_id, commit.commit_time, len(files),
+                          experience.commit_subsystems(name for _, name, _ in files))
+
+    author_id = history.intern_author(graph, author)
+    all_files = graph['files']
+    for _, name, _ in files:
+        if name not in all_files:
+            all_files[name] = {}
+        last_commit = all_files[name].get('lastcommit', "")
+        authorset_id = all_files[name][last_commit][1] if last_commit else 0
+        all_files[name][commit_id] = [last_commit, history.add_author_to_set(graph, authorset_id, author_id)]
+        all_files[name]['lastcommit'] = commit_id
+
+def history_features(graph, index, pos, paths):
+    """
+    与 004.py 相同：由提交（相对第一个父提交）修改的文件在历史图中的记录计算 (ndev, age, nuc)。
+    """
+    if index.parent_offsets[pos] == index.parent_offsets[pos + 1]:
+        return 1.0, 0.0, 0.0
+    commit_hash = index.hex(pos)
+    authors = 0
+    prev_commits = []
+    for name in paths:
+        revision = history.lookup(graph, name, commit_hash)
+        if revision is None:
+            continue
+        prev_commit, authorset = revision
+        authors |= authorset
+        if prev_commit:
+            prev_commits.append(prev_commit)
+
+    # 每个文件的 age 为距其上一次修改的时间
+    age = 0.0
+    if prev_commits:
+        prev_positions = index.positions(prev_commits)
+        commit_time = np.asarray(index.commit_time)
+        ages = commit_time[pos] - commit_time[prev_positions[prev_positions >= 0]]
+        age = float(ages.sum()) / len(ages) if len(ages) else 0.0
+    return float(history.count_authors(authors)), age, float(len(set(prev_commits)))
+
+def extract_commit_features(repo, commit, stats, loc_cache=None, labeler=DEFAULT_LABELER, project=suffix_repo, guard=NO_GUARD):
+    """
+    计算单个提交的 churn、diffusion、lt、fix 等不依赖历史状态的特征，
+    stats 为 diffstat.diff_stats 返回的按列数组；guard 启用时大提交的 lt 按抽样估计，并输出 large_commit 列。
+    """
+    old_oids = []
+    fileschanged = []
+    modules = set([])
+    subsystems_mapping = {}
+    file_changes = []
+    total_change = 0
+    line_of_code_old = 0
+
+    for fpath, old_oid, addition, deletions, binary in zip(stats['path'], stats['old_oid'], stats['additions'], stats['deletions'], stats['binary']):
+        if binary:
+            continue
+        total_change += (addition + deletions)
+        file_changes.append(addition + deletions)
+
+        fileschanged.append(fpath)
+
+        subsystems = fpath.split('/')[:-1]
+        root = subsystems_mapping
+        for system in subsystems:
+            if system not in root:
+                root[system] = {}
+            root = root[system]
+        if subsystems:
+            modules.add(subsystems[0])
+
+        old_oids.append(old_oid)
+
+    large_commit = stats['large_commit']
+    if commit.parents and guard.max_files and len(old_oids) > guard.max_files:
+        line_of_code_old, flag = guarded_sum(len(old_oids), guard, lambda i: get_file_lines_of_code(repo, old_oids[i], loc_cache))
+        large_commit = max(large_commit, flag)
+    elif commit.parents:
+        for old_oid in old_oids:
+            line_of_code_old += get_file_lines_of_code(repo, old_oid, loc_cache)
+
+    author = commit.author
+    commit_message = commit.message.strip()
+    classification = labeler.classify(commit_message)
+
+    row = {
+        'project': project,
+        'parent_hashes': ','.join([str(p.id) for p in commit.parents]),
+        'commit_hash': str(commit.id),
+        'author_name': author.name,
+        'author_email': author.email,
+        'author_date': format_author_date(author.time, author.offset),
+        'author_date_unix_timestamp': str(author.time),
+        'commit_message': commit_message,
+        'la': str(sum(stats['additions'])),
+        'ld': str(sum(stats['deletions'])),
+        'fileschanged': ','.join(fileschanged),
+        'nf': str(len(stats['path'])),
+        'ns': str(float(count_diffing_subsystems(subsystems_mapping))),
+        'nd': str(float(len(modules))),
+        'entropy': str(float(count_entropy(file_changes, total_change))),
+        'lt': str(line_of_code_old),
+        # 与 merge.py 一样，空值（例如默认的 "None"）输出为空字符串
+        'classification': '' if classification in NA_VALUES else classification,
+        'fix': str(1.0 if labeler.is_fix(commit.message) else 0.0),
+    }
+    if guard.max_files:
+        row['large_commit'] = large_commit
+    return row
+
+def extract_all_features(repo_path, branch, commit_hashes, label, loc_cache=f"./{suffix_file}/loc_cache.db", labeler=DEFAULT_LABELER,
+                         index_root=f"./{suffix_file}/commit_index", project=suffix_repo, guard=NO_GUARD,
+                         seed_patterns=DEFAULT_PATTERNS, tree_cache=f"./{suffix_file}/tree_files"):
+    """
+    单次遍历分支历史，对每个提交只计算一次diff，同时得到全部特征列。
+    loc_cache 为按blob oid保存行数的缓存文件（与 006.py 共用），为 None 时不使用缓存；
+    labeler 计算 classification 和 fix 列（见 message_labels.py）；guard 为大提交保护设置（见 diffstat.py）。
+    la/ld/lt 等逐提交的列与 001/002/006 一样和第一个父提交比较；exp/rexp/sexp 和 ndev/age/nuc
+    与 003/004 完全建图的语义相同：以tip中匹配 seed_patterns 的文件为初始状态（tree_cache 与 003/004 共用），
+    之后每个提交和遍历顺序中的前一个提交比较，合并提交的前一个提交不是第一个父提交时多做一次diff。
+    003 的图中没有根提交，所以与 merge.py 一样不输出根提交的行。
+    """
+    repo = Repository(repo_path)
+    cache = LocCache(loc_cache) if loc_cache else None
+    index = open_commit_index(repo_path, branch, index_root)
+    selected = set(index.select(commit_hashes).tolist())
+    authors, graph = seed_graphs(repo, repo[index.tip], seed_patterns, tree_cache)
+    pending = []
+    previous = None
+
+    start_time = time.time()
+    for pos in tqdm(range(len(index))):
+        commit = repo[index.hex(pos)]
+        instrument.begin_commit(str(commit.id), pos)
+        parent = commit.parents[0] if commit.parents else None
+        stats = diff_stats(repo, commit, parent, guard=guard)
+        if previous is not None:
+            same = parent is not None and parent.id == previous.id and stats['large_commit'] == LARGE_NONE
+            update_graphs(authors, graph, commit, stats if same else diff_stats(repo, commit, previous, guard=NO_GUARD))
+        previous = commit
+
+        if pos in selected:
+            row = extract_commit_features(repo, commit, stats, cache, labeler, project, guard)
+            paths = [path for path, binary in zip(stats['path'], stats['binary']) if not binary]
+            pending.append((pos, get_committer_name(commit), paths, row))
+        instrument.end_commit()
+
+    if cache is not None:
+        cache.close()
+
+    # 图建完后与 003/004 一样按提交查询
+    rows = []
+    not_in_graph = []
+    for pos, author, paths, row in pending:
+        try:
+            exp, rexp, sexp = experience.lookup(authors[author], row['commit_hash'])
+        except KeyError:
+            not_in_graph.append(row['commit_hash'])
+            continue
+        ndev, age, nuc = history_features(graph, index, pos, paths)
+        row.update({
+            'ndev': ndev,
+            'age': age,
+            'nuc': nuc,
+            'exp': str(float(exp)),
+            'rexp': str(float(rexp)),
+            'sexp': str(float(sexp)),
+            'is_buggy_commit': label,
+        })
+        rows.append(row)
+    report_misses(not_in_graph, "not found in the author graph (root commits are not part of it, as in 003.py)")
+
+    end_time = time.time()
+    print("Done")
+    print(f"Overall processing time: {end_time - start_time} seconds")
+
+    # 与 001.py 一致，按拓扑逆序（最新的提交在前）输出
+    return list(reversed(rows))
+
+def save_features(rows, path=f"./{suffix_file}/merged_data{suffix_num}.csv"):
+    """
+    按 columns_order 将全部特征保存为CSV文件，path 以 .parquet 结尾时保存为 Parquet 文件。
+    """
+    columns = columns_order + ['large_commit'] if rows and 'large_commit' in rows[0] else columns_order
+    with TableWriter(path, columns) as writer:
+        for row in rows:
+            writer.writerow([row[col] for col in columns])
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="单次遍历仓库历史，提取 merge.py 所需的全部特征列。")
+    PARSER.add_argument("--repository", "-r", type=str, default=f"/home/WangZiyang/szz/{suffix_repo}", help="Path to local git repository.")
+    PARSER.add_argument("--branch", "-b", type=str, default=f"refs/heads/{suffix_branch}", help="Which branch to use.")
+    PARSER.add_argument("--csv_file", "-c", type=str, default=f"./{suffix_file}/commit_id{suffix_num}.csv", help="包含提交哈希的CSV文件路径")
+    PARSER.add_argument("--output", "-o", type=str, default=f"./{suffix_file}/merged_data{suffix_num}.csv", help="The path where the output is written (.parquet for a typed Parquet file).")
+    PARSER.add_argument("--label", "-l", type=int, default=1, help="is_buggy_commit 列的取值。")
+    PARSER.add_argument("--loc-cache", type=str, default=f"./{suffix_file}/loc_cache.db", help="按blob oid缓存文件行数的sqlite文件，传空字符串则不使用缓存。")
+    PARSER.add_argument("--keywords", "-k", type=str, default=None, help="classification/fix 关键词配置JSON文件（见 message_labels.py）")
+    PARSER.add_argument("--index-root", type=str, default=f"./{suffix_file}/commit_index", help="提交索引目录（commit_index.py）")
+    PARSER.add_argument("--project", type=str, default=suffix_repo, help="project 列的取值")
+    PARSER.add_argument("--trace", type=str, default=None, help="按提交记录耗时、diff时间、读取字节数和内存的目录（见 instrument.py）")
+    PARSER.add_argument("--seed-files", nargs='+', default=DEFAULT_PATTERNS, help="作为初始状态的tip文件的扩展名或glob模式（同 003/004 的 --seed-files）")
+    PARSER.add_argument("--tree-cache", type=str, default=f"./{suffix_file}/tree_files", help="初始文件列表的缓存目录，与 003/004 共用")
+    add_guard_arguments(PARSER)
+
+    ARGS = PARSER.parse_args()
+    if ARGS.trace:
+        instrument.enable(ARGS.trace, "extract_all")
+    REPOPATH = ARGS.repository
+    BRANCH = ARGS.branch
+    CSV_FILE_PATH = ARGS.csv_file
+
+    if not os.path.exists(REPOPATH):
+        print("The repository path does not exist!")
+        sys.exit(1)
+
+    if not os.path.exists(CSV_FILE_PATH):
+        print("CSV文件不存在!")
+        sys.exit(1)
+
+    commit_hashes = load_commit_hashes_from_csv(CSV_FILE_PATH)
+    ROWS = extract_all_features(REPOPATH, BRANCH, commit_hashes, ARGS.label, ARGS.loc_cache,
+                                MessageLabeler(load_keywords(ARGS.keywords)), ARGS.index_root, ARGS.project, guard_from_args(ARGS),
+                                ARGS.seed_files, ARGS.tree_cache)
+    save_features(ROWS, ARGS.output)
@@ -0,0 +1,210 @@
+import csv
+import os
+import sys
+
+from argparse import ArgumentParser
+
+# pyarrow 为可选依赖，只有读写 .parquet 文件时才需要
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# 全局后缀变量
+suffix_num = "1"
+suffix_repo = "z3"
+suffix_branch = "master"
+suffix_file = "z3_data"
+
+# 列类型：整数计数、float64 指标、字典编码的低基数字符串、普通字符串
+INT = "int"
+FLOAT = "float"
+DICT = "dict"
+STR = "str"
+
+# 各阶段输出列的类型，未列出的列按普通字符串处理
+FEATURE_TYPES = {
+    'project': DICT, 'parent_hashes': STR, 'commit_hash': STR, 'author_name': DICT, 'author_email': DICT,
+    'author_date': STR, 'author_date_unix_timestamp': INT, 'commit_message': STR,
+    'la': INT, 'ld': INT, 'nf': INT, 'lt': INT, 'fileschanged': STR,
+    'ns': FLOAT, 'nd': FLOAT, 'entropy': FLOAT, 'ndev': FLOAT, 'nuc': FLOAT, 'age': FLOAT,
+    'exp': FLOAT, 'rexp': FLOAT, 'sexp': FLOAT, 'fix': FLOAT,
+    'classification': DICT, 'is_buggy_commit': INT, 'large_commit': INT,
+}
+
+# 与 pandas.read_csv 默认一致的空值字符串
+NA_VALUES = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+}
+
+# commit_message 等字段可能很长
+csv.field_size_limit(sys.maxsize)
+
+def is_parquet(path):
+    return str(path).endswith(".parquet")
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("Reading or writing .parquet files requires pyarrow (pip install pyarrow).")
+
+def arrow_type(kind):
+    if kind == INT:
+        return pa.int64()
+    if kind == FLOAT:
+        return pa.float64()
+    if kind == DICT:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+def convert(kind, value):
+    """
+    把CSV中的字符串或阶段中的Python值转换为列类型，空值返回 None。
+    """
+    if value is None:
+        return None
+    if kind == INT or kind == FLOAT:
+        if isinstance(value, str):
+            if value in NA_VALUES:
+                return None
+            value = float(value)
+        if kind == INT:
+            if not float(value).is_integer():
+                raise ValueError(f"non-integer value {value!r} in an integer column")
+            return int(value)
+        return float(value)
+    return str(value)
+
+class TableWriter:
+    """
+    按行写出特征表：路径以 .parquet 结尾时写为带类型、压缩的 Parquet 文件
+    （按 batch_rows 行一个 row group），否则与原先一样用 csv.writer 写 CSV。
+    """
+
+    def __init__(self, path, columns, batch_rows=100000, lineterminator='\r\n', compression='zstd'):
+        self.path = path
+        self.columns = list(columns)
+        self.batch_rows = batch_rows
+        self.count = 0
+        if is_parquet(path):
+            require_pyarrow()
+            self.kinds = [FEATURE_TYPES.get(col, STR) for col in self.columns]
+            self.schema = pa.schema([(col, arrow_type(kind)) for col, kind in zip(self.columns, self.kinds)])
+            self.batch = [[] for _ in self.columns]
+            self.parquet = pq.ParquetWriter(path, self.schema, compression=compression)
+            self.output = None
+        else:
+            self.parquet = None
+            self.output = open(path, 'w', newline='')
+            self.writer = csv.writer(self.output, lineterminator=lineterminator)
+            self.writer.writerow(self.columns)
+
+    def writerow(self, row):
+        self.count += 1
+        if self.parquet is None:
+            self.writer.writerow(row)
+            return
+        for column, kind, value in zip(self.batch, self.kinds, row):
+            column.append(convert(kind, value))
+        if len(self.batch[0]) >= self.batch_rows:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        if self.parquet is None or not self.batch[0]:
+            return
+        arrays = []
+        for column, kind in zip(self.batch, self.kinds):
+            if kind == DICT:
+                arrays.append(pa.array(column, type=pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(column, type=arrow_type(kind)))
+        self.parquet.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.batch = [[] for _ in self.columns]
+
+    def close(self):
+        if self.parquet is not None:
+            self.flush()
+            self.parquet.close()
+        else:
+            self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_columns(path):
+    """
+    返回文件的列名。
+    """
+    if is_parquet(path):
+        require_pyarrow()
+        return pq.ParquetFile(path).schema_arrow.names
+    with open(path, 'r', newline='') as inp:
+        return next(csv.reader(inp))
+
+def iter_rows(path, columns=None, batch_rows=100000):
+    """
+    逐行读取特征表，只读取 columns 中的列（为 None 时读取全部列）。
+    Parquet 按 row group 分批读取，值为带类型的Python对象，空值为 None；CSV 的值为字符串。
+    """
+    if is_parquet(path):
+        require_pyarrow()
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows, columns=columns):
+            yield from zip(*[batch.column(i).to_pylist() for i in range(batch.num_columns)])
+        return
+
+    with open(path, 'r', newline='') as inp:
+        reader = csv.reader(inp)
+        header = next(reader)
+        if columns is None:
+            yield from reader
+            return
+        positions = [header.index(col) for col in columns]
+        for row in reader:
+            yield [row[i] for i in positions]
+
+def read_table(path, columns=None):
+    """
+    读取为 pandas DataFrame，只读取需要的列。训练模型时可直接使用：
+    read_table("merged_data1.parquet", ["la", "ld", "nf", "is_buggy_commit"])
+    """
+    import pandas as pd
+    if is_parquet(path):
+        require_pyarrow()
+        return pq.read_table(path, columns=columns).to_pandas()
+    return pd.read_csv(path, usecols=columns, low_memory=False)
+
+def convert_table(source, target, columns=None, lineterminator='\n'):
+    """
+    在 CSV 和 Parquet 之间转换，格式由文件扩展名决定，返回行数。
+    """
+    columns = columns or read_columns(source)
+    with TableWriter(target, columns, lineterminator=lineterminator) as writer:
+        for row in iter_rows(source, columns):
+            if not is_parquet(target):
+                row = ['' if value is None else value for value in row]
+            writer.writerow(row)
+    return writer.count
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="在 CSV 和 Parquet 特征表之间转换，格式由扩展名决定。")
+    PARSER.add_argument("source", type=str, help="输入文件（.csv 或 .parquet）")
+    PARSER.add_argument("target", type=str, help="输出文件（.csv 或 .parquet）")
+    PARSER.add_argument("--columns", "-c", nargs='+', default=None, help="只导出这些列")
+
+    ARGS = PARSER.parse_args()
+
+    if not os.path.exists(ARGS.source):
+        print(f"{ARGS.source} 不存在!")
+        sys.exit(1)
+
+    COUNT = convert_table(ARGS.source, ARGS.target, ARGS.columns)
+    print(f"{COUNT} rows written to {ARGS.target}")
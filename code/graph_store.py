@@ -0,0 +1,473 @@
+import json
+import os
+import sqlite3
+import sys
+
+from argparse import ArgumentParser
+import experience
+import history
+from pygit2 import GIT_SORT_REVERSE, GIT_SORT_TOPOLOGICAL
+
+# 作者经验图 (003.py) 与文件历史图 (004.py) 的二进制存储。
+# 使用 sqlite 作为嵌入式键值存储：按 (author, commit) 或 (file, commit)
+# 查询时只读取 B 树中需要的页，不必像 JSON 一样整体加载到内存。
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS exp_commits (
+    author TEXT, seq INTEGER, commit_id BLOB, time INTEGER, files INTEGER, rexp REAL, sexp REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (author, seq)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS exp_commits_commit ON exp_commits (author, commit_id, seq);
+CREATE TABLE IF NOT EXISTS exp_authors (
+    author TEXT PRIMARY KEY, years INTEGER, buckets TEXT, subsystems TEXT NOT NULL DEFAULT '{}') WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hist_authors (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE IF NOT EXISTS hist_authorsets (id INTEGER PRIMARY KEY, bits BLOB);
+CREATE TABLE IF NOT EXISTS hist_files (id INTEGER PRIMARY KEY, name TEXT UNIQUE, lastcommit BLOB);
+CREATE TABLE IF NOT EXISTS hist_revisions (
+    file INTEGER, commit_id BLOB, prev BLOB, authorset INTEGER,
+    PRIMARY KEY (file, commit_id)) WITHOUT ROWID;
+"""
+
+# 旧存储缺少的列，打开时补上（值为默认值，图的版本号不变，需要重新建图）
+MIGRATIONS = [
+    ("exp_commits", "sexp", "REAL NOT NULL DEFAULT 0"),
+    ("exp_authors", "subsystems", "TEXT NOT NULL DEFAULT '{}'"),
+]
+
+# 各种图的当前格式版本，没有记录版本的图为 1
+GRAPH_VERSIONS = {"experience": experience.EXPERIENCE_VERSION, "history": 1}
+
+def is_store_path(path):
+    """
+    以 .db / .sqlite 结尾的路径使用二进制存储，其余路径仍使用 JSON。
+    """
+    return path.endswith((".db", ".sqlite"))
+
+def pack_commit(commit_id):
+    return bytes.fromhex(commit_id) if commit_id else None
+
+def unpack_commit(value):
+    return value.hex() if value else ""
+
+def pack_bits(bits):
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+def unpack_bits(value):
+    return int.from_bytes(value, 'little')
+
+class GraphStore:
+    """
+    author_graph / file_graph 的 sqlite 存储。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.executescript(SCHEMA)
+        for table, column, definition in MIGRATIONS:
+            if column not in [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        self._file_ids = {}
+        self._authorsets = {}
+
+    def close(self):
+        self.conn.close()
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+    # ---- 作者经验图 ----
+
+    def write_experience(self, all_authors):
+        """
+        用内存中的作者经验图（experience.new_author 的字典）替换存储中的内容。
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM exp_commits")
+            self.conn.execute("DELETE FROM exp_authors")
+            for author, data in all_authors.items():
+                self.conn.executemany(
+                    "INSERT INTO exp_commits VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ((author, seq, pack_commit(commit_id), data['times'][seq], data['files'][seq], data['rexp'][seq], data['sexp'][seq])
+                     for seq, commit_id in enumerate(data['commits'])))
+                self.conn.execute("INSERT INTO exp_authors VALUES (?, ?, ?, ?)",
+                                  (author, data['years'], json.dumps(data['buckets']), json.dumps(data['subsystems'])))
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", ("experience_version", json.dumps(experience.EXPERIENCE_VERSION)))
+
+    def read_experience_authors(self):
+        all_authors = {}
+        for author, years, buckets, subsystems in self.conn.execute("SELECT author, years, buckets, subsystems FROM exp_authors"):
+            data = experience.new_author()
+            data['years'] = years
+            data['buckets'] = json.loads(buckets)
+            data['subsystems'] = json.loads(subsystems)
+            all_authors[author] = data
+        return all_authors
+
+    def read_experience(self):
+        all_authors = self.read_experience_authors()
+        for author, commit_id, commit_time, files, rexp, sexp in self.conn.execute(
+                "SELECT author, commit_id, time, files, rexp, sexp FROM exp_commits ORDER BY author, seq"):
+            data = all_authors[author]
+            data['commits'].append(unpack_commit(commit_id))
+            data['times'].append(commit_time)
+            data['files'].append(files)
+            data['rexp'].append(rexp)
+            data['sexp'].append(sexp)
+        return all_authors
+
+    def read_experience_tail(self):
+        """
+        只读取每个作者的最后一次提交和增量计算状态，用于增量更新。
+        """
+        all_authors = self.read_experience_authors()
+        for author, seq, commit_id, commit_time, files, rexp, sexp in self.conn.execute(
+                "SELECT c.author, c.seq, c.commit_id, c.time, c.files, c.rexp, c.sexp FROM exp_commits c "
+                "JOIN (SELECT author, MAX(seq) AS seq FROM exp_commits GROUP BY author) m "
+                "ON c.author = m.author AND c.seq = m.seq"):
+            data = all_authors[author]
+            data['commits'].append(unpack_commit(commit_id))
+            data['times'].append(commit_time)
+            data['files'].append(files)
+            data['rexp'].append(rexp)
+            data['sexp'].append(sexp)
+            data['offset'] = seq
+            data['stored'] = 1
+        return all_authors
+
+    def read_experience_author(self, author):
+        """
+        读取一个作者的完整记录（增量更新移动初始提交时需要），不存在时返回 None。
+        """
+        row = self.conn.execute("SELECT years, buckets, subsystems FROM exp_authors WHERE author = ?", (author,)).fetchone()
+        if row is None:
+            return None
+        data = experience.new_author()
+        data['years'] = row[0]
+        data['buckets'] = json.loads(row[1])
+        data['subsystems'] = json.loads(row[2])
+        for commit_id, commit_time, files, rexp, sexp in self.conn.execute(
+                "SELECT commit_id, time, files, rexp, sexp FROM exp_commits WHERE author = ? ORDER BY seq", (author,)):
+            data['commits'].append(unpack_commit(commit_id))
+            data['times'].append(commit_time)
+            data['files'].append(files)
+            data['rexp'].append(rexp)
+            data['sexp'].append(sexp)
+        return data
+
+    def append_experience(self, all_authors):
+        """
+        只写入 read_experience_tail 之后新增的提交；记录变短的作者（见 experience.move_seed）删除多出的旧提交。
+        """
+        with self.conn:
+            for author, data in all_authors.items():
+                self.conn.execute("DELETE FROM exp_commits WHERE author = ? AND seq >= ?", (author, data['offset'] + len(data['commits'])))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO exp_commits VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ((author, data['offset'] + i, pack_commit(data['commits'][i]), data['times'][i], data['files'][i], data['rexp'][i],
+                      data['sexp'][i]) for i in range(data['stored'], len(data['commits']))))
+                self.conn.execute("INSERT OR REPLACE INTO exp_authors VALUES (?, ?, ?, ?)",
+                                  (author, data['years'], json.dumps(data['buckets']), json.dumps(data['subsystems'])))
+
+    def lookup_experience(self, author, commit_id):
+        """
+        返回 (exp, rexp, sexp)，不存在时抛出 KeyError。
+        """
+        row = self.conn.execute(
+            "SELECT seq, rexp, sexp FROM exp_commits WHERE author = ? AND commit_id = ? ORDER BY seq DESC LIMIT 1",
+            (author, pack_commit(commit_id))).fetchone()
+        if row is None:
+            raise KeyError((author, commit_id))
+        return row[0] + 1, row[1], row[2]
+
+    def lookup_experiences(self, keys):
+        """
+        批量查询 [(author, commit_id), ...]，返回同样长度的列表，
+        每项为 (exp, rexp, sexp)，不存在时为 None。键先写入临时表，再用一次连接查询。
+        """
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (i INTEGER PRIMARY KEY, author TEXT, commit_id BLOB)")
+        self.conn.execute("DELETE FROM wanted")
+        self.conn.executemany("INSERT INTO wanted VALUES (?, ?, ?)",
+                              ((i, author, pack_commit(commit_id)) for i, (author, commit_id) in enumerate(keys)))
+        results = [None] * len(keys)
+        for i, seq, rexp, sexp in self.conn.execute(
+                "SELECT w.i, c.seq, c.rexp, c.sexp FROM wanted w JOIN exp_commits c "
+                "ON c.author = w.author AND c.commit_id = w.commit_id "
+                "AND c.seq = (SELECT MAX(seq) FROM exp_commits WHERE author = w.author AND commit_id = w.commit_id)"):
+            results[i] = (seq + 1, rexp, sexp)
+        self.conn.execute("DELETE FROM wanted")
+        return results
+
+    # ---- 文件历史图 ----
+
+    def write_history(self, graph):
+        """
+        用内存中的文件历史图（history.new_history_graph 的字典）替换存储中的内容。
+        """
+        with self.conn:
+            for table in ["hist_authors", "hist_authorsets", "hist_files", "hist_revisions"]:
+                self.conn.execute(f"DELETE FROM {table}")
+            self.conn.executemany("INSERT INTO hist_authors VALUES (?, ?)", enumerate(graph['authors']))
+            self.conn.executemany("INSERT INTO hist_authorsets VALUES (?, ?)",
+                                  ((i, pack_bits(bits)) for i, bits in enumerate(graph['authorsets'])))
+            for file_id, (name, revisions) in enumerate(graph['files'].items()):
+                self.conn.execute("INSERT INTO hist_files VALUES (?, ?, ?)",
+                                  (file_id, name, pack_commit(revisions.get('lastcommit', ""))))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO hist_revisions VALUES (?, ?, ?, ?)",
+                    ((file_id, pack_commit(commit_id), pack_commit(revision[0]), revision[1])
+                     for commit_id, revision in revisions.items() if commit_id != 'lastcommit'))
+        self._file_ids = {}
+        self._authorsets = {}
+
+    def read_history(self):
+        graph = history.new_history_graph()
+        for _, name in self.conn.execute("SELECT id, name FROM hist_authors ORDER BY id"):
+            history.intern_author(graph, name)
+        graph['authorsets'] = [unpack_bits(bits) for _, bits in
+                               self.conn.execute("SELECT id, bits FROM hist_authorsets ORDER BY id")]
+        graph['authorset_ids'] = {bits: i for i, bits in enumerate(graph['authorsets'])}
+        names = {}
+        for file_id, name, lastcommit in self.conn.execute("SELECT id, name, lastcommit FROM hist_files"):
+            names[file_id] = name
+            graph['files'][name] = {'lastcommit': sys.intern(unpack_commit(lastcommit))}
+        for file_id, commit_id, prev, authorset_id in self.conn.execute("SELECT * FROM hist_revisions"):
+            graph['files'][names[file_id]][sys.intern(unpack_commit(commit_id))] = [sys.intern(unpack_commit(prev)), authorset_id]
+        return graph
+
+    def read_history_tail(self):
+        """
+        只读取每个文件的最后一个版本，用于增量更新。
+        graph['stored'] 记录已持久化的作者、作者集合与文件，供 append_history 使用。
+        """
+        graph = history.new_history_graph()
+        for _, name in self.conn.execute("SELECT id, name FROM hist_authors ORDER BY id"):
+            history.intern_author(graph, name)
+        graph['authorsets'] = [unpack_bits(bits) for _, bits in
+                               self.conn.execute("SELECT id, bits FROM hist_authorsets ORDER BY id")]
+        graph['authorset_ids'] = {bits: i for i, bits in enumerate(graph['authorsets'])}
+
+        stored_files = {}
+        for file_id, name, lastcommit, authorset_id in self.conn.execute(
+                "SELECT f.id, f.name, f.lastcommit, r.authorset FROM hist_files f "
+                "LEFT JOIN hist_revisions r ON r.file = f.id AND r.commit_id = f.lastcommit"):
+            lastcommit = sys.intern(unpack_commit(lastcommit))
+            graph['files'][name] = {'lastcommit': lastcommit}
+            if lastcommit:
+                graph['files'][name][lastcommit] = ["", authorset_id or 0]
+            stored_files[name] = (file_id, lastcommit)
+
+        graph['stored'] = {
+            'authors': len(graph['authors']),
+            'authorsets': len(graph['authorsets']),
+            'files': stored_files,
+        }
+        return graph
+
+    def read_history_files(self, graph, names):
+        """
+        把 names 中文件的全部版本读入 read_history_tail 得到的图（见 history.move_seed），
+        append_history 之后重写这些文件的所有版本。
+        """
+        stored_files = graph['stored']['files']
+        for name in names:
+            if name not in stored_files:
+                continue
+            file_id, lastcommit = stored_files[name]
+            revisions = {'lastcommit': lastcommit}
+            for commit_id, prev, authorset_id in self.conn.execute(
+                    "SELECT commit_id, prev, authorset FROM hist_revisions WHERE file = ?", (file_id,)):
+                revisions[sys.intern(unpack_commit(commit_id))] = [sys.intern(unpack_commit(prev)), authorset_id]
+            graph['files'][name] = revisions
+            stored_files[name] = (file_id, None)
+
+    def append_history(self, graph):
+        """
+        只写入 read_history_tail 之后新增的作者、作者集合与文件版本；
+        由 read_history_files 完整读入的文件先删除旧版本再整体写入。
+        """
+        stored = graph['stored']
+        next_file_id = max([file_id for file_id, _ in stored['files'].values()], default=-1) + 1
+        with self.conn:
+            self.conn.executemany("INSERT INTO hist_authors VALUES (?, ?)",
+                                  ((i, name) for i, name in enumerate(graph['authors']) if i >= stored['authors']))
+            self.conn.executemany("INSERT INTO hist_authorsets VALUES (?, ?)",
+                                  ((i, pack_bits(bits)) for i, bits in enumerate(graph['authorsets']) if i >= stored['authorsets']))
+            for name, revisions in graph['files'].items():
+                file_id, base_commit = stored['files'].get(name, (None, None))
+                # read_history_tail 读入的最后一个版本没有 prev，未改变时不重写；
+                # 初始提交本身修改了文件时（见 004.py）这一版本已被更新，需要写入
+                if not base_commit or revisions[base_commit][0]:
+                    base_commit = None
+                elif revisions.get('lastcommit', "") == base_commit:
+                    continue
+                if file_id is None:
+                    file_id = next_file_id
+                    next_file_id += 1
+                elif stored['files'][name][1] is None:
+                    self.conn.execute("DELETE FROM hist_revisions WHERE file = ?", (file_id,))
+                self.conn.execute("INSERT OR REPLACE INTO hist_files VALUES (?, ?, ?)",
+                                  (file_id, name, pack_commit(revisions.get('lastcommit', ""))))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO hist_revisions VALUES (?, ?, ?, ?)",
+                    ((file_id, pack_commit(commit_id), pack_commit(revision[0]), revision[1])
+                     for commit_id, revision in revisions.items() if commit_id not in ('lastcommit', base_commit)))
+        self._file_ids = {}
+
+    def lookup_revision(self, name, commit_id):
+        """
+        返回文件在 commit_id 时的 (prevcommit, 作者位集)，不存在时返回 None。
+        """
+        if name not in self._file_ids:
+            row = self.conn.execute("SELECT id FROM hist_files WHERE name = ?", (name,)).fetchone()
+            self._file_ids[name] = row[0] if row else None
+        file_id = self._file_ids[name]
+        if file_id is None:
+            return None
+
+        row = self.conn.execute("SELECT prev, authorset FROM hist_revisions WHERE file = ? AND commit_id = ?",
+                                (file_id, pack_commit(commit_id))).fetchone()
+        if row is None:
+            return None
+
+        prev, authorset_id = row
+        if authorset_id not in self._authorsets:
+            bits = self.conn.execute("SELECT bits FROM hist_authorsets WHERE id = ?", (authorset_id,)).fetchone()[0]
+            self._authorsets[authorset_id] = unpack_bits(bits)
+        return unpack_commit(prev), self._authorsets[authorset_id]
+
+def read_graph_tip(kind, path, seed_patterns=None):
+    """
+    返回已保存的图构建时的分支tip，图不存在、没有记录tip、格式版本不是当前版本
+    或初始文件的模式与 seed_patterns 不同时返回 None（需要重新建图）。
+    """
+    if not os.path.exists(path):
+        return None
+    if is_store_path(path):
+        store = GraphStore(path)
+        tip = store.get_meta(f"{kind}_tip")
+        version = store.get_meta(f"{kind}_version", 1)
+        seed_files = store.get_meta(f"{kind}_seed_files")
+        store.close()
+    else:
+        with open(path, 'r') as inp:
+            data = json.load(inp)
+        tip = data.get('tip') if isinstance(data.get('tip'), str) else None
+        version = data.get('version', 1)
+        seed_files = data.get('seed_files')
+    if version != GRAPH_VERSIONS[kind] or (seed_patterns is not None and seed_files != list(seed_patterns)):
+        return None
+    return tip
+
+def is_fast_forward(repo, tip, target):
+    """
+    判断保存的tip是否仍是当前分支的祖先；历史被改写时返回 False，需要完整重建。
+    """
+    try:
+        tip_oid = repo.get(tip).id
+    except (KeyError, ValueError, AttributeError):
+        return False
+    return tip_oid == target or repo.descendant_of(target, tip_oid)
+
+def walk_commits(repo, target, base=None):
+    """
+    按拓扑顺序（从旧到新）列出构建图时要处理的提交。base 不为 None 时为增量更新：
+    列表以 base 开头，之后是 base 之后的新提交。相同参数得到的列表相同，断点按下标记录。
+    """
+    walker = repo.walk(target, GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE)
+    if base is None:
+        return list(walker)
+    walker.hide(repo.get(base).id)
+    return [repo.get(base)] + list(walker)
+
+def read_graph_checkpoint(kind, path, target):
+    """
+    返回二进制存储中构建到一半的图的断点 {"target", "base", "done"}：
+    commits = walk_commits(repo, target, base) 中前 done 个提交已经写入存储。
+    没有断点或分支tip已经变化时返回 None。
+    """
+    if not is_store_path(path) or not os.path.exists(path):
+        return None
+    store = GraphStore(path)
+    checkpoint = store.get_meta(f"{kind}_checkpoint")
+    store.close()
+    return checkpoint if checkpoint and checkpoint["target"] == target else None
+
+def write_graph_checkpoint(kind, path, state, append, checkpoint):
+    """
+    把构建到一半的图（append 为 True 时只写入新增部分）写入二进制存储并记录断点，
+    返回从存储重新读取的尾部状态，之后的提交在它上面继续计算（也释放了已写入的历史）。
+    先清空 tip 和旧断点再写入：中途退出时存储不会被当作已完成的图，下次重新构建。
+    """
+    store = GraphStore(path)
+    store.set_meta(f"{kind}_tip", None)
+    store.set_meta(f"{kind}_checkpoint", None)
+    if kind == "experience" and append:
+        store.append_experience(state)
+    elif kind == "experience":
+        store.write_experience(state)
+    elif append:
+        store.append_history(state)
+    else:
+        store.write_history(state)
+    store.set_meta(f"{kind}_checkpoint", checkpoint)
+    state = store.read_experience_tail() if kind == "experience" else store.read_history_tail()
+    store.close()
+    return state
+
+def json_to_store(kind, json_path, store_path):
+    """
+    将现有的 author_graph.json / file_graph.json 转换为二进制存储，
+    旧版 003.py / 004.py 保存的格式分别由 experience.convert_old_author 和 history.convert_old_graph 转换。
+    """
+    with open(json_path, 'r') as inp:
+        data = json.load(inp)
+    store = GraphStore(store_path)
+    if kind == "experience":
+        store.write_experience(experience.graph_from_json(data))
+    else:
+        store.write_history(history.from_json(data))
+    if isinstance(data.get('tip'), str):
+        store.set_meta(f"{kind}_tip", data['tip'])
+    store.set_meta(f"{kind}_seed_files", data.get('seed_files'))
+    # 保留 JSON 的版本：没有 sexp 的旧图转换后仍需重新建图
+    store.set_meta(f"{kind}_version", data.get('version', 1))
+    store.close()
+
+def store_to_json(kind, store_path, json_path):
+    """
+    将二进制存储导出为 003.py / 004.py 可直接读取的 JSON。
+    """
+    store = GraphStore(store_path)
+    tip = store.get_meta(f"{kind}_tip")
+    seed_files = store.get_meta(f"{kind}_seed_files")
+    if kind == "experience":
+        data = experience.graph_to_json(store.read_experience(), tip, seed_files)
+    else:
+        data = history.to_json(store.read_history(), tip, seed_files)
+    store.close()
+    with open(json_path, 'w') as output:
+        json.dump(data, output)
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="Convert author/file graphs between JSON and the binary graph store.")
+    PARSER.add_argument("command", choices=["from-json", "to-json"], help="from-json: JSON -> store, to-json: store -> JSON.")
+    PARSER.add_argument("source", type=str, help="Input path.")
+    PARSER.add_argument("target", type=str, help="Output path.")
+    PARSER.add_argument("--kind", "-k", choices=["experience", "history"], required=True,
+                        help="experience for author_graph (003.py), history for file_graph (004.py).")
+
+    ARGS = PARSER.parse_args()
+
+    if not os.path.exists(ARGS.source):
+        print(f"{ARGS.source} does not exist!")
+        sys.exit(1)
+
+    if ARGS.command == "from-json":
+        json_to_store(ARGS.kind, ARGS.source, ARGS.target)
+    else:
+        store_to_json(ARGS.kind, ARGS.source, ARGS.target)
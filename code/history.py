@@ -0,0 +1,145 @@
+import sys
+
+def new_history_graph():
+    """
+    Create an empty history graph. Author names are interned to integer ids
+    and the authors of a file revision are stored as an integer bitset.
+    Every distinct bitset is stored once in 'authorsets', and the file
+    revisions refer to it by id, so successive revisions of a file that were
+    made by already known authors share the same set.
+
+    files[name] = {'lastcommit': commit, commit: [prevcommit, authorset_id], ...}
+    """
+    return {'authors': [], 'author_ids': {}, 'authorsets': [0], 'authorset_ids': {0: 0}, 'files': {}}
+
+
+def intern_author(graph, name):
+    """
+    Return the integer id of an author, adding it to the graph if needed.
+    """
+    author_ids = graph['author_ids']
+    if name not in author_ids:
+        author_ids[name] = len(graph['authors'])
+        graph['authors'].append(name)
+    return author_ids[name]
+
+
+def add_author_to_set(graph, authorset_id, author_id):
+    """
+    Return the id of the author set extended with author_id. If the author is
+    already part of the set the same set is shared.
+    """
+    bits = graph['authorsets'][authorset_id]
+    if bits >> author_id & 1:
+        return authorset_id
+    bits |= 1 << author_id
+    authorset_ids = graph['authorset_ids']
+    if bits not in authorset_ids:
+        authorset_ids[bits] = len(graph['authorsets'])
+        graph['authorsets'].append(bits)
+    return authorset_ids[bits]
+
+
+def count_authors(bits):
+    return bin(bits).count("1")
+
+
+def convert_old_graph(old_graph):
+    """
+    Convert a graph written by the previous version of this script, where
+    every revision stored a full list of author names, to the compact format.
+    """
+    graph = new_history_graph()
+    for name, revisions in old_graph.items():
+        graph['files'][name] = {}
+        for commit_id, revision in revisions.items():
+            if commit_id == 'lastcommit':
+                graph['files'][name]['lastcommit'] = sys.intern(revision)
+                continue
+            authorset_id = 0
+            for author in revision.get('authors', []):
+                authorset_id = add_author_to_set(graph, authorset_id, intern_author(graph, author))
+            graph['files'][name][sys.intern(commit_id)] = [sys.intern(revision['prevcommit']), authorset_id]
+    return graph
+
+
+def move_seed(graph, index, old_tip, old_seed, new_tip, new_seed):
+    """
+    A full build seeds every file of the tip matching the seed patterns with
+    a revision at the tip made by its committer (see 004.py). The first real
+    revision of such a file points back to the tip and every later author
+    set contains the tip committer. When the graph is updated to a new tip
+    the seed moves there: the revisions of the files seeded at either tip
+    are rebuilt in commit-index order, so the result matches a full build
+    at new_tip. Those files must be fully loaded, and index must be the
+    commit index of the new tip. Raises ValueError if a revision is not
+    part of the index.
+    """
+    files = graph['files']
+    old_seed = set(old_seed)
+    new_seed = set(new_seed)
+    revisions = {}
+    for name in old_seed | new_seed:
+        entries = files.get(name, {})
+        # At old_tip, a seeded file keeps its seed entry unless old_tip itself changed the file
+        revisions[name] = [commit_id for commit_id, revision in entries.items()
+                           if commit_id != 'lastcommit' and not (name in old_seed and commit_id == old_tip and not revision[0])]
+
+    commit_ids = sorted(set(commit_id for ids in revisions.values() for commit_id in ids) | {new_tip})
+    positions = index.positions(commit_ids)
+    if (positions < 0).any():
+        raise ValueError(f"{int((positions < 0).sum())} revisions are not part of the branch")
+    position = dict(zip(commit_ids, positions.tolist()))
+    committer = dict(zip(commit_ids, index.committers(positions)))
+
+    for name, commit_ids in revisions.items():
+        entries = {}
+        last_commit = ""
+        authorset_id = 0
+        if name in new_seed:
+            last_commit = sys.intern(new_tip)
+            authorset_id = add_author_to_set(graph, 0, intern_author(graph, committer[new_tip]))
+            entries[last_commit] = ["", authorset_id]
+        for commit_id in sorted(commit_ids, key=position.get):
+            authorset_id = add_author_to_set(graph, authorset_id, intern_author(graph, committer[commit_id]))
+            entries[commit_id] = [last_commit, authorset_id]
+            last_commit = commit_id
+        entries['lastcommit'] = last_commit
+        files[name] = entries
+
+
+def to_json(graph, tip=None, seed_files=None):
+    return {
+        'tip': tip,
+        'seed_files': seed_files,
+        'authors': graph['authors'],
+        'authorsets': [format(bits, 'x') for bits in graph['authorsets']],
+        'files': graph['files'],
+    }
+
+
+def from_json(data):
+    """
+    Build a graph from its JSON form; graphs in the previous layout are converted.
+    """
+    if 'files' not in data:
+        return convert_old_graph(data)
+
+    graph = new_history_graph()
+    graph['authors'] = data['authors']
+    graph['author_ids'] = {name: i for i, name in enumerate(graph['authors'])}
+    graph['authorsets'] = [int(bits, 16) for bits in data['authorsets']]
+    graph['authorset_ids'] = {bits: i for i, bits in enumerate(graph['authorsets'])}
+    graph['files'] = data['files']
+    return graph
+
+
+def lookup(graph, name, commit_id):
+    """
+    Return (prevcommit, author bitset) of a file revision, or None.
+    """
+    revisions = graph['files'].get(name)
+    if revisions is None or commit_id not in revisions:
+        return None
+    prev_commit, authorset_id = revisions[commit_id]
+    return prev_commit, graph['authorsets'][authorset_id]
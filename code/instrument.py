@@ -0,0 +1,221 @@
+import atexit
+import json
+import os
+import resource
+import sys
+import time
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+
+# 记录目录与阶段名通过环境变量传给工作进程（以及 run_all.py 启动的子进程）
+TRACE_ENV = "FEATURE_TRACE_DIR"
+STAGE_ENV = "FEATURE_TRACE_STAGE"
+
+# 每个提交记录的计数项
+COUNTERS = ["diff_seconds", "blob_bytes", "files"]
+
+class Tracer:
+    """
+    按提交记录耗时和资源：wall_seconds、diff_seconds、blob_bytes、files，
+    以及提交结束时进程的峰值RSS（maxrss_kb）和本提交期间的增长（rss_growth_kb）。
+    每个进程写一个 <trace_dir>/<stage>.<pid>.jsonl 文件，每行一条记录。
+    """
+
+    def __init__(self, trace_dir, stage):
+        os.makedirs(trace_dir, exist_ok=True)
+        self.stage = stage
+        self.pid = os.getpid()
+        self.output = open(os.path.join(trace_dir, f"{stage}.{self.pid}.jsonl"), 'a')
+        self.current = None
+        self.start_time = time.time()
+
+    def begin(self, commit_hash, pos=None):
+        self.current = {"type": "commit", "stage": self.stage, "pid": self.pid, "commit": commit_hash, "pos": pos,
+                        "start": time.time(), "diff_seconds": 0.0, "blob_bytes": 0, "files": 0}
+        self.rss_before = maxrss_kb()
+        self.begin_time = time.perf_counter()
+
+    def add(self, key, amount):
+        if self.current is not None:
+            self.current[key] += amount
+
+    def end(self):
+        if self.current is None:
+            return
+        record = self.current
+        record["wall_seconds"] = time.perf_counter() - self.begin_time
+        record["maxrss_kb"] = maxrss_kb()
+        record["rss_growth_kb"] = record["maxrss_kb"] - self.rss_before
+        self.output.write(json.dumps(record) + "\n")
+        self.current = None
+
+    def finish_stage(self):
+        """
+        写入整个阶段的记录（在主进程退出时调用），峰值RSS包括已结束的工作进程。
+        """
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        self.output.write(json.dumps({"type": "stage", "stage": self.stage, "pid": self.pid, "start": self.start_time,
+                                      "wall_seconds": time.time() - self.start_time,
+                                      "maxrss_kb": max(maxrss_kb(), children)}) + "\n")
+        self.close()
+
+    def flush(self):
+        self.output.flush()
+
+    def close(self):
+        if not self.output.closed:
+            self.output.close()
+
+# 当前进程的记录器，未启用时为 None，此时下面的函数都不做任何事
+_TRACER = None
+
+def maxrss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def enable(trace_dir, stage):
+    """
+    在阶段的主进程中启用记录：之后启动的工作进程由 init_worker_tracing 继续记录到同一目录。
+    """
+    global _TRACER
+    os.environ[TRACE_ENV] = trace_dir
+    os.environ[STAGE_ENV] = stage
+    _TRACER = Tracer(trace_dir, stage)
+    atexit.register(_TRACER.finish_stage)
+    return _TRACER
+
+def init_worker_tracing():
+    """
+    在工作进程启动时调用：主进程启用了记录时为本进程打开自己的记录文件。
+    """
+    global _TRACER
+    trace_dir = os.environ.get(TRACE_ENV)
+    if not trace_dir or (_TRACER is not None and _TRACER.pid == os.getpid()):
+        return
+    _TRACER = Tracer(trace_dir, os.environ.get(STAGE_ENV, "stage"))
+    atexit.register(_TRACER.close)
+
+def tracer():
+    return _TRACER
+
+def begin_commit(commit_hash, pos=None):
+    if _TRACER is not None:
+        _TRACER.begin(commit_hash, pos)
+
+def end_commit():
+    if _TRACER is not None:
+        _TRACER.end()
+
+def add(key, amount):
+    if _TRACER is not None:
+        _TRACER.add(key, amount)
+
+def flush():
+    if _TRACER is not None:
+        _TRACER.flush()
+
+@contextmanager
+def timed(key="diff_seconds"):
+    """
+    把代码块的耗时累加到当前提交的 key 上。
+    """
+    if _TRACER is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        _TRACER.add(key, time.perf_counter() - start_time)
+
+def read_trace(trace_dir):
+    """
+    读取目录下所有进程的记录，返回 (提交记录列表, 阶段记录列表)。
+    """
+    commits = []
+    stages = []
+    for name in sorted(os.listdir(trace_dir)):
+        if not name.endswith(".jsonl"):
+            continue
+        with open(os.path.join(trace_dir, name), 'r') as inp:
+            for line in inp:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                (stages if record.get("type") == "stage" else commits).append(record)
+    return commits, stages
+
+def summarize(commits, stages, top=20, stage=None):
+    """
+    输出每个阶段的汇总和最慢的 top 个提交（含修改文件数、读取blob字节数、diff耗时等特征）。
+    """
+    if stage:
+        commits = [record for record in commits if record["stage"] == stage]
+        stages = [record for record in stages if record["stage"] == stage]
+
+    totals = {}
+    for record in commits:
+        total = totals.setdefault(record["stage"], {"commits": 0, "wall_seconds": 0.0, "diff_seconds": 0.0, "blob_bytes": 0,
+                                                    "files": 0, "maxrss_kb": 0, "stage_seconds": None})
+        total["commits"] += 1
+        for key in COUNTERS + ["wall_seconds"]:
+            total[key] += record[key]
+        total["maxrss_kb"] = max(total["maxrss_kb"], record["maxrss_kb"])
+    for record in stages:
+        total = totals.setdefault(record["stage"], {"commits": 0, "wall_seconds": 0.0, "diff_seconds": 0.0, "blob_bytes": 0,
+                                                    "files": 0, "maxrss_kb": 0, "stage_seconds": None})
+        # 同一阶段可能运行多次（例如每个标签一次），耗时累加
+        total["stage_seconds"] = (total["stage_seconds"] or 0.0) + record["wall_seconds"]
+        total["maxrss_kb"] = max(total["maxrss_kb"], record["maxrss_kb"])
+
+    print(f"{'stage':<12} {'commits':>8} {'stage s':>9} {'commit s':>9} {'diff s':>9} {'blob MB':>9} {'files':>9} {'peak MB':>8}")
+    for name, total in sorted(totals.items()):
+        stage_seconds = f"{total['stage_seconds']:9.2f}" if total["stage_seconds"] is not None else f"{'-':>9}"
+        print(f"{name:<12} {total['commits']:>8} {stage_seconds} {total['wall_seconds']:9.2f} {total['diff_seconds']:9.2f} "
+              f"{total['blob_bytes'] / 2 ** 20:9.1f} {total['files']:>9} {total['maxrss_kb'] / 1024:8.1f}")
+
+    slowest = sorted(commits, key=lambda record: record["wall_seconds"], reverse=True)[:top]
+    if not slowest:
+        return
+    print()
+    print(f"Slowest {len(slowest)} commits:")
+    print(f"{'stage':<12} {'commit':<12} {'wall s':>8} {'share':>6} {'diff s':>8} {'files':>7} {'blob MB':>8} {'+rss MB':>8}")
+    for record in slowest:
+        share = record["wall_seconds"] / totals[record["stage"]]["wall_seconds"] if totals[record["stage"]]["wall_seconds"] else 0
+        print(f"{record['stage']:<12} {record['commit'][:12]:<12} {record['wall_seconds']:8.3f} {share:6.1%} "
+              f"{record['diff_seconds']:8.3f} {record['files']:>7} {record['blob_bytes'] / 2 ** 20:8.2f} {record['rss_growth_kb'] / 1024:8.1f}")
+
+def to_chrome_trace(commits, stages, path):
+    """
+    转换为 Chrome trace event 格式（chrome://tracing 或 Perfetto 可直接打开），每个进程一行。
+    """
+    events = []
+    for record in stages:
+        events.append({"name": record["stage"], "cat": "stage", "ph": "X", "pid": record["stage"], "tid": record["pid"],
+                       "ts": record["start"] * 1e6, "dur": record["wall_seconds"] * 1e6, "args": {"maxrss_kb": record["maxrss_kb"]}})
+    for record in commits:
+        events.append({"name": record["commit"][:12], "cat": "commit", "ph": "X", "pid": record["stage"], "tid": record["pid"],
+                       "ts": record["start"] * 1e6, "dur": record["wall_seconds"] * 1e6,
+                       "args": {key: record[key] for key in ["commit", "pos", "diff_seconds", "blob_bytes", "files", "maxrss_kb", "rss_growth_kb"]}})
+    with open(path, 'w') as output:
+        json.dump({"traceEvents": events}, output)
+    return len(events)
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="汇总各阶段 --trace 目录中的记录，列出最慢的提交，或导出为 Chrome trace。")
+    PARSER.add_argument("trace_dir", type=str, help="各阶段 --trace 指定的目录")
+    PARSER.add_argument("--top", "-n", type=int, default=20, help="列出最慢的提交数")
+    PARSER.add_argument("--stage", "-s", type=str, default=None, help="只看这个阶段")
+    PARSER.add_argument("--chrome", type=str, default=None, help="另外导出 Chrome trace event JSON 文件")
+
+    ARGS = PARSER.parse_args()
+
+    if not os.path.isdir(ARGS.trace_dir):
+        print(f"{ARGS.trace_dir} 不存在!")
+        sys.exit(1)
+
+    COMMITS, STAGES = read_trace(ARGS.trace_dir)
+    summarize(COMMITS, STAGES, ARGS.top, ARGS.stage)
+    if ARGS.chrome:
+        COUNT = to_chrome_trace(COMMITS, STAGES, ARGS.chrome)
+        print(f"{COUNT} events written to {ARGS.chrome}")
@@ -1,53 +1,188 @@
-import pandas as pd
+import csv
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+
+from argparse import ArgumentParser
+from feature_io import FEATURE_TYPES, FLOAT, INT, NA_VALUES, TableWriter, iter_rows, read_columns
 
 # 全局后缀变量
-suffix_num = "1" 
-suffix_repo = "z3" 
+suffix_num = "1"
+suffix_repo = "z3"
 suffix_branch = "master"
 suffix_file = "z3_data"
 
 # 定义列的顺序
 columns_order = [
-    'project', 'parent_hashes', 'commit_hash', 'author_name', 'author_email', 
-    'author_date', 'author_date_unix_timestamp', 'commit_message', 'la', 'ld', 
-    'fileschanged', 'nf', 'ns', 'nd', 'entropy', 'ndev', 'lt', 'nuc', 'age', 
-    'exp', 'rexp', 'sexp', 'classification', 'fix', 'is_buggy_commit'
+    'project', 'parent_hashes', 'commit_hash', 'author_name', 'author_email',
+    'author_date', 'author_date_unix_timestamp', 'commit_message', 'la', 'ld',
+    'fileschanged', 'nf', 'ns', 'nd', 'entropy', 'ndev', 'lt', 'nuc', 'age',
+    'exp', 'rexp', 'sexp', 'classification', 'fix', 'is_buggy_commit', 'large_commit'
 ]
 
 # 文件列表
 files = [f"./{suffix_file}/code_churns{suffix_num}.csv", f"./{suffix_file}/diffusion_features{suffix_num}.csv", f"./{suffix_file}/exp{suffix_num}.csv", f"./{suffix_file}/fix_features{suffix_num}.csv", f"./{suffix_file}/history{suffix_num}.csv", f"./{suffix_file}/lt{suffix_num}.csv"]
 
-# 用于存储每个文件的 DataFrame 列表
-df_list = []
+# 各列的类型（与 feature_io.FEATURE_TYPES 一致）：计数和时间戳为整数，ns/nd/entropy/exp 等指标为浮点数，其余为字符串
+dtypes = {col: {INT: int, FLOAT: float}.get(FEATURE_TYPES.get(col), str) for col in columns_order}
+
+def write_sorted_run(rows, columns, path):
+    """
+    把一块行按 (commit_hash, 行号) 排序后写入临时文件。
+    """
+    rows.sort(key=lambda row: (row[1], row[0]))
+    with open(path, 'w', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow(['_row'] + columns)
+        writer.writerows(rows)
+
+def as_text(value):
+    """
+    Parquet 输入的值带类型，统一转换为与CSV相同的字符串，空值为空字符串。
+    """
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def sort_file(path, tmp_dir, chunk_rows=200000, wanted=None):
+    """
+    外部排序：按块读取CSV或Parquet，每块排序后写入 tmp_dir，返回 (列名, 临时文件列表)。
+    wanted 不为 None 时只读取其中的列（Parquet 只解码这些列）。
+    每行前面加上原文件中的行号，相同 commit_hash 时保持原顺序。
+    """
+    columns = read_columns(path)
+    if 'commit_hash' not in columns:
+        raise ValueError(f"{path} has no commit_hash column")
+    columns = ['commit_hash'] + [col for col in columns if col != 'commit_hash' and (wanted is None or col in wanted)]
+
+    runs = []
+    rows = []
+    for i, row in enumerate(iter_rows(path, columns)):
+        rows.append([i] + [as_text(value) for value in row])
+        if len(rows) >= chunk_rows:
+            runs.append(os.path.join(tmp_dir, f"{os.path.basename(path)}.{len(runs)}"))
+            write_sorted_run(rows, columns, runs[-1])
+            rows = []
+    if rows or not runs:
+        runs.append(os.path.join(tmp_dir, f"{os.path.basename(path)}.{len(runs)}"))
+        write_sorted_run(rows, columns, runs[-1])
+    return columns, runs
+
+def read_run(path):
+    with open(path, 'r', newline='') as inp:
+        reader = csv.reader(inp)
+        next(reader)
+        for row in reader:
+            yield (row[1], int(row[0]), row[1:])
+
+def iter_sorted(path, tmp_dir, chunk_rows=200000, wanted=None):
+    """
+    按 commit_hash 升序逐行产生 (commit_hash, 行)，同一文件中重复的 commit_hash 只保留首次出现的。
+    返回 (列名, 迭代器)。
+    """
+    columns, runs = sort_file(path, tmp_dir, chunk_rows, wanted)
+
+    def rows():
+        last = None
+        for commit_hash, _, row in heapq.merge(*[read_run(run) for run in runs]):
+            if commit_hash != last:
+                last = commit_hash
+                yield commit_hash, row
+    return columns, rows()
+
+def format_value(col, value):
+    """
+    按列类型格式化输出值：整数列写成整数，浮点数列写成浮点数，无法解析时原样输出。
+    """
+    kind = dtypes.get(col)
+    if kind is float or kind is int:
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+        if kind is int and number.is_integer():
+            return str(int(number))
+        return repr(number)
+    return value
+
+def merge_features(paths, output_file, label=1, chunk_rows=200000, tmp_dir=None):
+    """
+    每个输入文件先按 commit_hash 外部排序，再一次遍历按 commit_hash 归并连接。
+    内存中只保留每个文件的一块排序缓冲和当前行。
+    与原先的 outer merge + dropna 等价：只输出所有检查列都不为空的提交，
+    classification 为空值（例如 "None"）时输出空字符串，行按 commit_hash 升序排列。
+    large_commit 列（启用大提交保护时）只在输入中有时输出，取各文件中的最大值。
+    输入和输出都可以是 .csv 或 .parquet，输入只读取 columns_order 中的列。
+    返回写出的行数。
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="merge_", dir=tmp_dir)
+    try:
+        streams = [iter_sorted(path, tmp_dir, chunk_rows, set(columns_order)) for path in paths]
+
+        # 每列取自第一个包含它的文件，large_commit 取自所有包含它的文件
+        sources = {}
+        large_sources = []
+        for i, (columns, _) in enumerate(streams):
+            for j, col in enumerate(columns):
+                sources.setdefault(col, (i, j))
+                if col == 'large_commit':
+                    large_sources.append((i, j))
+        sources['is_buggy_commit'] = None
+        available_columns = [col for col in columns_order if col in sources]
+        cols_to_check = [col for col in available_columns if col not in ('classification', 'is_buggy_commit', 'large_commit')]
+
+        iterators = [rows for _, rows in streams]
+        heads = [next(rows, None) for rows in iterators]
+
+        with TableWriter(output_file, available_columns, lineterminator='\n') as writer:
+            while all(head is not None for head in heads):
+                target = max(head[0] for head in heads)
+                # 把落后的文件推进到 target
+                for i in range(len(heads)):
+                    while heads[i] is not None and heads[i][0] < target:
+                        heads[i] = next(iterators[i], None)
+                if not all(head is not None and head[0] == target for head in heads):
+                    continue
 
-# 遍历每个文件，删除重复的 commit_hash，并存储处理后的 DataFrame
-for file in files:
-    df = pd.read_csv(file, low_memory=False)
-    
-    # 删除同一文件中重复的 commit_hash 行，保留首次出现的
-    df = df.drop_duplicates(subset='commit_hash', keep='first')
-    
-    # 将处理后的 DataFrame 添加到列表中
-    df_list.append(df)
+                values = {}
+                for col in available_columns:
+                    if col == 'is_buggy_commit':
+                        values[col] = str(label)
+                    elif col == 'large_commit':
+                        flags = [heads[i][1][j] for i, j in large_sources if heads[i][1][j] not in NA_VALUES]
+                        values[col] = str(max(int(flag) for flag in flags)) if flags else '0'
+                    else:
+                        i, j = sources[col]
+                        values[col] = heads[i][1][j]
 
-# 逐步合并所有文件，基于 commit_hash 列
-merged_df = df_list[0]
-for df in df_list[1:]:
-    merged_df = pd.merge(merged_df, df, on='commit_hash', how='outer')
+                if not any(values[col] in NA_VALUES for col in cols_to_check):
+                    if values.get('classification') in NA_VALUES:
+                        values['classification'] = ''
+                    writer.writerow([format_value(col, values[col]) for col in available_columns])
 
-# 添加 'is_buggy_commit' 列，默认值为 1
-merged_df['is_buggy_commit'] = 1
+                heads = [next(rows, None) for rows in iterators]
+    finally:
+        shutil.rmtree(tmp_dir)
+    return writer.count
 
-# 按照指定的列顺序排列列
-available_columns = [col for col in columns_order if col in merged_df.columns]
-merged_df = merged_df[available_columns]
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="按 commit_hash 流式合并各阶段的特征文件，按 columns_order 输出。")
+    PARSER.add_argument("--files", "-f", nargs='+', default=files, help="要合并的特征文件（.csv 或 .parquet）")
+    PARSER.add_argument("--output", "-o", type=str, default=f"/home/WangZiyang/szz/{suffix_file}/merged_data{suffix_num}.csv", help="输出文件，以 .parquet 结尾时写为 Parquet")
+    PARSER.add_argument("--label", "-l", type=int, default=1, help="is_buggy_commit 列的取值")
+    PARSER.add_argument("--chunk-rows", type=int, default=200000, help="外部排序时每块的行数")
+    PARSER.add_argument("--tmp-dir", type=str, default=None, help="外部排序临时文件所在目录")
 
-# 删除合并后的空值行，但排除 'classification' 列，不将 'None' 作为空值处理
-cols_to_check = [col for col in available_columns if col != 'classification']
-merged_df = merged_df.dropna(subset=cols_to_check)
+    ARGS = PARSER.parse_args()
 
-# 保存合并后的数据为新的 CSV 文件
-output_file = f"/home/WangZiyang/szz/{suffix_file}/merged_data{suffix_num}.csv"
-merged_df.to_csv(output_file, index=False)
+    for path in ARGS.files:
+        if not os.path.exists(path):
+            print(f"{path} 不存在!")
+            sys.exit(1)
 
-print(f"Merged CSV saved as {output_file}")
+    COUNT = merge_features(ARGS.files, ARGS.output, ARGS.label, ARGS.chunk_rows, ARGS.tmp_dir)
+    print(f"Merged data saved as {ARGS.output} ({COUNT} rows)")
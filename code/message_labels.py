@@ -0,0 +1,138 @@
+import json
+import os
+import re
+import sys
+import warnings
+
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+from feature_io import TableWriter, iter_rows
+
+# 全局后缀变量
+suffix_num = "1"
+suffix_repo = "z3"
+suffix_branch = "master"
+suffix_file = "z3_data"
+
+# 默认关键词，与原先 001.py 的 classify_commit_message 和 005.py 的 PATTERNS 一致。
+# classification 按顺序匹配，靠前的分类优先；关键词按小写子串匹配。
+# fix 为正则表达式，忽略大小写，任意一个匹配即为修复提交。
+DEFAULT_KEYWORDS = {
+    "classification": [
+        {"label": "Corrective", "keywords": ["fix", "bug", "defect", "correct"]},
+        {"label": "Feature Addition", "keywords": ["add", "feature", "improvement", "introduce"]},
+        {"label": "Perfective", "keywords": ["improve", "enhance", "refactor", "optimize"]},
+        {"label": "Preventative", "keywords": ["prevent", "avoid", "secure"]},
+        {"label": "Non Functional", "keywords": ["non functional", "documentation", "doc", "comment"]},
+    ],
+    "default": "None",
+    "fix": [r"bug", r"fix", r"defect", r"patch"],
+}
+
+def load_keywords(path=None):
+    """
+    读取关键词配置（JSON，格式同 DEFAULT_KEYWORDS），缺少的部分使用默认值。
+    """
+    keywords = dict(DEFAULT_KEYWORDS)
+    if path:
+        with open(path, 'r') as inp:
+            keywords.update(json.load(inp))
+    return keywords
+
+class MessageLabeler:
+    """
+    每个分类的关键词编译为一个正则（关键词之间用 | 连接），fix 的所有模式也编译为一个正则，
+    每条消息只需小写一次，按分类顺序各搜索一次，命中即停止。
+    """
+
+    def __init__(self, keywords=None):
+        keywords = keywords or DEFAULT_KEYWORDS
+        groups = [group for group in keywords["classification"] if group["keywords"]]
+        self.labels = [group["label"] for group in groups] + [keywords["default"]]
+        self.class_patterns = [re.compile("|".join(re.escape(k.lower()) for k in group["keywords"])) for group in groups]
+        self.fix_pattern = re.compile("|".join(f"(?:{p})" for p in keywords["fix"]), re.IGNORECASE) if keywords["fix"] else None
+
+    def classify_code(self, message):
+        """
+        单条消息的分类下标，没有命中任何分类时为 len(labels) - 1。
+        """
+        message = message.lower()
+        for code, pattern in enumerate(self.class_patterns):
+            if pattern.search(message):
+                return code
+        return len(self.class_patterns)
+
+    def classify(self, message):
+        return self.labels[self.classify_code(message)]
+
+    def is_fix(self, message):
+        return self.fix_pattern is not None and self.fix_pattern.search(message) is not None
+
+    def label_messages(self, messages, batch_size=100000):
+        """
+        对任意多条消息分批打标签，返回 (classification 列表, fix 浮点数组)。
+        每批消息只小写一次，然后按分类顺序对整批中尚未分类的消息做一次向量化匹配（str.contains），
+        fix 也对整批匹配一次，不再逐条消息、逐个正则调用。
+        """
+        codes = np.full(len(messages), len(self.class_patterns), dtype=np.int16)
+        fixes = np.zeros(len(messages), dtype=np.float64)
+        for start in range(0, len(messages), batch_size):
+            batch = pd.Series(messages[start:start + batch_size], dtype=object)
+            lowered = batch.str.lower()
+            remaining = np.arange(len(batch))
+            for code, pattern in enumerate(self.class_patterns):
+                if len(remaining) == 0:
+                    break
+                hit = lowered.iloc[remaining].str.contains(pattern, na=False).to_numpy(dtype=bool)
+                codes[start + remaining[hit]] = code
+                remaining = remaining[~hit]
+            if self.fix_pattern is not None:
+                # 用户的 fix 正则可能带分组，pandas 会为此发出无关的警告
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", UserWarning)
+                    hit = batch.str.contains(self.fix_pattern, na=False)
+                fixes[start:start + len(batch)] = hit.to_numpy(dtype=np.float64)
+        return [self.labels[code] for code in codes], fixes
+
+# 默认关键词的标注器，供各阶段逐条调用
+DEFAULT_LABELER = MessageLabeler()
+
+def label_csv(input_path, output_path, labeler=DEFAULT_LABELER, commit_hashes=None):
+    """
+    读取包含 commit_hash 和 commit_message 列的CSV或Parquet文件（只读这两列），
+    输出 commit_hash,classification,fix。
+    """
+    hashes = []
+    messages = []
+    for commit_hash, message in iter_rows(input_path, ["commit_hash", "commit_message"]):
+        if commit_hashes is None or commit_hash in commit_hashes:
+            hashes.append(commit_hash)
+            messages.append(message)
+
+    classification, fixes = labeler.label_messages(messages)
+    with TableWriter(output_path, ["commit_hash", "classification", "fix"]) as writer:
+        for row in zip(hashes, classification, fixes):
+            writer.writerow([row[0], row[1], str(row[2])])
+    return len(hashes)
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="根据提交信息批量计算 classification 和 fix 列，不需要访问仓库。")
+    PARSER.add_argument("--input", "-i", type=str, default=f"./{suffix_file}/code_churns{suffix_num}.csv", help="包含 commit_hash 和 commit_message 列的CSV文件")
+    PARSER.add_argument("--output", "-o", type=str, default=f"./{suffix_file}/message_labels{suffix_num}.csv", help="输出文件")
+    PARSER.add_argument("--keywords", "-k", type=str, default=None, help="关键词配置JSON文件，格式同 DEFAULT_KEYWORDS")
+    PARSER.add_argument("--dump-keywords", action="store_true", help="输出默认关键词配置后退出")
+
+    ARGS = PARSER.parse_args()
+
+    if ARGS.dump_keywords:
+        json.dump(DEFAULT_KEYWORDS, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+        sys.exit(0)
+
+    if not os.path.exists(ARGS.input):
+        print("CSV文件不存在!")
+        sys.exit(1)
+
+    COUNT = label_csv(ARGS.input, ARGS.output, MessageLabeler(load_keywords(ARGS.keywords)))
+    print(f"{COUNT} messages labelled, written to {ARGS.output}")
@@ -0,0 +1,259 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from argparse import ArgumentParser
+
+# 全局后缀变量（只用于 --dump-manifest 输出的示例）
+suffix_num = "1"
+suffix_repo = "z3"
+suffix_branch = "master"
+suffix_file = "z3_data"
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 清单中每个仓库可以设置的字段及默认值；data_dir 默认为 ./<name>_data，
+# pairs 默认为 <data_dir>/fix_and_introducers_pairs.json
+REPO_DEFAULTS = {
+    "branch": "master",
+    "labels": [1, 0],
+    "engine": "stages",
+    "format": "csv",
+    "keywords": None,
+    "trace": False,         # true 时各阶段把按提交的记录写入 <data_dir>/trace，也可以直接给出目录
+    "max_files": 0,         # 大提交保护：修改文件数超过该值的提交按 large_mode 处理，0 表示不启用（见 diffstat.py）
+    "large_mode": "approximate",
+}
+
+def example_manifest():
+    return {
+        "workers": os.cpu_count(),
+        "defaults": dict(REPO_DEFAULTS),
+        "repos": [{
+            "name": suffix_repo,
+            "path": f"/home/WangZiyang/szz/{suffix_repo}",
+            "branch": suffix_branch,
+            "data_dir": f"./{suffix_file}",
+            "pairs": f"./{suffix_file}/fix_and_introducers_pairs.json",
+        }],
+    }
+
+def load_manifest(path):
+    """
+    读取仓库清单（JSON，格式见 --dump-manifest），补齐每个仓库的默认字段。
+    """
+    with open(path, 'r') as inp:
+        manifest = json.load(inp)
+    defaults = dict(REPO_DEFAULTS)
+    defaults.update(manifest.get("defaults", {}))
+
+    repos = []
+    for entry in manifest["repos"]:
+        repo = dict(defaults)
+        repo.update(entry)
+        repo.setdefault("data_dir", f"./{repo['name']}_data")
+        repo.setdefault("pairs", os.path.join(repo["data_dir"], "fix_and_introducers_pairs.json"))
+        if not repo["branch"].startswith("refs/"):
+            repo["branch"] = f"refs/heads/{repo['branch']}"
+        if repo["engine"] not in ("stages", "extract_all"):
+            raise ValueError(f"{repo['name']}: unknown engine {repo['engine']!r}")
+        repos.append(repo)
+    return manifest.get("workers") or os.cpu_count(), repos
+
+class Job:
+    """
+    流水线中的一步：在子进程中运行 code/ 下的一个脚本。
+    parallel 为 True 的步骤使用调度器（--processes），会按全局预算分配工作进程数。
+    """
+
+    def __init__(self, repo, name, script, args, deps=(), parallel=False):
+        self.repo = repo
+        self.name = name
+        self.script = script
+        self.args = args
+        self.deps = list(deps)
+        self.parallel = parallel
+        self.state = "pending"
+        self.workers = 0
+        self.process = None
+        self.log = None
+        self.start_time = None
+
+    @property
+    def key(self):
+        return f"{self.repo['name']}/{self.name}"
+
+    def command(self):
+        command = [sys.executable, os.path.join(CODE_DIR, self.script)] + self.args
+        if self.parallel and self.workers:
+            command += ["--processes", str(self.workers)]
+        return command
+
+def plan_repo(repo):
+    """
+    按依赖关系生成一个仓库的全部步骤，返回 Job 列表（依赖在前）。
+    """
+    data = repo["data_dir"]
+    common = ["-r", repo["path"], "-b", repo["branch"]]
+    index_root = ["--index-root", os.path.join(data, "commit_index")]
+    keywords = ["--keywords", repo["keywords"]] if repo["keywords"] else []
+    ext = ".parquet" if repo["format"] == "parquet" else ".csv"
+    trace_dir = repo["trace"] if isinstance(repo["trace"], str) else os.path.join(data, "trace")
+    trace = ["--trace", trace_dir] if repo["trace"] else []
+    guard = ["--max-files", str(repo["max_files"]), "--large-mode", repo["large_mode"]] if repo["max_files"] else []
+    jobs = []
+
+    def checkpoint(name):
+        # 并行步骤的断点目录：失败后重新运行 run_all.py 时从断点继续
+        return ["--checkpoint", os.path.join(data, "checkpoints", name)]
+
+    def add(name, script, args, deps=(), parallel=False):
+        jobs.append(Job(repo, name, script, args, deps, parallel))
+        return jobs[-1]
+
+    index = add("commit_index", "commit_index.py", common + ["-i", os.path.join(data, "commit_index")])
+    # 一次遍历提交索引同时写出 commit_id1（引入bug的提交）和 commit_id0（其余提交）
+    labels = add("bug_labels", "bug_labels.py", common + index_root + [
+        "-p", repo["pairs"], "-o", os.path.join(data, "bug_labels.csv"), "--buggy-output", os.path.join(data, "commit_id1.csv"),
+        "--clean-output", os.path.join(data, "commit_id0.csv"), "--pairs-output", os.path.join(data, "不同数据对.csv")], [index])
+    ids = {1: labels, 0: labels}
+
+    tree_cache = os.path.join(data, "tree_files")
+    if repo["engine"] == "extract_all":
+        for label in repo["labels"]:
+            add(f"extract_all{label}", "extract_all.py", common + index_root + keywords + [
+                "-c", os.path.join(data, f"commit_id{label}.csv"), "-o", os.path.join(data, f"merged_data{label}{ext}"),
+                "--label", str(label), "--loc-cache", os.path.join(data, "loc_cache.db"), "--project", repo["name"],
+                "--tree-cache", tree_cache] + trace + guard,
+                [index, ids[label]])
+        return jobs
+
+    diffstat_root = ["--diffstat-root", os.path.join(data, "diffstat")]
+    diffstat = add("diffstat", "diffstat.py", common + index_root + ["-s", os.path.join(data, "diffstat")] + trace + guard + checkpoint("diffstat"),
+                   [index], parallel=True)
+
+    # 003/004 的图在同一仓库的各标签之间共用，依次运行；第一次运行时建图，之后增量更新
+    last_exp = last_history = None
+    for label in repo["labels"]:
+        ids_csv = os.path.join(data, f"commit_id{label}.csv")
+        output = {stage: os.path.join(data, f"{stage}{label}{ext}")
+                  for stage in ["code_churns", "diffusion_features", "exp", "fix_features", "history", "lt"]}
+        deps = [index, ids[label]]
+
+        churn = add(f"001_{label}", "001.py", common + index_root + diffstat_root + keywords + [
+            "-c", ids_csv, "-o", output["code_churns"], "--project", repo["name"]] + trace + guard + checkpoint(f"001_{label}"),
+            deps + [diffstat], parallel=True)
+        diffusion = add(f"002_{label}", "002.py", common + index_root + diffstat_root + [
+            "-c", ids_csv, "-o", output["diffusion_features"]] + trace + guard + checkpoint(f"002_{label}"), deps + [diffstat], parallel=True)
+        exp = add(f"003_{label}", "003.py", common + index_root + [
+            "-sg", "-gp", os.path.join(data, "author_graph.db"), "-c", ids_csv, "-o", output["exp"], "--tree-cache", tree_cache] + trace,
+            deps + ([last_exp] if last_exp else []))
+        history = add(f"004_{label}", "004.py", common + index_root + diffstat_root + [
+            "-sg", "-gp", os.path.join(data, "file_graph.db"), "-c", ids_csv, "-o", output["history"], "--tree-cache", tree_cache] + trace,
+            deps + [diffstat] + ([last_history] if last_history else []))
+        fix = add(f"005_{label}", "005.py", common + index_root + keywords + [
+            "-c", ids_csv, "-m", output["code_churns"], "-o", output["fix_features"]], deps + [churn])
+        lt = add(f"006_{label}", "006.py", common + index_root + diffstat_root + [
+            "-c", ids_csv, "-o", output["lt"], "--loc-cache", os.path.join(data, "loc_cache.db")] + trace + guard + checkpoint(f"006_{label}"),
+            deps + [diffstat], parallel=True)
+        add(f"merge{label}", "merge.py", [
+            "-f", output["code_churns"], output["diffusion_features"], output["exp"], output["fix_features"], output["history"], output["lt"],
+            "-o", os.path.join(data, f"merged_data{label}{ext}"), "--label", str(label)],
+            [churn, diffusion, exp, history, fix, lt])
+        last_exp, last_history = exp, history
+    return jobs
+
+def run_jobs(jobs, workers, poll_interval=0.5):
+    """
+    在全局工作进程预算内并发运行所有仓库的步骤。
+    单进程步骤占用1个名额；并行步骤按仍有未完成步骤的仓库数平分预算，至少1个。
+    某一步失败时，依赖它的步骤被跳过，其他仓库继续运行。返回失败和跳过的步骤。
+    """
+    running = []
+    used = 0
+
+    while True:
+        for job in list(running):
+            if job.process.poll() is None:
+                continue
+            job.log.close()
+            running.remove(job)
+            used -= job.workers
+            job.state = "done" if job.process.returncode == 0 else "failed"
+            print(f"[{job.key}] {job.state} in {time.time() - job.start_time:.1f} seconds")
+
+        for job in jobs:
+            if job.state == "pending" and any(dep.state in ("failed", "skipped") for dep in job.deps):
+                job.state = "skipped"
+                print(f"[{job.key}] skipped")
+
+        pending = [job for job in jobs if job.state == "pending"]
+        if not pending and not running:
+            break
+
+        active_repos = len({job.repo["name"] for job in pending + running})
+        share = max(1, workers // max(1, active_repos))
+        ready = [job for job in pending if all(dep.state == "done" for dep in job.deps)]
+        # 正在运行步骤最少的仓库优先，使各仓库交替推进
+        ready.sort(key=lambda job: sum(r.repo is job.repo for r in running))
+        for job in ready:
+            if used >= workers:
+                break
+            job.workers = min(share, workers - used) if job.parallel else 1
+            log_dir = os.path.join(job.repo["data_dir"], "logs")
+            os.makedirs(log_dir, exist_ok=True)
+            job.log = open(os.path.join(log_dir, f"{job.name}.log"), 'w')
+            job.start_time = time.time()
+            job.process = subprocess.Popen(job.command(), stdout=job.log, stderr=subprocess.STDOUT)
+            job.state = "running"
+            used += job.workers
+            running.append(job)
+            print(f"[{job.key}] started with {job.workers} worker(s)")
+
+        time.sleep(poll_interval)
+
+    return [job for job in jobs if job.state in ("failed", "skipped")]
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="按仓库清单并发运行多个仓库的特征提取流水线，共用一个工作进程预算（替代 change_suffix.py）。")
+    PARSER.add_argument("manifest", nargs='?', default=None, help="仓库清单JSON文件，格式见 --dump-manifest")
+    PARSER.add_argument("--workers", "-w", type=int, default=None, help="全局工作进程预算，默认取清单中的 workers，否则为CPU数")
+    PARSER.add_argument("--repos", nargs='+', default=None, help="只运行这些名字的仓库")
+    PARSER.add_argument("--dry-run", action="store_true", help="只输出要运行的命令")
+    PARSER.add_argument("--dump-manifest", action="store_true", help="输出示例清单后退出")
+
+    ARGS = PARSER.parse_args()
+
+    if ARGS.dump_manifest:
+        json.dump(example_manifest(), sys.stdout, indent=2, ensure_ascii=False)
+        print()
+        sys.exit(0)
+
+    if not ARGS.manifest or not os.path.exists(ARGS.manifest):
+        print("清单文件不存在!")
+        sys.exit(1)
+
+    WORKERS, REPOS = load_manifest(ARGS.manifest)
+    WORKERS = ARGS.workers or WORKERS
+    if ARGS.repos:
+        REPOS = [repo for repo in REPOS if repo["name"] in ARGS.repos]
+
+    for repo in REPOS:
+        if not os.path.exists(repo["path"]):
+            print(f"{repo['name']}: the repository path {repo['path']} does not exist!")
+            sys.exit(1)
+
+    JOBS = [job for repo in REPOS for job in plan_repo(repo)]
+    if ARGS.dry_run:
+        for job in JOBS:
+            print(f"[{job.key}] {subprocess.list2cmdline(job.command())}")
+        sys.exit(0)
+
+    start_time = time.time()
+    FAILED = run_jobs(JOBS, WORKERS)
+    print(f"{len(JOBS) - len(FAILED)} of {len(JOBS)} steps finished in {time.time() - start_time:.1f} seconds with {WORKERS} workers")
+    for job in FAILED:
+        print(f"[{job.key}] {job.state}, see {os.path.join(job.repo['data_dir'], 'logs', job.name + '.log')}")
+    sys.exit(1 if FAILED else 0)
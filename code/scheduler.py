@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from functools import partial
+from multiprocessing import Pool, cpu_count
+import instrument
+import numpy as np
+from pygit2 import Repository
+from tqdm import tqdm
+from commit_index import CommitIndex
+from columnar import ColumnWriter, ColumnarResult, ShardWriter, done_chunks
+
+# 每个工作进程内的全局状态，由 _init_worker 在进程启动时设置一次
+_REPO = None
+_INDEX = None
+_WORKER = None
+_SCHEMA = None
+_SPILL_DIR = None
+_MULTI_ROW = False
+# 本工作进程的结果分片，处理第一块时创建
+_SHARD = None
+# 每处理完一块后在工作进程中调用的函数（例如把缓存写回磁盘）
+_CHUNK_HOOKS = []
+
+# 断点目录中记录本次运行参数的文件
+CHECKPOINT_FILE = "checkpoint.json"
+
+def register_chunk_hook(hook):
+    """
+    在当前工作进程中注册一个函数，每处理完一块提交后调用一次。
+    """
+    _CHUNK_HOOKS.append(hook)
+
+def _init_worker(repo_path, index_path, worker, schema, spill_dir, setup, multi_row):
+    global _REPO, _INDEX, _WORKER, _SCHEMA, _SPILL_DIR, _MULTI_ROW
+    _REPO = Repository(repo_path)
+    _INDEX = CommitIndex(index_path)
+    _WORKER = worker
+    _SCHEMA = schema
+    _SPILL_DIR = spill_dir
+    _MULTI_ROW = multi_row
+    instrument.init_worker_tracing()
+    if setup is not None:
+        setup()
+
+def _run_chunk(task):
+    """
+    处理一块拓扑相邻的提交，把结果按列追加到本进程的分片文件，
+    只向父进程返回 (块编号, 进程id, 提交数, 行数)；multi_row 时行数可能与提交数不同。
+    """
+    global _SHARD
+    chunk_id, positions = task
+    writer = ColumnWriter(_SCHEMA)
+    for pos in positions:
+        commit_hash = _INDEX.hex(pos)
+        instrument.begin_commit(commit_hash, int(pos))
+        result = _WORKER(_REPO, _REPO[commit_hash])
+        instrument.end_commit()
+        if _MULTI_ROW:
+            for row in result:
+                writer.append(row)
+        else:
+            writer.append(result)
+    if _SHARD is None:
+        _SHARD = ShardWriter(_SPILL_DIR)
+    _SHARD.append(chunk_id, writer)
+    for hook in _CHUNK_HOOKS:
+        hook()
+    instrument.flush()
+    return chunk_id, os.getpid(), len(positions), writer.count
+
+def checkpoint_key(worker, index, chunks, schema, setup, multi_row):
+    """
+    断点对应的运行参数：阶段函数及其 setup 参数、索引tip、输出列和分块方式都相同时才能接着上次运行。
+    """
+    positions = np.asarray([pos for chunk in chunks for pos in chunk], dtype=np.int64)
+    key = {
+        "worker": f"{os.path.basename(worker.__code__.co_filename)}:{worker.__qualname__}",
+        "tip": index.tip,
+        "schema": schema,
+        "setup": [setup.func.__qualname__] + [repr(arg) for arg in setup.args] if isinstance(setup, partial) else None,
+        "multi_row": multi_row,
+        "chunks": len(chunks),
+        "positions": hashlib.sha1(positions.tobytes()).hexdigest(),
+    }
+    return json.loads(json.dumps(key))
+
+def open_checkpoint(spill_dir, key, chunk_count):
+    """
+    打开断点目录，返回上次运行已完成的块编号集合。
+    目录中记录的参数与 key 不同时删除其中的旧结果块，从头开始。
+    """
+    os.makedirs(spill_dir, exist_ok=True)
+    path = os.path.join(spill_dir, CHECKPOINT_FILE)
+    if os.path.exists(path):
+        with open(path, 'r') as inp:
+            if json.load(inp) == key:
+                return set(i for i in done_chunks(spill_dir) if i < chunk_count)
+    for name in os.listdir(spill_dir):
+        if name.startswith("chunk_"):
+            shutil.rmtree(os.path.join(spill_dir, name))
+        elif name.startswith("shard_"):
+            os.remove(os.path.join(spill_dir, name))
+    with open(path, 'w') as output:
+        json.dump(key, output)
+    return set()
+
+def make_chunks(positions, chunk_size):
+    """
+    将按拓扑顺序排列的提交位置切分为相邻的小块。
+    """
+    positions = sorted(positions)
+    return [positions[i:i + chunk_size] for i in range(0, len(positions), chunk_size)]
+
+def run_stage(worker, repo_path, index, positions, schema, processes=None, chunk_size=8, spill_dir=None, setup=None, multi_row=False,
+              checkpoint_dir=None):
+    """
+    按需调度：进程池中空闲的进程每次领取一小块拓扑相邻的提交，
+    对其中每个提交调用 worker(repo, commit) 得到一行（列类型由 schema 给出）。
+    相邻提交共享packfile中的delta链和libgit2缓存，小块按需分发可以避免
+    个别巨大提交拖慢某一个进程的整体进度。
+    每个工作进程把结果按列追加到 spill_dir 中自己的分片文件（分片内按拓扑顺序），
+    返回的 ColumnarResult 在迭代时对各分片做k路归并，得到确定的拓扑顺序，
+    父进程和工作进程的内存占用都只与块的大小有关，与仓库大小无关。
+    setup 为可选的无参函数，在每个工作进程启动时调用一次（需可pickle）。
+    multi_row 为 True 时 worker 返回一个提交对应的多行结果。
+    checkpoint_dir 不为 None 时用作溢出目录并保留已完成的块：中断后用相同参数重新运行，
+    只处理上次没有完成的块，结果与一次运行完全相同；结果的 cleanup 会删除该目录。
+    """
+    processes = processes or cpu_count()
+    chunks = make_chunks(positions, chunk_size)
+    print(f"Using {processes} CPUs, {len(chunks)} chunks of up to {chunk_size} commits...")
+
+    done = set()
+    if checkpoint_dir is not None:
+        spill_dir = checkpoint_dir
+        done = open_checkpoint(spill_dir, checkpoint_key(worker, index, chunks, schema, setup, multi_row), len(chunks))
+        if done:
+            print(f"Resuming from {spill_dir}: {len(done)} of {len(chunks)} chunks already done")
+    elif spill_dir is None:
+        spill_dir = tempfile.mkdtemp(prefix="spill_")
+    os.makedirs(spill_dir, exist_ok=True)
+    tasks = [(i, chunk) for i, chunk in enumerate(chunks) if i not in done]
+
+    worker_ids = {}
+    progress = {}
+    rows = 0
+
+    start_time = time.time()
+    initargs = (repo_path, index.path, worker, schema, spill_dir, setup, multi_row)
+    with Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+        with tqdm(total=sum(len(c) for c in chunks), initial=sum(len(chunks[i]) for i in done)) as bar:
+            for chunk_id, pid, commits, count in pool.imap_unordered(_run_chunk, tasks):
+                name = worker_ids.setdefault(pid, f"w{len(worker_ids)}")
+                progress[name] = progress.get(name, 0) + commits
+                rows += count
+                bar.update(commits)
+                bar.set_postfix(progress)
+    end_time = time.time()
+
+    print("Done")
+    print(f"Overall processing time: {end_time - start_time} seconds")
+    print("Commits per worker: " + ", ".join(f"{name}={count}" for name, count in progress.items()))
+    if multi_row:
+        print(f"Rows written: {rows}")
+
+    return ColumnarResult(schema, spill_dir)
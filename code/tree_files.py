@@ -0,0 +1,69 @@
+import fnmatch
+import hashlib
+import json
+import os
+import re
+
+from pygit2 import GIT_FILEMODE_BLOB, GIT_FILEMODE_BLOB_EXECUTABLE, GIT_FILEMODE_TREE
+
+# 003/004 建图时作为初始文件集合的文件模式（原先只统计 .java 文件）
+DEFAULT_PATTERNS = ["*.java"]
+
+def compile_patterns(patterns):
+    """
+    把扩展名或 glob 模式编译为一个正则表达式：".java" 等同于 "*.java"；
+    不含 "/" 的模式匹配文件名，含 "/" 的模式匹配完整路径。
+    """
+    names = []
+    paths = []
+    for pattern in patterns:
+        if pattern.startswith("."):
+            pattern = "*" + pattern
+        (paths if "/" in pattern else names).append(fnmatch.translate(pattern))
+    name_re = re.compile("|".join(names)) if names else None
+    path_re = re.compile("|".join(paths)) if paths else None
+
+    def match(name, path):
+        return bool((name_re is not None and name_re.match(name)) or (path_re is not None and path_re.match(path)))
+    return match
+
+def iter_tree_files(repo, tree, patterns=DEFAULT_PATTERNS):
+    """
+    逐个产生树中匹配 patterns 的普通文件 (blob oid, 路径)。
+    只读取树对象，按 filemode 判断条目类型，不加载任何blob的内容；
+    符号链接和子模块被跳过。
+    """
+    match = compile_patterns(patterns)
+    stack = [(tree, "")]
+    while stack:
+        tree, prefix = stack.pop()
+        for entry in tree:
+            path = prefix + entry.name
+            if entry.filemode == GIT_FILEMODE_TREE:
+                stack.append((repo[entry.id], path + "/"))
+            elif entry.filemode in (GIT_FILEMODE_BLOB, GIT_FILEMODE_BLOB_EXECUTABLE) and match(entry.name, path):
+                yield entry.id, path
+
+def tree_files(repo, tree, patterns=DEFAULT_PATTERNS, cache_dir=None):
+    """
+    返回树中匹配 patterns 的文件 [(blob oid 的十六进制, 路径), ...]，按路径排序。
+    cache_dir 不为 None 时结果按 (树oid, 模式) 保存为JSON文件，
+    003 和 004 对同一个分支tip建图时只遍历一次。
+    """
+    path = None
+    if cache_dir is not None:
+        key = hashlib.sha1(json.dumps(sorted(patterns)).encode()).hexdigest()[:12]
+        path = os.path.join(cache_dir, f"{tree.id}.{key}.json")
+        if os.path.exists(path):
+            with open(path, 'r') as inp:
+                return [tuple(item) for item in json.load(inp)]
+
+    files = sorted(((str(oid), name) for oid, name in iter_tree_files(repo, tree, patterns)), key=lambda item: item[1])
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as output:
+            json.dump(files, output)
+        os.replace(tmp_path, path)
+    return files